@@ -202,16 +202,55 @@
 
 
 
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+import asyncio
+from abc import ABC, abstractmethod
+import contextlib
+import contextvars
+import copy
+import hashlib
+import itertools
+import importlib.util
+import ipaddress
+import re
+import shutil
+import subprocess
+import wave
+import zipfile
+from array import array
+from typing import Annotated, List, Optional
+import sqlite3
 import tempfile
+import threading
+import time
+import uuid
 import os
 import json
+from collections import OrderedDict, deque
+import numpy as np
+from pydantic import BeforeValidator, ConfigDict, Field, TypeAdapter, ValidationError, create_model
 from dotenv import load_dotenv
-from groq import Groq
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+import httpx
 from groq import RateLimitError, APIError
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Optional: local CPU transcription (pip install -r requirements-local.txt)
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+# Optional: semantic lecture search on CPU (pip install -r requirements-local.txt)
+try:
+    from fastembed import TextEmbedding
+except ImportError:
+    TextEmbedding = None
 
 # Setup logging
 logging.basicConfig(level=logging.INFO)
@@ -222,18 +261,443 @@ load_dotenv()
 
 app = FastAPI(title="ClassEcho")
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+# ==========================================
+# METRICS AND TRACING
+# ==========================================
+STAGE_SECONDS = Histogram(
+    "classecho_stage_seconds", "Time spent in each pipeline stage", ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+)
+REQUEST_SECONDS = Histogram(
+    "classecho_request_seconds", "End-to-end request latency", ["endpoint", "status"]
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    "classecho_in_flight_requests", "Requests currently being handled", ["endpoint"]
+)
+TOKENS = Counter(
+    "classecho_tokens_total", "LLM tokens used", ["key", "model", "kind"]
+)
+KEY_REQUESTS = Counter(
+    "classecho_key_requests_total", "Groq calls scheduled on each API key", ["key"]
+)
+RATE_LIMITS = Counter(
+    "classecho_rate_limits_total", "429 responses from Groq per API key", ["key"]
+)
+KEY_ROTATIONS = Counter(
+    "classecho_key_rotations_total", "Manual rotations of the preferred API key"
 )
+KEY_WAIT_SECONDS = Histogram(
+    "classecho_key_wait_seconds", "Time callers waited for a key with free budget"
+)
+GROQ_IN_FLIGHT = Gauge(
+    "classecho_groq_in_flight", "Groq API calls currently in flight"
+)
+
+# Set per request by the tracing middleware, echoed as X-Request-ID
+trace_id = contextvars.ContextVar("trace_id", default=None)
+# Priority class of the work making Groq calls: set by admission control for
+# requests and to "batch" by the job workers
+groq_priority = contextvars.ContextVar("groq_priority", default="interactive")
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str):
+    """Record how long the enclosed block takes under classecho_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def route_label(request: Request) -> str:
+    """Route template for a request, so /jobs/{job_id} is one label"""
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match.name == "FULL":
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """Assign a trace ID and track latency and in-flight requests per endpoint"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    trace_id.set(request_id)
+    endpoint = route_label(request)
+    status = 500
+    started = time.perf_counter()
+    IN_FLIGHT_REQUESTS.labels(endpoint).inc()
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        IN_FLIGHT_REQUESTS.labels(endpoint).dec()
+        REQUEST_SECONDS.labels(endpoint, str(status)).observe(time.perf_counter() - started)
+
 
 # ==========================================
 # GROQ API KEY ROTATION MANAGER
 # ==========================================
+def parse_reset_seconds(value):
+    """Parse Groq reset headers such as '7.66s', '2m59.56s' or '120ms'"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    return sum(float(amount) * units[unit] for amount, unit in parts) if parts else None
+
+
+def request_model(request: httpx.Request):
+    """Model a Groq request was made for (rate limits are per model), or None"""
+    if request.url.path.endswith("/audio/transcriptions"):
+        return WHISPER_MODEL   # Multipart upload streamed from disk; only one model is used
+    try:
+        return json.loads(request.content).get("model")
+    except (httpx.RequestNotRead, ValueError, AttributeError):
+        return None
+
+
+class ModelRateLimited(Exception):
+    """Every model a call could use is rate limited on the key it was given"""
+
+
+def http_pool_settings():
+    """
+    Connection pool settings for the shared Groq HTTP client
+    
+    HTTP/2 is used when the optional h2 package is installed, unless
+    GROQ_HTTP2=0.
+    """
+    http2 = os.environ.get("GROQ_HTTP2", "auto").lower()
+    h2_available = importlib.util.find_spec("h2") is not None
+    return {
+        "http2": h2_available if http2 == "auto" else http2 in ("1", "true", "yes") and h2_available,
+        "limits": httpx.Limits(
+            max_connections=int(os.environ.get("GROQ_POOL_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("GROQ_POOL_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=float(os.environ.get("GROQ_POOL_KEEPALIVE_EXPIRY", "60"))
+        ),
+        "timeout": httpx.Timeout(
+            float(os.environ.get("GROQ_TIMEOUT", "120")),
+            connect=float(os.environ.get("GROQ_CONNECT_TIMEOUT", "5"))
+        )
+    }
+
+
+class PrioritySemaphore:
+    def __init__(self, value, limits=None):
+        """
+        Semaphore whose waiters are served by priority class, then in arrival
+        order, with an optional cap on how many slots a class may hold
+        
+        Args:
+            value: Number of slots
+            limits: {priority: most slots that class may hold at once}
+        """
+        self.size = value
+        self.value = value
+        self.limits = limits or {}
+        self.held = {}
+        self.waiters = []
+        self.sequence = itertools.count()
+    
+    def _eligible(self, priority):
+        return self.held.get(priority, 0) < self.limits.get(priority, self.size)
+    
+    def _wake(self):
+        while self.value > 0:
+            eligible = [waiter for waiter in self.waiters if self._eligible(waiter[2])]
+            if not eligible:
+                return
+            waiter = min(eligible)
+            self.waiters.remove(waiter)
+            self._take(waiter[2])
+            waiter[3].set_result(None)
+    
+    def _take(self, priority):
+        self.value -= 1
+        self.held[priority] = self.held.get(priority, 0) + 1
+    
+    def release(self, priority):
+        self.value += 1
+        self.held[priority] -= 1
+        self._wake()
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, priority):
+        """Hold one slot for the block, waiting behind higher-priority callers"""
+        rank = PRIORITY_CLASSES.index(priority)
+        waiter = (rank, next(self.sequence), priority, asyncio.get_running_loop().create_future())
+        self.waiters.append(waiter)
+        self._wake()
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            elif waiter[3].done() and not waiter[3].cancelled():
+                self.release(priority)
+            raise
+        try:
+            yield
+        finally:
+            self.release(priority)
+    
+    def stats(self):
+        return {
+            "held": dict(self.held),
+            "waiting": {
+                priority: sum(waiter[2] == priority for waiter in self.waiters) for priority in PRIORITY_CLASSES
+            }
+        }
+
+
+class KeyState:
+    def __init__(self, index, rpm_limit):
+        """
+        Scheduling state for one API key: a requests-per-minute token bucket
+        and a parked-until time after 429s that can't be put down to a model.
+        Groq's own limits are per model and are kept in ModelLimits.
+        Times are wall-clock so they mean the same thing in every worker.
+        """
+        self.index = index
+        self.rpm_limit = rpm_limit
+        self.bucket = float(rpm_limit)
+        self.last_refill = time.time()
+        self.parked_until = 0.0
+        self.active = 0
+        self.requests = 0
+        self.rate_limits = 0
+    
+    def refill(self, now):
+        self.bucket = min(
+            self.rpm_limit, self.bucket + (now - self.last_refill) * self.rpm_limit / 60
+        )
+        self.last_refill = now
+    
+    def park(self, seconds):
+        self.parked_until = max(self.parked_until, time.time() + seconds)
+    
+    def seconds_until_ready(self, now):
+        wait_for_bucket = (1 - self.bucket) * 60 / self.rpm_limit if self.bucket < 1 else 0.0
+        return max(self.parked_until - now, wait_for_bucket, 0.0)
+    
+    def score(self):
+        """Higher is better: free request budget"""
+        return self.bucket - self.active
+    
+    def headroom(self, now):
+        """Share of the key's request budget that is free right now (0 to 1)"""
+        if self.parked_until > now:
+            return 0.0
+        return min(self.rpm_limit, self.bucket + (now - self.last_refill) * self.rpm_limit / 60) / self.rpm_limit
+    
+    def stats(self, now):
+        return {
+            "key": self.index + 1,
+            "available_requests": int(self.bucket),
+            "active_requests": self.active,
+            "parked_for_seconds": round(max(self.parked_until - now, 0.0), 1),
+            "requests": self.requests,
+            "rate_limits": self.rate_limits
+        }
+
+
+class ModelLimits:
+    def __init__(self):
+        """
+        Groq's budget for one model on one key, from its x-ratelimit-* headers,
+        and a parked-until time after that model's 429s. Times are wall-clock;
+        a budget counts as full again once its reset passes.
+        """
+        self.parked_until = 0.0
+        self.remaining_requests = None
+        self.limit_requests = None
+        self.requests_reset_at = 0.0
+        self.remaining_tokens = None
+        self.limit_tokens = None
+        self.tokens_reset_at = 0.0
+    
+    def park(self, seconds):
+        self.parked_until = max(self.parked_until, time.time() + seconds)
+    
+    def record(self, headers):
+        now = time.time()
+        if "x-ratelimit-remaining-requests" in headers:
+            self.remaining_requests = int(headers["x-ratelimit-remaining-requests"])
+            if "x-ratelimit-limit-requests" in headers:
+                self.limit_requests = int(headers["x-ratelimit-limit-requests"])
+            reset = parse_reset_seconds(headers.get("x-ratelimit-reset-requests")) or 60
+            self.requests_reset_at = now + reset
+            if self.remaining_requests == 0:
+                self.park(reset)
+        if "x-ratelimit-remaining-tokens" in headers:
+            self.remaining_tokens = int(headers["x-ratelimit-remaining-tokens"])
+            if "x-ratelimit-limit-tokens" in headers:
+                self.limit_tokens = int(headers["x-ratelimit-limit-tokens"])
+            reset = parse_reset_seconds(headers.get("x-ratelimit-reset-tokens")) or 60
+            self.tokens_reset_at = now + reset
+            if self.remaining_tokens == 0:
+                self.park(reset)
+    
+    def headroom(self, now):
+        """Share of the model's request and token budget on this key that is free (0 to 1)"""
+        if self.parked_until > now:
+            return 0.0
+        fraction = 1.0
+        if self.limit_requests and self.remaining_requests is not None and now < self.requests_reset_at:
+            fraction = min(fraction, self.remaining_requests / self.limit_requests)
+        if self.limit_tokens and self.remaining_tokens is not None and now < self.tokens_reset_at:
+            fraction = min(fraction, self.remaining_tokens / self.limit_tokens)
+        return fraction
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedKeyState:
+    def __init__(self, db_path, api_keys):
+        """
+        Key budgets, per-model limits, cooldowns and the preferred key kept in
+        a SQLite (WAL) file so every uvicorn worker schedules against the same pool
+        
+        Args:
+            db_path: SQLite file shared by the workers on this host
+            api_keys: The keys, identified in the file by a hash rather than position
+        """
+        self.db_path = db_path
+        self.key_ids = [hashlib.sha256(key.encode("utf-8")).hexdigest()[:16] for key in api_keys]
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS key_state ("
+                "key_id TEXT PRIMARY KEY, bucket REAL NOT NULL, last_refill REAL NOT NULL, "
+                "parked_until REAL NOT NULL, requests INTEGER NOT NULL, rate_limits INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS model_limits ("
+                "key_id TEXT NOT NULL, model TEXT NOT NULL, parked_until REAL NOT NULL, "
+                "remaining_requests INTEGER, limit_requests INTEGER, requests_reset_at REAL NOT NULL, "
+                "remaining_tokens INTEGER, limit_tokens INTEGER, tokens_reset_at REAL NOT NULL, "
+                "PRIMARY KEY (key_id, model))"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS key_pool (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS key_workers ("
+                "pid INTEGER PRIMARY KEY, in_flight INTEGER NOT NULL, updated_at REAL NOT NULL)"
+            )
+        logger.info(f"Key pool state shared through {db_path}")
+    
+    @contextlib.contextmanager
+    def transaction(self, manager):
+        """
+        Load the shared state into the manager, run the block, and write it back,
+        holding the database write lock throughout
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._load(manager)
+                yield
+                self._save(manager)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def refresh(self, manager):
+        """Read-only load of the shared state (for status endpoints)"""
+        with self.lock:
+            self._load(manager)
+    
+    def _load(self, manager):
+        rows = {
+            row[0]: row[1:] for row in self.conn.execute(
+                "SELECT key_id, bucket, last_refill, parked_until, requests, rate_limits FROM key_state"
+            )
+        }
+        for key_id, state in zip(self.key_ids, manager.key_states):
+            if key_id in rows:
+                (state.bucket, state.last_refill, state.parked_until,
+                 state.requests, state.rate_limits) = rows[key_id]
+        indexes = {key_id: index for index, key_id in enumerate(self.key_ids)}
+        for key_id, model, *row in self.conn.execute(
+            "SELECT key_id, model, parked_until, remaining_requests, limit_requests, requests_reset_at, "
+            "remaining_tokens, limit_tokens, tokens_reset_at FROM model_limits"
+        ):
+            if key_id in indexes:
+                limits = manager.limits_for(indexes[key_id], model)
+                (limits.parked_until, limits.remaining_requests, limits.limit_requests, limits.requests_reset_at,
+                 limits.remaining_tokens, limits.limit_tokens, limits.tokens_reset_at) = row
+        row = self.conn.execute("SELECT value FROM key_pool WHERE name = 'current_key'").fetchone()
+        if row and row[0] in self.key_ids:
+            manager.current_key_index = self.key_ids.index(row[0])
+    
+    def _save(self, manager):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO key_state (key_id, bucket, last_refill, parked_until, "
+            "requests, rate_limits) VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (key_id, state.bucket, state.last_refill, state.parked_until,
+                 state.requests, state.rate_limits)
+                for key_id, state in zip(self.key_ids, manager.key_states)
+            ]
+        )
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO model_limits (key_id, model, parked_until, remaining_requests, "
+            "limit_requests, requests_reset_at, remaining_tokens, limit_tokens, tokens_reset_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (self.key_ids[index], model, limits.parked_until, limits.remaining_requests,
+                 limits.limit_requests, limits.requests_reset_at, limits.remaining_tokens,
+                 limits.limit_tokens, limits.tokens_reset_at)
+                for (index, model), limits in manager.model_limits.items()
+            ]
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO key_pool (name, value) VALUES ('current_key', ?)",
+            (self.key_ids[manager.current_key_index],)
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO key_workers (pid, in_flight, updated_at) VALUES (?, ?, ?)",
+            (self.pid, manager.in_flight, time.time())
+        )
+    
+    def workers(self):
+        """Live workers and their in-flight Groq calls; rows of exited workers are dropped"""
+        with self.lock:
+            rows = self.conn.execute("SELECT pid, in_flight FROM key_workers").fetchall()
+            dead = [(pid,) for pid, _ in rows if pid != self.pid and not pid_alive(pid)]
+            if dead:
+                self.conn.executemany("DELETE FROM key_workers WHERE pid = ?", dead)
+        return {pid: in_flight for pid, in_flight in rows if (pid,) not in dead}
+    
+    def close(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM key_workers WHERE pid = ?", (self.pid,))
+            self.conn.close()
+
+
 class GroqKeyManager:
     def __init__(self):
         # Load all available API keys from environment
@@ -262,15 +726,63 @@ class GroqKeyManager:
         
         logger.info(f"Total API keys loaded: {len(self.api_keys)}")
         
-        # Initialize client with first key
-        self.client = Groq(api_key=self.api_keys[self.current_key_index])
+        # Cap the number of Groq calls in flight at once (GROQ_MAX_CONCURRENCY).
+        # Live and interactive calls are served first, and batch work (/batch
+        # and /jobs) never holds more than GROQ_BATCH_MAX_CONCURRENCY slots.
+        self.max_concurrency = int(os.environ.get("GROQ_MAX_CONCURRENCY", "8"))
+        self.semaphore = PrioritySemaphore(self.max_concurrency, {"batch": int(os.environ.get(
+            "GROQ_BATCH_MAX_CONCURRENCY", str(max(1, self.max_concurrency // 2))
+        ))})
+        self.in_flight = 0
+        
+        # Per-key budgets; callers wait up to GROQ_MAX_WAIT_SECONDS for a free key
+        rpm_limit = int(os.environ.get("GROQ_RPM_LIMIT", "30"))
+        self.max_wait = float(os.environ.get("GROQ_MAX_WAIT_SECONDS", "30"))
+        self.key_states = [KeyState(i, rpm_limit) for i in range(len(self.api_keys))]
+        self.model_limits = {}   # (key index, model) -> ModelLimits
+        self.key_lookup = {f"Bearer {key}": i for i, key in enumerate(self.api_keys)}
+        
+        # With KEY_STATE_DB set, budgets and cooldowns are shared by every worker
+        # process; otherwise each process schedules on its own
+        key_state_db = os.environ.get("KEY_STATE_DB")
+        self.shared = SharedKeyState(key_state_db, self.api_keys) if key_state_db else None
+        
+        # One long-lived client per key, all sharing a single keep-alive pool.
+        # Rate-limit headers are read from every response, and SDK retries
+        # are off so 429s come straight back to the scheduler.
+        self.http_client = DefaultAsyncHttpxClient(**http_pool_settings(), event_hooks={
+            "response": [self._record_rate_limits]
+        })
+        self.clients = [
+            AsyncGroq(api_key=key, http_client=self.http_client, max_retries=0)
+            for key in self.api_keys
+        ]
+    
+    @property
+    def client(self):
+        return self.clients[self.current_key_index]
     
     def get_client(self):
         """Get current Groq client"""
         return self.client
     
+    def shared_state(self):
+        """Context in which key state is read from and written back to the shared store"""
+        return self.shared.transaction(self) if self.shared else contextlib.nullcontext()
+    
+    async def update_state(self, change):
+        """Apply change() to the key states, through the shared store when there is one"""
+        if not self.shared:
+            change()
+            return
+        
+        def apply():
+            with self.shared_state():
+                change()
+        await asyncio.to_thread(apply)
+    
     def rotate_key(self):
-        """Rotate to next available API key"""
+        """Rotate the preferred key to the next available API key"""
         if len(self.api_keys) <= 1:
             logger.error("No backup keys available!")
             raise HTTPException(
@@ -278,41 +790,155 @@ class GroqKeyManager:
                 detail="All API keys exhausted. Please try again later."
             )
         
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        self.client = Groq(api_key=self.api_keys[self.current_key_index])
+        with self.shared_state():
+            self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
+        KEY_ROTATIONS.inc()
         logger.warning(f"Rotated to API key #{self.current_key_index + 1}")
         return self.client
     
-    async def execute_with_retry(self, func, *args, max_retries=None, **kwargs):
+    def limits_for(self, index, model):
+        return self.model_limits.setdefault((index, model), ModelLimits())
+    
+    def model_available(self, model, index=None):
+        """Whether the model isn't rate limited on the key (on any key if index is None)"""
+        now = time.time()
+        indexes = range(len(self.api_keys)) if index is None else [index]
+        return any(self.limits_for(i, model).parked_until <= now for i in indexes)
+    
+    def model_headroom(self, model):
+        """Share of the pool's budget for the model that is free right now (0 to 1)"""
+        now = time.time()
+        free = [
+            min(state.headroom(now), self.limits_for(state.index, model).headroom(now))
+            for state in self.key_states
+        ]
+        return sum(free) / len(free)
+    
+    async def park_model(self, index, model, seconds):
+        """Skip the model on the key (in every worker) for seconds after a 429"""
+        def park():
+            self.key_states[index].rate_limits += 1
+            self.limits_for(index, model).park(seconds)
+        await self.update_state(park)
+    
+    async def _record_rate_limits(self, response):
+        """Update the model's budget on the key from Groq's x-ratelimit-* response headers"""
+        index = self.key_lookup.get(response.request.headers.get("authorization"))
+        if index is None or not any(name.startswith("x-ratelimit-") for name in response.headers):
+            return
+        model = request_model(response.request)
+        if model:
+            await self.update_state(lambda: self.limits_for(index, model).record(response.headers))
+    
+    def seconds_until_ready(self, state, models, now):
+        """Wait for the key's request budget and for one of the models to be free on it"""
+        wait = state.seconds_until_ready(now)
+        if models:
+            wait = max(wait, min(self.limits_for(state.index, model).parked_until - now for model in models))
+        return max(wait, 0.0)
+    
+    def try_acquire(self, models=None):
+        """
+        Reserve one request on the ready key with the most budget, passing over
+        keys on which every one of the call's models is rate limited; returns
+        (state, 0) or (None, seconds until some key is ready)
+        """
+        with self.shared_state():
+            now = time.time()
+            for state in self.key_states:
+                state.refill(now)
+            
+            waits = {state.index: self.seconds_until_ready(state, models, now) for state in self.key_states}
+            ready = [s for s in self.key_states if waits[s.index] == 0]
+            if not ready:
+                return None, min(waits.values())
+            
+            # Ties go to the preferred key so /rotate-key still has an effect
+            state = max(ready, key=lambda s: (s.score(), s.index == self.current_key_index))
+            state.bucket -= 1
+            state.requests += 1
+            self.current_key_index = state.index
+            return state, 0.0
+    
+    async def acquire_key(self, models=None):
+        """
+        Wait for the key with the most remaining budget and reserve one request on it
+        """
+        started = time.time()
+        deadline = started + self.max_wait
+        while True:
+            if self.shared:
+                state, wait = await asyncio.to_thread(self.try_acquire, models)
+            else:
+                state, wait = self.try_acquire(models)
+            now = time.time()
+            if state:
+                state.active += 1
+                KEY_REQUESTS.labels(str(state.index + 1)).inc()
+                KEY_WAIT_SECONDS.observe(now - started)
+                return state
+            
+            if now + wait > deadline:
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"All {len(self.api_keys)} API keys are rate limited. Please try again later.",
+                    headers={"Retry-After": str(int(wait) + 1)}
+                )
+            await asyncio.sleep(wait)
+    
+    async def execute_with_retry(self, func, *args, max_retries=None, models=None, **kwargs):
         """
-        Execute a function with automatic key rotation on rate limit
+        Execute a function on the key with the most remaining budget
+        
+        At most max_concurrency calls run at once; the rest wait on the
+        semaphore without blocking the event loop, served by the caller's
+        priority class (groq_priority). Groq's limits are per
+        model, so a 429 parks the model on that key and the call moves to a
+        key where one of its models is free, waiting for the earliest reset
+        if there is none; the key itself is parked only when the limited
+        model can't be told.
         
         Args:
-            func: The function to execute
-            max_retries: Maximum number of key rotations (default: number of keys)
+            func: The async function to execute, called as func(client, *args, **kwargs)
+            max_retries: Maximum number of attempts (default: twice the number of keys)
+            models: Models the call may use (None if unknown)
             *args, **kwargs: Arguments to pass to the function
         """
         if max_retries is None:
-            max_retries = len(self.api_keys)
-        
-        last_error = None
+            max_retries = 2 * len(self.api_keys)
         
         for attempt in range(max_retries):
+            state = await self.acquire_key(models)
             try:
-                # Execute the function with current client
-                result = await func(self.get_client(), *args, **kwargs)
+                # Execute the function with the scheduled key's client
+                async with self.semaphore.slot(groq_priority.get()):
+                    self.in_flight += 1
+                    GROQ_IN_FLIGHT.inc()
+                    try:
+                        result = await func(self.clients[state.index], *args, **kwargs)
+                    finally:
+                        self.in_flight -= 1
+                        GROQ_IN_FLIGHT.dec()
                 return result
                 
+            except ModelRateLimited:
+                logger.warning(f"Every model for this call is rate limited on key #{state.index + 1}")
+            
             except RateLimitError as e:
-                last_error = e
-                logger.warning(f"Rate limit hit on key #{self.current_key_index + 1}: {str(e)}")
-                
-                if attempt < max_retries - 1:
-                    # Rotate to next key
-                    self.rotate_key()
-                    logger.info(f"Retrying with key #{self.current_key_index + 1}...")
+                RATE_LIMITS.labels(str(state.index + 1)).inc()
+                retry_after = parse_reset_seconds(e.response.headers.get("retry-after")) or 60
+                model = request_model(e.response.request)
+                if model:
+                    await model_router.park(state.index, model, retry_after)
                 else:
-                    logger.error("All API keys exhausted!")
+                    def park(state=state, retry_after=retry_after):
+                        state.rate_limits += 1
+                        state.park(retry_after)
+                    await self.update_state(park)
+                logger.warning(
+                    f"Rate limit hit on key #{state.index + 1} for {model or 'every model'}, "
+                    f"parked for {retry_after:.0f}s: {str(e)}"
+                )
                     
             except APIError as e:
                 # For other API errors, don't retry
@@ -322,16 +948,177 @@ class GroqKeyManager:
             except Exception as e:
                 logger.error(f"Unexpected error: {str(e)}")
                 raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+            
+            finally:
+                state.active -= 1
         
-        # If we exhausted all retries
+        logger.error("All API keys exhausted!")
+        now = time.time()
+        wait = min(self.seconds_until_ready(state, models, now) for state in self.key_states)
         raise HTTPException(
             status_code=429,
-            detail=f"All {len(self.api_keys)} API keys are rate limited. Please try again later."
+            detail=f"All {len(self.api_keys)} API keys are rate limited. Please try again later.",
+            headers={"Retry-After": str(int(wait) + 1)}
         )
+    
+    def stats(self):
+        """Per-key budgets for /api-status (deployment-wide when state is shared)"""
+        if self.shared:
+            self.shared.refresh(self)
+        now = time.time()
+        return [state.stats(now) for state in self.key_states]
+    
+    def deployment(self):
+        """Worker processes sharing the key pool and their in-flight calls"""
+        workers = self.shared.workers() if self.shared else {}
+        workers[os.getpid()] = self.in_flight
+        return {
+            "shared_state": bool(self.shared),
+            "workers": len(workers),
+            "in_flight_requests": sum(workers.values())
+        }
 
 # Initialize key manager
 key_manager = GroqKeyManager()
 
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await key_manager.http_client.aclose()
+    if key_manager.shared:
+        key_manager.shared.close()
+
+
+def record_token_usage(client: AsyncGroq, model: str, usage):
+    """Count prompt and completion tokens against the key that made the call"""
+    if usage is None:
+        return
+    key = str(key_manager.clients.index(client) + 1) if client in key_manager.clients else "unknown"
+    TOKENS.labels(key, model, "prompt").inc(usage.prompt_tokens or 0)
+    TOKENS.labels(key, model, "completion").inc(usage.completion_tokens or 0)
+
+# ==========================================
+# RESULT CACHE (IN-MEMORY LRU + OPTIONAL SQLITE)
+# ==========================================
+class ResultCache:
+    def __init__(self, name, max_entries=256, ttl_seconds=86400, db_path=None):
+        """
+        Two-tier cache with LRU eviction in memory and an optional SQLite tier
+        
+        Args:
+            name: Cache name, also used as the SQLite table name
+            max_entries: Maximum number of entries kept per tier
+            ttl_seconds: Entries older than this are treated as missing
+            db_path: SQLite file for the on-disk tier (None disables it)
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.db_path = db_path
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        if self.db_path:
+            with self._connect() as conn:
+                # WAL lets worker processes read the shared tier while one writes
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {self.name} "
+                    "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)"
+                )
+            logger.info(f"{self.name} cache persisted to {self.db_path}")
+    
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def _expired(self, created_at):
+        return time.time() - created_at > self.ttl_seconds
+    
+    def get(self, key):
+        """Return the cached value for key, or None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(created_at):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+        
+        if self.db_path:
+            with self._connect() as conn:
+                row = conn.execute(
+                    f"SELECT value, created_at FROM {self.name} WHERE key = ?", (key,)
+                ).fetchone()
+            if row and not self._expired(row[1]):
+                value = json.loads(row[0])
+                self._remember(key, value, row[1])
+                with self.lock:
+                    self.disk_hits += 1
+                return value
+        
+        with self.lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key, value):
+        """Store value under key in every enabled tier"""
+        created_at = time.time()
+        self._remember(key, value, created_at)
+        
+        if self.db_path:
+            with self._connect() as conn:
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {self.name} (key, value, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), created_at)
+                )
+                # Drop expired rows, then the oldest rows beyond max_entries
+                conn.execute(
+                    f"DELETE FROM {self.name} WHERE created_at < ?",
+                    (created_at - self.ttl_seconds,)
+                )
+                conn.execute(
+                    f"DELETE FROM {self.name} WHERE key NOT IN "
+                    f"(SELECT key FROM {self.name} ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries,)
+                )
+    
+    def _remember(self, key, value, created_at):
+        with self.lock:
+            self.entries[key] = (value, created_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def stats(self):
+        """Hit/miss counters for /api-status"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "persistent": bool(self.db_path),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.disk_hits) / lookups, 3) if lookups else 0.0
+        }
+
+# Transcripts are keyed by a SHA-256 of the raw audio bytes
+transcript_cache = ResultCache(
+    "transcripts",
+    max_entries=int(os.environ.get("TRANSCRIPT_CACHE_SIZE", "256")),
+    ttl_seconds=int(os.environ.get("TRANSCRIPT_CACHE_TTL", "86400")),
+    db_path=os.environ.get("TRANSCRIPT_CACHE_DB")
+)
+
 # ==========================================
 # ENDPOINTS
 # ==========================================
@@ -347,302 +1134,2829 @@ def home():
 @app.get("/api-status")
 def api_status():
     """Check API key status"""
+    keys = key_manager.stats()
     return {
         "total_keys": len(key_manager.api_keys),
         "current_key_index": key_manager.current_key_index + 1,
-        "keys_remaining": len(key_manager.api_keys) - key_manager.current_key_index
+        "keys_remaining": len(key_manager.api_keys) - key_manager.current_key_index,
+        "max_concurrency": key_manager.max_concurrency,
+        "in_flight_requests": key_manager.in_flight,
+        "groq_slots": key_manager.semaphore.stats(),
+        "deployment": key_manager.deployment(),
+        "keys": keys,
+        "transcript_cache": transcript_cache.stats(),
+        "llm_cache": llm_cache.stats(),
+        "transcription_backend": DEFAULT_TRANSCRIPTION_BACKEND,
+        "local_whisper_available": transcription_backends["local"].available(),
+        "audio_preprocessing": {**audio_stats, "ffmpeg": bool(FFMPEG), "upload_codec": AUDIO_UPLOAD_CODEC},
+        "vad": {
+            **{name: round(value, 2) for name, value in vad_stats.items()},
+            "fraction_dropped": round(
+                1 - vad_stats["seconds_kept"] / vad_stats["seconds_in"], 3
+            ) if vad_stats["seconds_in"] else 0.0
+        },
+        "jobs": job_queue.stats(),
+        "admission": admission.stats(),
+        "model_routing": model_router.stats(),
+        "lecture_store": lecture_store.stats(),
+        "live_sessions": sum(session.status != "closed" for session in live_sessions.values()),
+        "batch_stage_slots": {name: limit._value for name, limit in batch_stage_limits.items()}
     }
 
-# ==========================================
-# SPEECH TO TEXT WITH KEY ROTATION
-# ==========================================
-async def speech_to_text_groq(client: Groq, audio_bytes: bytes) -> str:
-    """
-    Uses Groq's Whisper implementation with provided client
-    """
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp.write(audio_bytes)
-        tmp_path = tmp.name
-
-    try:
-        with open(tmp_path, "rb") as f:
-            transcription = client.audio.transcriptions.create(
-                file=f,
-                model="whisper-large-v3-turbo",
-                response_format="text",
-                language="en",
-                temperature=0.0
-            )
-        return transcription
-    finally:
-        os.remove(tmp_path)
-
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics in text exposition format"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 # ==========================================
-# SUMMARIZE WITH KEY ROTATION
+# ADMISSION CONTROL
 # ==========================================
-async def summarize_and_structure(client: Groq, text: str) -> dict:
-    """
-    Generate structured notes using provided Groq client
-    """
-    prompt = f"""
-You are an expert note-taking assistant and learning guide. Your task is to transform the following transcript into comprehensive, actionable study notes.
-
-**Instructions:**
-1. Identify and extract all speakers (if mentioned) and attribute their contributions
-2. Organize content into clear topics with descriptive headings
-3. For each topic, provide:
-   - Key points with detailed explanations
-   - Context and additional insights to deepen understanding
-   - Practical examples or applications
-   - Recommended learning resources (books, courses, articles, or tools)
-   - Summary that connects ideas together
-4. Act as a learning guide by highlighting important concepts and suggesting next steps
-
-Return the result in strict JSON with this exact format:
-{{
-  "title": "Descriptive Title of the Lecture/Discussion",
-  "overview": "Brief 2-3 sentence overview of the entire content",
-  "speakers": [
-    {{
-      "name": "Speaker Name or 'Unknown' if not mentioned",
-      "role": "Their role or context if mentioned",
-      "key_contributions": ["Main points they discussed"]
-    }}
-  ],
-  "topics": [
-    {{
-      "heading": "Clear Topic Heading",
-      "summary": "2-3 sentence summary of this topic",
-      "key_points": [
-        {{
-          "point": "Main point statement",
-          "explanation": "Detailed explanation with context",
-          "examples": ["Practical example 1", "Practical example 2"],
-          "importance": "Why this matters or how to apply it"
-        }}
-      ],
-      "additional_insights": [
-        "Extra context or connection to other concepts",
-        "Common misconceptions or pitfalls to avoid"
-      ],
-      "recommended_resources": [
-        {{
-          "type": "book|course|article|video|tool|documentation",
-          "title": "Resource name",
-          "description": "Why this resource is helpful",
-          "url": "URL if applicable or 'Search online'"
-        }}
-      ]
-    }}
-  ],
-  "key_takeaways": [
-    "Most important insight 1",
-    "Most important insight 2",
-    "Most important insight 3"
-  ],
-  "action_items": [
-    "Specific next step or practice exercise 1",
-    "Specific next step or practice exercise 2"
-  ],
-  "further_learning": {{
-    "beginner": ["Resource for those new to the topic"],
-    "intermediate": ["Resource for those with some knowledge"],
-    "advanced": ["Resource for deep diving"]
-  }}
-}}
-
-**Transcript:**
-{text}
-
-**Important:** 
-- If speakers are not identified in the transcript, use "Speaker 1", "Speaker 2" or "Unknown Speaker"
-- Ensure all JSON is properly formatted with correct escaping
-- Provide specific, actionable resource recommendations
-- Keep summaries concise but informative
-- Focus on creating value beyond just transcribing - add insights that help learning
-"""
-    
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.2,
-        response_format={"type": "json_object"}
-    )
-
-    raw_output = response.choices[0].message.content.strip()
+# Highest priority first; clients may ask for a lower class with X-Priority
+PRIORITY_CLASSES = ("live", "interactive", "batch")
+INTERACTIVE_ROUTES = {
+    "/generate_notes", "/generate_qa", "/process-lecture",
+    "/generate_notes/stream", "/generate_qa/stream"
+}
+BATCH_ROUTES = {"/batch", "/jobs"}
 
-    try:
-        notes = json.loads(raw_output)
-    except json.JSONDecodeError:
-        start = raw_output.find("{")
-        end = raw_output.rfind("}") + 1
-        json_str = raw_output[start:end]
-        notes = json.loads(json_str)
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "100")) * 1024 * 1024)
+MAX_BATCH_UPLOAD_BYTES = int(float(os.environ.get("MAX_BATCH_UPLOAD_MB", "1024")) * 1024 * 1024)
+MAX_AUDIO_SECONDS = float(os.environ.get("MAX_AUDIO_SECONDS", str(4 * 3600)))
+FFPROBE = shutil.which("ffprobe")
 
-    return notes
+ADMISSION_WAIT_SECONDS = Histogram(
+    "classecho_admission_wait_seconds", "Time requests waited for an admission slot", ["priority"]
+)
+ADMISSION_REJECTIONS = Counter(
+    "classecho_admission_rejections_total", "Requests turned away by admission control", ["reason"]
+)
+ADMISSION_QUEUE = Gauge(
+    "classecho_admission_queue_depth", "Requests waiting for an admission slot"
+)
 
 
-# ==========================================
-# Q&A GENERATION FUNCTION
-# ==========================================
-async def generate_questions_and_answers(client: Groq, text: str) -> dict:
-    """
-    Generate comprehensive Q&A based on the transcript
-    Returns 20 most relevant questions with detailed answers
-    """
-    prompt = f"""
-You are an expert educator and question generator. Your task is to create comprehensive, thoughtful questions and answers based on the following transcript to help students test their understanding and reinforce learning.
-
-**Instructions:**
-1. Analyze the transcript thoroughly
-2. Generate exactly 20 questions that cover:
-   - Key concepts and definitions (5 questions)
-   - Application and practical scenarios (5 questions)
-   - Critical thinking and analysis (5 questions)
-   - Synthesis and connections (5 questions)
-3. Each question should:
-   - Be clear and specific
-   - Test real understanding, not just memorization
-   - Be answerable from the content provided
-   - Progress from basic to advanced difficulty
-4. Each answer should:
-   - Be comprehensive yet concise
-   - Include examples where relevant
-   - Explain the "why" not just the "what"
-   - Connect to broader concepts when applicable
-
-Return the result in strict JSON with this exact format:
-{{
-  "topic": "Main topic of the transcript",
-  "total_questions": 20,
-  "difficulty_breakdown": {{
-    "easy": 5,
-    "medium": 10,
-    "hard": 5
-  }},
-  "questions": [
-    {{
-      "id": 1,
-      "question": "Clear, specific question text",
-      "answer": "Comprehensive answer with explanation",
-      "difficulty": "easy|medium|hard",
-      "category": "concept|application|critical_thinking|synthesis",
-      "key_terms": ["term1", "term2"],
-      "related_topics": ["topic1", "topic2"]
-    }}
-  ],
-  "study_tips": [
-    "Tip 1 for effective studying",
-    "Tip 2 for retention",
-    "Tip 3 for application"
-  ],
-  "quiz_summary": {{
-    "main_themes": ["theme1", "theme2", "theme3"],
-    "prerequisites": ["What students should know before"],
-    "next_steps": ["What to study next"]
-  }}
-}}
-
-**Transcript:**
-{text}
-
-**Important:** 
-- Generate EXACTLY 20 questions
-- Ensure questions are diverse in type and difficulty
-- Answers should be 2-4 sentences each
-- Focus on understanding, not trivia
-- Make questions practical and relevant
-"""
-    
-    response = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.3,  # Slightly higher for more diverse questions
-        response_format={"type": "json_object"}
-    )
+def admission_class(method: str, path: str):
+    """Priority class of an audio-processing request, or None if it isn't gated"""
+    if method != "POST":
+        return None
+    if path.startswith("/live/sessions/"):
+        return "live"
+    if path in INTERACTIVE_ROUTES:
+        return "interactive"
+    if path in BATCH_ROUTES:
+        return "batch"
+    return None
 
-    raw_output = response.choices[0].message.content.strip()
 
+def audio_duration(path: str):
+    """Length in seconds from the WAV header, or ffprobe for other formats (None if unknown)"""
     try:
-        qa_data = json.loads(raw_output)
-    except json.JSONDecodeError:
-        start = raw_output.find("{")
-        end = raw_output.rfind("}") + 1
-        json_str = raw_output[start:end]
-        qa_data = json.loads(json_str)
-
-    print(qa_data)
-    print("Length of Q&A data:", len(qa_data.get("questions", [])))
-    return qa_data
+        with wave.open(path, "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        pass
+    if not FFPROBE:
+        return None
+    result = subprocess.run(
+        [FFPROBE, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        capture_output=True, text=True, timeout=30
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
 
 
+class AdmissionTicket:
+    def __init__(self, client, priority, sequence):
+        self.client = client
+        self.priority = priority
+        self.sequence = sequence
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = time.monotonic()
+        self.admitted_at = None
 
-# ==========================================
-# MAIN ENDPOINT WITH AUTOMATIC KEY ROTATION
-# ==========================================
 
-@app.post("/generate_qa")
-async def generate_qa_endpoint(audio: UploadFile = File(...)):
-    """
-    Generate Q&A only from audio
-    """
-    try:
-        contents = await audio.read()
+class AdmissionController:
+    def __init__(self, max_active, queue_size, max_wait, client_max_active,
+                 client_max_queued, client_rpm, batch_max_active):
+        """
+        Bounded, prioritized admission for the audio endpoints
         
-        # Transcribe
-        transcript = await key_manager.execute_with_retry(
-            speech_to_text_groq,
-            contents
+        At most max_active requests run at once. The rest wait in a queue of
+        queue_size, served by priority class and then least-recently-served
+        client, so one client's stack of uploads can't starve everyone else.
+        Each client also has a concurrency cap, a queue cap and an RPM budget.
+        """
+        self.max_active = max_active
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.client_max_active = client_max_active
+        self.client_max_queued = client_max_queued
+        self.client_rpm = client_rpm
+        self.batch_max_active = batch_max_active
+        self.active = 0
+        self.active_by_client = {}
+        self.active_by_priority = {priority: 0 for priority in PRIORITY_CLASSES}
+        self.waiting = []
+        self.last_served = {}
+        self.buckets = {}
+        self.sequence = itertools.count()
+        self.pruned_at = time.monotonic()
+        self.service_seconds = 5.0   # Moving average of how long a slot is held
+        self.admitted = 0
+        self.rejected = 0
+    
+    def reject(self, status_code, reason, detail, retry_after):
+        self.rejected += 1
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        return HTTPException(
+            status_code=status_code, detail=detail,
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
         )
+    
+    def _take_rate_token(self, client):
+        """Seconds until the client may send another request (0 if allowed now)"""
+        if not self.client_rpm:
+            return 0.0
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(client, (float(self.client_rpm), now))
+        tokens = min(self.client_rpm, tokens + (now - updated) * self.client_rpm / 60)
+        if tokens < 1:
+            self.buckets[client] = (tokens, now)
+            return (1 - tokens) * 60 / self.client_rpm
+        self.buckets[client] = (tokens - 1, now)
+        return 0.0
+    
+    def _prune(self, now):
+        """Forget rate buckets and fairness history of clients that went quiet"""
+        if now - self.pruned_at < ADMISSION_PRUNE_SECONDS:
+            return
+        self.pruned_at = now
+        # An idle bucket refills completely within a minute, so dropping it changes nothing
+        self.buckets = {
+            client: bucket for client, bucket in self.buckets.items()
+            if now - bucket[1] < 60
+        }
+        busy = set(self.active_by_client) | {ticket.client for ticket in self.waiting}
+        self.last_served = {
+            client: served for client, served in self.last_served.items()
+            if client in busy or now - served < 5 * ADMISSION_PRUNE_SECONDS
+        }
+    
+    def _eligible(self, ticket):
+        if self.active_by_client.get(ticket.client, 0) >= self.client_max_active:
+            return False
+        return ticket.priority != "batch" or self.active_by_priority["batch"] < self.batch_max_active
+    
+    def _dispatch(self):
+        while self.active < self.max_active:
+            eligible = [ticket for ticket in self.waiting if self._eligible(ticket)]
+            if not eligible:
+                break
+            ticket = min(eligible, key=lambda t: (
+                PRIORITY_CLASSES.index(t.priority), self.last_served.get(t.client, 0.0), t.sequence
+            ))
+            self.waiting.remove(ticket)
+            self.active += 1
+            self.active_by_client[ticket.client] = self.active_by_client.get(ticket.client, 0) + 1
+            self.active_by_priority[ticket.priority] += 1
+            self.last_served[ticket.client] = ticket.admitted_at = time.monotonic()
+            self.admitted += 1
+            ADMISSION_WAIT_SECONDS.labels(ticket.priority).observe(ticket.admitted_at - ticket.queued_at)
+            ticket.future.set_result(None)
+        ADMISSION_QUEUE.set(len(self.waiting))
+    
+    def estimated_wait(self, position):
+        return self.service_seconds * (position + 1) / self.max_active
+    
+    async def acquire(self, client, priority):
+        """Wait for a slot; raises HTTPException 429 (client over quota) or 503 (saturated)"""
+        self._prune(time.monotonic())
+        retry_after = self._take_rate_token(client)
+        if retry_after:
+            raise self.reject(429, "client_rate", "Too many requests from this client", retry_after)
+        if sum(ticket.client == client for ticket in self.waiting) >= self.client_max_queued:
+            raise self.reject(
+                429, "client_queue", "Too many queued requests from this client",
+                self.estimated_wait(len(self.waiting))
+            )
         
-        # Generate Q&A
-        qa_data = await key_manager.execute_with_retry(
-            generate_questions_and_answers,
-            transcript
-        )
+        ticket = AdmissionTicket(client, priority, next(self.sequence))
+        self.waiting.append(ticket)
+        self._dispatch()
+        if ticket.future.done():
+            return ticket
+        if len(self.waiting) > self.queue_size:
+            self.waiting.remove(ticket)
+            ADMISSION_QUEUE.set(len(self.waiting))
+            raise self.reject(503, "queue_full", "Server is busy", self.estimated_wait(len(self.waiting)))
         
-        return JSONResponse(content=qa_data)
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.max_wait)
+        except asyncio.TimeoutError:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                ADMISSION_QUEUE.set(len(self.waiting))
+                raise self.reject(503, "queue_timeout", "Server is busy", self.estimated_wait(len(self.waiting)))
+        except asyncio.CancelledError:
+            # Client went away while queued (or just as it was admitted)
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                ADMISSION_QUEUE.set(len(self.waiting))
+            elif ticket.future.done():
+                self.release(ticket)
+            raise
+        return ticket
     
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    def release(self, ticket):
+        held = time.monotonic() - ticket.admitted_at
+        self.service_seconds = 0.9 * self.service_seconds + 0.1 * held
+        self.active -= 1
+        self.active_by_priority[ticket.priority] -= 1
+        self.active_by_client[ticket.client] -= 1
+        if not self.active_by_client[ticket.client]:
+            del self.active_by_client[ticket.client]
+        self._dispatch()
+    
+    def stats(self):
+        return {
+            "max_active": self.max_active,
+            "active": self.active,
+            "active_by_priority": dict(self.active_by_priority),
+            "queued": len(self.waiting),
+            "queue_size": self.queue_size,
+            "clients_active": len(self.active_by_client),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "mean_service_seconds": round(self.service_seconds, 2)
+        }
 
 
+ADMISSION_PRUNE_SECONDS = 60
+# Reverse proxies (IPs or CIDRs) whose X-Forwarded-For is believed; everyone
+# else is identified by the address they connected from
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(entry.strip(), strict=False)
+    for entry in os.environ.get("TRUSTED_PROXIES", "").split(",") if entry.strip()
+]
 
-@app.post("/generate_notes")
-async def generate_notes(audio: UploadFile = File(...)):
+
+def is_trusted_proxy(address):
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+
+def client_address(scope, headers):
     """
-    Process audio file with automatic API key rotation on rate limits
+    Identity used for per-client quotas: the peer address, or the nearest
+    untrusted hop of X-Forwarded-For when the peer is a trusted proxy
     """
-    try:
-        contents = await audio.read()
-        logger.info(f"Processing audio file: {audio.filename} ({len(contents)} bytes)")
+    peer = (scope.get("client") or ("unknown",))[0]
+    if not is_trusted_proxy(peer):
+        return peer
+    hops = [hop.strip() for hop in headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    for hop in reversed(hops):
+        if not is_trusted_proxy(hop):
+            return hop[:64]
+    return hops[0][:64] if hops else peer
+
+
+ADMISSION_MAX_ACTIVE = int(os.environ.get(
+    "ADMISSION_MAX_ACTIVE", str(max(4, 2 * len(key_manager.api_keys)))
+))
+admission = AdmissionController(
+    max_active=ADMISSION_MAX_ACTIVE,
+    queue_size=int(os.environ.get("ADMISSION_QUEUE_SIZE", "32")),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT_SECONDS", "60")),
+    client_max_active=int(os.environ.get("CLIENT_MAX_ACTIVE", "2")),
+    client_max_queued=int(os.environ.get("CLIENT_MAX_QUEUED", "4")),
+    client_rpm=int(os.environ.get("CLIENT_RPM", "30")),
+    batch_max_active=int(os.environ.get("BATCH_MAX_ACTIVE", str(max(1, ADMISSION_MAX_ACTIVE // 2))))
+)
 
-        # Step 1: Audio → Transcript (with automatic key rotation)
-        transcript = await key_manager.execute_with_retry(
-            speech_to_text_groq,
-            contents
-        )
-        
-        logger.info(f"Transcription successful. Length: {len(transcript)} characters")
 
+class AdmissionMiddleware:
+    """
+    ASGI middleware in front of the audio endpoints: rejects oversized bodies
+    before they are read, then holds an admission slot until the response
+    (including a streamed one) is finished
+    """
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        priority = admission_class(scope.get("method"), scope.get("path")) if scope["type"] == "http" else None
+        if priority is None:
+            await self.app(scope, receive, send)
+            return
         
-        # Step 2: Transcript → Structured Notes (with automatic key rotation)
-        structured_notes = await key_manager.execute_with_retry(
-            summarize_and_structure,
-            transcript
-        )
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        limit = MAX_BATCH_UPLOAD_BYTES if priority == "batch" else MAX_UPLOAD_BYTES
+        requested = headers.get("x-priority", "").lower()
+        if requested in PRIORITY_CLASSES and PRIORITY_CLASSES.index(requested) > PRIORITY_CLASSES.index(priority):
+            priority = requested
+        groq_priority.set(priority)
+        client = client_address(scope, headers)
         
-        logger.info("Note generation successful")
+        try:
+            if int(headers.get("content-length") or 0) > limit:
+                ADMISSION_REJECTIONS.labels("too_large").inc()
+                raise HTTPException(status_code=413, detail=f"Upload exceeds {limit // (1024 * 1024)} MB")
+            ticket = await admission.acquire(client, priority)
+        except HTTPException as e:
+            response = JSONResponse(status_code=e.status_code, content={"detail": e.detail}, headers=e.headers)
+            await response(scope, receive, send)
+            return
+        
+        received = 0
+        rejected = False
+        
+        async def limited_receive():
+            # Chunked uploads have no Content-Length: once over the limit, answer 413
+            # ourselves and tell the app the client disconnected so it stops reading
+            nonlocal received, rejected
+            if rejected:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    rejected = True
+                    ADMISSION_REJECTIONS.labels("too_large").inc()
+                    response = JSONResponse(
+                        status_code=413, content={"detail": f"Upload exceeds {limit // (1024 * 1024)} MB"}
+                    )
+                    await response(scope, receive, send)
+                    return {"type": "http.disconnect"}
+            return message
+        
+        async def guarded_send(message):
+            if not rejected:
+                await send(message)
+        
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        finally:
+            admission.release(ticket)
 
-        # Add metadata about which key was used
-        structured_notes["_metadata"] = {
-            "processed_with_key": key_manager.current_key_index + 1,
-            "total_keys_available": len(key_manager.api_keys)
-        }
 
-        return JSONResponse(content=structured_notes)
-    
+app.add_middleware(AdmissionMiddleware)
+
+
+# ==========================================
+# UPLOAD SPOOLING
+# ==========================================
+UPLOAD_READ_SIZE = 1024 * 1024
+
+
+class AudioUpload:
+    def __init__(self, path, sha256, size, filename):
+        """
+        An uploaded recording spooled to a temp file, with its content hash
+        """
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.filename = filename
+    
+    def cleanup(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def spool_upload(audio: UploadFile) -> AudioUpload:
+    """
+    Copy an upload to disk in fixed-size blocks, hashing as it goes, so
+    memory per request stays bounded regardless of file size
+    """
+    suffix = os.path.splitext(audio.filename or "")[1].lower() or ".wav"
+    with timed_stage("upload_spool"):
+        tmp = await asyncio.to_thread(tempfile.NamedTemporaryFile, delete=False, suffix=suffix)
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            while True:
+                block = await audio.read(UPLOAD_READ_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                size += len(block)
+                await asyncio.to_thread(tmp.write, block)
+        except BaseException:
+            tmp.close()
+            os.remove(tmp.name)
+            raise
+        await asyncio.to_thread(tmp.close)
+    
+    upload = AudioUpload(tmp.name, digest.hexdigest(), size, audio.filename)
+    await asyncio.to_thread(check_duration, upload)
+    return upload
+
+
+def check_duration(upload: AudioUpload):
+    """Remove the upload and raise 413 if it is longer than MAX_AUDIO_SECONDS"""
+    duration = audio_duration(upload.path)
+    if duration and duration > MAX_AUDIO_SECONDS:
+        upload.cleanup()
+        ADMISSION_REJECTIONS.labels("too_long").inc()
+        raise HTTPException(
+            status_code=413,
+            detail=f"Audio is {duration:.0f} seconds long; the limit is {MAX_AUDIO_SECONDS:.0f} seconds"
+        )
+
+
+# ==========================================
+# AUDIO PREPROCESSING
+# ==========================================
+TARGET_SAMPLE_RATE = 16000
+SILENCE_THRESHOLD_DB = float(os.environ.get("SILENCE_THRESHOLD_DB", "-45"))
+SILENCE_PADDING_SECONDS = 0.25
+# Codec used for the Whisper upload: flac, opus or wav (flac/opus need ffmpeg)
+AUDIO_UPLOAD_CODEC = os.environ.get("AUDIO_UPLOAD_CODEC", "flac").lower()
+FFMPEG = shutil.which("ffmpeg")
+
+AUDIO_SIGNATURES = [
+    (0, b"RIFF", "wav"),
+    (0, b"fLaC", "flac"),
+    (0, b"OggS", "ogg"),
+    (0, b"ID3", "mp3"),
+    (0, b"\x1a\x45\xdf\xa3", "webm"),
+    (4, b"ftyp", "m4a"),
+]
+PCM_DTYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+audio_stats = {"bytes_received": 0, "bytes_uploaded": 0, "files_preprocessed": 0}
+
+
+def detect_audio_format(audio_path: str) -> str:
+    """Identify the container from its magic bytes"""
+    with open(audio_path, "rb") as f:
+        header = f.read(12)
+    for offset, signature, name in AUDIO_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return name
+    if header[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    return "unknown"
+
+
+def run_ffmpeg(*args) -> bool:
+    result = subprocess.run(
+        [FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-y", *args],
+        capture_output=True
+    )
+    if result.returncode != 0:
+        logger.warning(f"ffmpeg failed: {result.stderr.decode(errors='replace').strip()}")
+    return result.returncode == 0
+
+
+def ffmpeg_speech_bounds(src: str):
+    """
+    First pass: (start, end) seconds of the sound between leading and trailing
+    silence, found with silencedetect while decoding as a stream, so memory
+    stays flat however long the recording is. end is None when there's no
+    trailing silence; returns None if nothing should be trimmed.
+    """
+    result = subprocess.run(
+        [FFMPEG, "-nostdin", "-hide_banner", "-nostats", "-loglevel", "info", "-i", src, "-vn",
+         "-af", f"silencedetect=noise={SILENCE_THRESHOLD_DB}dB:d={SILENCE_PADDING_SECONDS}",
+         "-f", "null", "-"],
+        capture_output=True, text=True, errors="replace"
+    )
+    if result.returncode != 0:
+        return None
+    events = [(kind, float(value)) for kind, value in
+              re.findall(r"silence_(start|end): (-?\d+(?:\.\d+)?)", result.stderr)]
+    if not events:
+        return None
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", result.stderr)
+    duration = int(duration[1]) * 3600 + int(duration[2]) * 60 + float(duration[3]) if duration else None
+    
+    start, end = 0.0, None
+    if events[0][0] == "start" and events[0][1] <= 0.05:
+        if len(events) == 1:
+            return None   # Silent throughout; leave it for VAD to report
+        start = events[1][1]
+    if events[-1][0] == "start":
+        end = events[-1][1]
+    elif duration and events[-1][1] >= duration - 0.05 and len(events) >= 2 and events[-2][1] > start:
+        # Newer ffmpeg closes a silence still open at end of stream
+        end = events[-2][1]
+    if not start and end is None:
+        return None
+    return max(0.0, start - SILENCE_PADDING_SECONDS), end + SILENCE_PADDING_SECONDS if end else None
+
+
+def preprocess_with_ffmpeg(src: str, dst: str) -> bool:
+    """
+    Decode any format to 16 kHz mono PCM WAV with edge silence trimmed
+    
+    The silence bounds come from a separate streaming pass and are applied
+    with -ss/-t, rather than reversing the audio, which would hold the whole
+    decoded clip in memory.
+    """
+    bounds = ffmpeg_speech_bounds(src)
+    cut = []
+    if bounds:
+        start, end = bounds
+        cut = ["-ss", f"{start:.3f}"] + (["-t", f"{end - start:.3f}"] if end else [])
+    return run_ffmpeg(
+        *cut, "-i", src, "-vn", "-ac", "1", "-ar", str(TARGET_SAMPLE_RATE), "-c:a", "pcm_s16le", dst
+    )
+
+
+def read_mono_block(wav, frames: int, channels: int, dtype) -> np.ndarray:
+    """Read frames as float32 in [-1, 1], averaging channels down to mono"""
+    samples = np.frombuffer(wav.readframes(frames), dtype=dtype).astype(np.float32)
+    if dtype == np.uint8:
+        samples = (samples - 128) / 128
+    else:
+        samples /= np.iinfo(dtype).max
+    return samples.reshape(-1, channels).mean(axis=1)
+
+
+def lowpass_kernel(rate: int, taps: int = 63) -> np.ndarray:
+    """Windowed-sinc anti-aliasing filter for resampling down to 16 kHz"""
+    cutoff = 0.9 * (TARGET_SAMPLE_RATE / 2) / rate
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = np.sinc(2 * cutoff * n) * np.hamming(taps)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def preprocess_with_numpy(src: str, dst: str) -> bool:
+    """
+    Downmix, trim edge silence and resample a PCM WAV to 16 kHz mono,
+    processing 30 s blocks so memory stays flat for long lectures
+    """
+    with wave.open(src, "rb") as wav:
+        rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+        total_frames = wav.getnframes()
+        dtype = PCM_DTYPES.get(width)
+        if dtype is None or total_frames == 0:
+            return False
+        block_frames = rate * 30
+        
+        # Pass 1: first and last 20 ms windows above the silence threshold
+        window = max(1, rate // 50)
+        threshold = 10 ** (SILENCE_THRESHOLD_DB / 20)
+        first, last = None, None
+        for block_start in range(0, total_frames, block_frames):
+            samples = read_mono_block(wav, block_frames, channels, dtype)
+            usable = len(samples) // window * window
+            if not usable:
+                continue
+            rms = np.sqrt((samples[:usable].reshape(-1, window) ** 2).mean(axis=1))
+            loud = np.flatnonzero(rms > threshold)
+            if len(loud):
+                if first is None:
+                    first = block_start + loud[0] * window
+                last = block_start + (loud[-1] + 1) * window
+        if first is None:
+            return False
+        
+        padding = int(SILENCE_PADDING_SECONDS * rate)
+        start, end = max(0, first - padding), min(total_frames, last + padding)
+        if rate == TARGET_SAMPLE_RATE and channels == 1 and width == 2 \
+                and start == 0 and end == total_frames:
+            return False
+        
+        # Pass 2: filter and linearly interpolate onto the 16 kHz grid
+        kernel = lowpass_kernel(rate) if rate > TARGET_SAMPLE_RATE else None
+        history = np.zeros(len(kernel) - 1 if kernel is not None else 0, dtype=np.float32)
+        step = rate / TARGET_SAMPLE_RATE
+        next_output = 0.0          # Input position of the next output sample
+        carry = np.zeros(0, dtype=np.float32)
+        wav.setpos(start)
+        with wave.open(dst, "wb") as out:
+            out.setnchannels(1)
+            out.setsampwidth(2)
+            out.setframerate(TARGET_SAMPLE_RATE)
+            consumed = 0           # Input samples before the start of carry
+            for block_start in range(start, end, block_frames):
+                samples = read_mono_block(wav, min(block_frames, end - block_start), channels, dtype)
+                if kernel is not None:
+                    padded = np.concatenate([history, samples])
+                    history = padded[-len(history):] if len(history) else history
+                    samples = np.convolve(padded, kernel, mode="valid").astype(np.float32)
+                samples = np.concatenate([carry, samples])
+                # Interpolate every output position that has both neighbours available
+                positions = np.arange(next_output, consumed + len(samples) - 1, step)
+                resampled = np.interp(positions - consumed, np.arange(len(samples)), samples)
+                out.writeframes((np.clip(resampled, -1, 1) * 32767).astype("<i2").tobytes())
+                next_output = positions[-1] + step if len(positions) else next_output
+                consumed += len(samples) - 1
+                carry = samples[-1:]
+    return True
+
+
+def preprocess_audio(audio_path: str) -> str:
+    """
+    Normalize an upload to 16 kHz mono WAV with leading and trailing
+    silence removed, returning a new path (or audio_path if unchanged)
+    
+    Uses ffmpeg when it is on PATH; otherwise PCM WAV input is handled
+    with NumPy and other formats are passed through untouched.
+    """
+    audio_format = detect_audio_format(audio_path)
+    before = os.path.getsize(audio_path)
+    audio_stats["bytes_received"] += before
+    
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+        dst = tmp.name
+    try:
+        if FFMPEG:
+            converted = preprocess_with_ffmpeg(audio_path, dst)
+        elif audio_format == "wav":
+            converted = preprocess_with_numpy(audio_path, dst)
+        else:
+            converted = False
+    except (wave.Error, EOFError, ValueError) as e:
+        logger.warning(f"Audio preprocessing skipped: {str(e)}")
+        converted = False
+    
+    if not converted:
+        os.remove(dst)
+        return audio_path
+    
+    audio_stats["files_preprocessed"] += 1
+    logger.info(f"Preprocessed {audio_format} audio: {before} -> {os.path.getsize(dst)} bytes")
+    return dst
+
+
+def encode_for_upload(audio_path: str) -> str:
+    """
+    Re-encode a WAV chunk to AUDIO_UPLOAD_CODEC for a smaller Whisper
+    upload, returning a new path (or audio_path if unchanged)
+    """
+    codecs = {
+        "flac": (".flac", ["-c:a", "flac"]),
+        "opus": (".ogg", ["-c:a", "libopus", "-b:a", "24k", "-application", "voip"]),
+    }
+    if AUDIO_UPLOAD_CODEC not in codecs or not FFMPEG or detect_audio_format(audio_path) != "wav":
+        return audio_path
+    
+    suffix, codec_args = codecs[AUDIO_UPLOAD_CODEC]
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
+        dst = tmp.name
+    if not run_ffmpeg("-i", audio_path, *codec_args, dst):
+        os.remove(dst)
+        return audio_path
+    return dst
+
+
+# ==========================================
+# VOICE ACTIVITY DETECTION
+# ==========================================
+VAD_ENABLED = os.environ.get("VAD_ENABLED", "1") == "1"
+VAD_FRAME_SECONDS = 0.03
+VAD_MARGIN_DB = float(os.environ.get("VAD_MARGIN_DB", "12"))
+# Only pauses longer than this are removed; shorter ones stay in the audio
+VAD_MIN_SILENCE_SECONDS = float(os.environ.get("VAD_MIN_SILENCE_SECONDS", "1.0"))
+VAD_PADDING_SECONDS = 0.3
+
+vad_stats = {"lectures": 0, "seconds_in": 0.0, "seconds_kept": 0.0, "latency_saved_seconds": 0.0}
+
+
+def frame_levels_db(wav, frame: int, block_frames: int) -> np.ndarray:
+    """Per-frame RMS level in dBFS for a 16-bit mono WAV"""
+    levels = []
+    for _ in range(0, wav.getnframes(), block_frames):
+        samples = np.frombuffer(wav.readframes(block_frames), dtype="<i2").astype(np.float32) / 32768
+        usable = len(samples) // frame * frame
+        if usable:
+            rms = np.sqrt((samples[:usable].reshape(-1, frame) ** 2).mean(axis=1))
+            levels.append(20 * np.log10(rms + 1e-9))
+    return np.concatenate(levels) if levels else np.zeros(0)
+
+
+def find_speech_regions(levels: np.ndarray, frame_seconds: float) -> list:
+    """
+    Speech regions (start, end) in seconds from frame levels: frames above
+    an adaptive noise-floor threshold, merged across short pauses and padded
+    """
+    if not len(levels):
+        return []
+    noise_floor = np.percentile(levels, 10)
+    threshold = max(noise_floor + VAD_MARGIN_DB, SILENCE_THRESHOLD_DB)
+    active = np.flatnonzero(levels > threshold)
+    if not len(active):
+        return []
+    
+    # Split wherever the gap between active frames exceeds the minimum silence
+    gap_frames = int(VAD_MIN_SILENCE_SECONDS / frame_seconds)
+    breaks = np.flatnonzero(np.diff(active) > gap_frames)
+    starts = np.concatenate([[active[0]], active[breaks + 1]])
+    ends = np.concatenate([active[breaks], [active[-1]]]) + 1
+    
+    total = len(levels) * frame_seconds
+    regions = []
+    for start, end in zip(starts * frame_seconds, ends * frame_seconds):
+        start = max(0.0, float(start) - VAD_PADDING_SECONDS)
+        end = min(total, float(end) + VAD_PADDING_SECONDS)
+        if regions and start <= regions[-1][1]:
+            regions[-1] = (regions[-1][0], end)
+        else:
+            regions.append((start, end))
+    return regions
+
+
+def apply_vad(audio_path: str):
+    """
+    Keep only the speech regions of a 16 kHz mono WAV
+    
+    Returns (path, report). The path is audio_path itself when VAD is
+    disabled, the input isn't 16-bit PCM mono WAV, or there is nothing
+    worth dropping.
+    """
+    report = {"seconds_in": None, "seconds_kept": None, "fraction_dropped": 0.0}
+    if not VAD_ENABLED or detect_audio_format(audio_path) != "wav":
+        return audio_path, report
+    
+    try:
+        wav = wave.open(audio_path, "rb")
+    except (wave.Error, EOFError):
+        # Float or compressed WAV (only reaches here without ffmpeg); send it as is
+        return audio_path, report
+    
+    with wav:
+        rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+        total_seconds = wav.getnframes() / rate if rate else 0.0
+        if channels != 1 or width != 2 or not total_seconds:
+            return audio_path, report
+        
+        frame = int(rate * VAD_FRAME_SECONDS)
+        levels = frame_levels_db(wav, frame, frame * 1000)
+        regions = find_speech_regions(levels, frame / rate)
+        kept_seconds = sum(end - start for start, end in regions)
+        report = {
+            "seconds_in": round(total_seconds, 2),
+            "seconds_kept": round(kept_seconds, 2),
+            "fraction_dropped": round(1 - kept_seconds / total_seconds, 3)
+        }
+        if not regions or report["fraction_dropped"] < 0.02:
+            # Sent as is, so nothing was dropped
+            report.update(seconds_kept=report["seconds_in"], fraction_dropped=0.0)
+            return audio_path, report
+        
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+            with wave.open(tmp, "wb") as out:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(rate)
+                block_frames = rate * 30
+                for start, end in regions:
+                    start_frame, end_frame = int(start * rate), int(end * rate)
+                    wav.setpos(start_frame)
+                    for block_start in range(start_frame, end_frame, block_frames):
+                        out.writeframes(wav.readframes(min(block_frames, end_frame - block_start)))
+    
+    logger.info(
+        f"VAD kept {kept_seconds:.0f}s of {total_seconds:.0f}s "
+        f"({report['fraction_dropped']:.0%} dropped) in {len(regions)} regions"
+    )
+    return tmp.name, report
+
+
+# ==========================================
+# SPEECH TO TEXT WITH KEY ROTATION
+# ==========================================
+WHISPER_MODEL = "whisper-large-v3-turbo"
+
+
+async def speech_to_text_groq(client: AsyncGroq, audio_path: str) -> str:
+    """
+    Uses Groq's Whisper implementation with provided async client
+    
+    The file is streamed from disk rather than loaded into memory.
+    """
+    with open(audio_path, "rb") as f, timed_stage("whisper_request"):
+        transcription = await client.audio.transcriptions.create(
+            file=(os.path.basename(audio_path), f),
+            model=WHISPER_MODEL,
+            response_format="text",
+            language="en",
+            temperature=0.0
+        )
+    return transcription
+
+
+# ==========================================
+# TRANSCRIPTION BACKENDS
+# ==========================================
+# Loaded once per local-whisper worker process by the pool initializer
+_local_whisper_model = None
+
+
+def load_local_whisper(model_size: str, compute_type: str, cpu_threads: int):
+    global _local_whisper_model
+    _local_whisper_model = WhisperModel(
+        model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads
+    )
+
+
+def run_local_whisper(audio_path: str) -> str:
+    segments, _ = _local_whisper_model.transcribe(
+        audio_path, language="en", temperature=0.0, beam_size=1
+    )
+    return " ".join(segment.text.strip() for segment in segments)
+
+
+class TranscriptionBackend(ABC):
+    """Interface: turn an audio file on disk into transcript text"""
+    name = "base"
+    
+    def available(self) -> bool:
+        return True
+    
+    @abstractmethod
+    async def transcribe(self, audio_path: str) -> str:
+        ...
+
+
+class GroqTranscriptionBackend(TranscriptionBackend):
+    """Groq-hosted Whisper, scheduled across the API key pool"""
+    name = "groq"
+    
+    async def transcribe(self, audio_path: str) -> str:
+        upload_path = await asyncio.to_thread(encode_for_upload, audio_path)
+        audio_stats["bytes_uploaded"] += os.path.getsize(upload_path)
+        try:
+            return await key_manager.execute_with_retry(speech_to_text_groq, upload_path, models=[WHISPER_MODEL])
+        finally:
+            if upload_path != audio_path:
+                os.remove(upload_path)
+
+
+class LocalWhisperBackend(TranscriptionBackend):
+    """
+    CPU Whisper via faster-whisper (CTranslate2) in a process pool, with the
+    model loaded once per worker
+    """
+    name = "local"
+    
+    def __init__(self, model_size, workers, cpu_threads, compute_type="int8"):
+        self.model_size = model_size
+        self.workers = workers
+        self.cpu_threads = cpu_threads
+        self.compute_type = compute_type
+        self.executor = None
+    
+    def available(self) -> bool:
+        return WhisperModel is not None
+    
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=load_local_whisper,
+                initargs=(self.model_size, self.compute_type, self.cpu_threads)
+            )
+        return self.executor
+    
+    async def warm_up(self):
+        """Start every worker and load its model before the first request"""
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+            with wave.open(tmp, "wb") as out:
+                out.setnchannels(1)
+                out.setsampwidth(2)
+                out.setframerate(16000)
+                out.writeframes(b"\x00\x00" * 16000)
+        try:
+            started = time.perf_counter()
+            await asyncio.gather(*[self.transcribe(tmp.name) for _ in range(self.workers)])
+            logger.info(
+                f"Local whisper ({self.model_size}, {self.compute_type}) warmed "
+                f"{self.workers} workers in {time.perf_counter() - started:.1f}s"
+            )
+        finally:
+            os.remove(tmp.name)
+    
+    async def transcribe(self, audio_path: str) -> str:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.start(), run_local_whisper, audio_path)
+    
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+transcription_backends = {
+    "groq": GroqTranscriptionBackend(),
+    "local": LocalWhisperBackend(
+        model_size=os.environ.get("LOCAL_WHISPER_MODEL", "base.en"),
+        workers=int(os.environ.get("LOCAL_WHISPER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2)))),
+        cpu_threads=int(os.environ.get("LOCAL_WHISPER_THREADS", "2")),
+        compute_type=os.environ.get("LOCAL_WHISPER_COMPUTE_TYPE", "int8")
+    )
+}
+DEFAULT_TRANSCRIPTION_BACKEND = os.environ.get("TRANSCRIPTION_BACKEND", "groq").lower()
+if DEFAULT_TRANSCRIPTION_BACKEND not in transcription_backends:
+    raise ValueError(
+        f"Unknown TRANSCRIPTION_BACKEND '{DEFAULT_TRANSCRIPTION_BACKEND}'. Use one of: groq, local"
+    )
+if not transcription_backends[DEFAULT_TRANSCRIPTION_BACKEND].available():
+    raise ValueError("TRANSCRIPTION_BACKEND=local requires faster-whisper to be installed")
+# Fall back to local whisper when every Groq key is rate limited
+LOCAL_WHISPER_FALLBACK = os.environ.get("LOCAL_WHISPER_FALLBACK", "1") == "1"
+# Load the model in every pool worker at startup. Off unless local whisper is
+# the default backend: each uvicorn worker would start its own pool, and the
+# fallback pool starts on first use anyway
+LOCAL_WHISPER_WARMUP = os.environ.get(
+    "LOCAL_WHISPER_WARMUP", "1" if DEFAULT_TRANSCRIPTION_BACKEND == "local" else "0"
+) == "1"
+
+# Set per request from the X-Transcription-Backend header
+transcription_backend = contextvars.ContextVar(
+    "transcription_backend", default=DEFAULT_TRANSCRIPTION_BACKEND
+)
+
+
+async def transcribe_file(audio_path: str) -> tuple:
+    """
+    Transcribe one file on the selected backend, falling back to local
+    whisper when Groq is rate limited; returns (text, backend used)
+    """
+    name = transcription_backend.get()
+    backend = transcription_backends[name]
+    try:
+        return await backend.transcribe(audio_path), name
+    except HTTPException as e:
+        local = transcription_backends["local"]
+        if e.status_code != 429 or backend is local or not (LOCAL_WHISPER_FALLBACK and local.available()):
+            raise
+        logger.warning("All Groq keys rate limited, transcribing locally")
+        return await local.transcribe(audio_path), "local"
+
+
+@app.middleware("http")
+async def read_transcription_backend_header(request: Request, call_next):
+    """Select the transcription backend with X-Transcription-Backend: groq|local"""
+    # The default was checked at startup; only audio routes look at the header
+    if "x-transcription-backend" not in request.headers or admission_class(request.method, request.url.path) is None:
+        return await call_next(request)
+    name = request.headers["x-transcription-backend"].lower()
+    if name not in transcription_backends:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": f"Unknown transcription backend '{name}'. Use one of: groq, local"}
+        )
+    if not transcription_backends[name].available():
+        return JSONResponse(
+            status_code=400,
+            content={"detail": "Local transcription requires faster-whisper to be installed"}
+        )
+    transcription_backend.set(name)
+    return await call_next(request)
+
+
+@app.on_event("startup")
+async def start_local_whisper():
+    local = transcription_backends["local"]
+    if local.available() and LOCAL_WHISPER_WARMUP:
+        await local.warm_up()
+
+
+@app.on_event("shutdown")
+async def stop_local_whisper():
+    transcription_backends["local"].shutdown()
+
+
+# ==========================================
+# LONG AUDIO CHUNKING
+# ==========================================
+CHUNK_SECONDS = float(os.environ.get("TRANSCRIBE_CHUNK_SECONDS", "600"))
+CHUNK_OVERLAP_SECONDS = float(os.environ.get("TRANSCRIBE_CHUNK_OVERLAP_SECONDS", "2"))
+SILENCE_SEARCH_SECONDS = float(os.environ.get("TRANSCRIBE_SILENCE_SEARCH_SECONDS", "15"))
+
+
+def find_quietest_frame(samples, channels: int, rate: int) -> int:
+    """
+    Return the offset (in frames) of the quietest 20 ms window in samples
+    """
+    window = max(1, rate // 50)
+    total = len(samples) // channels
+    best_frame, best_energy = total, None
+    for frame in range(0, max(1, total - window), window):
+        chunk = samples[frame * channels:(frame + window) * channels]
+        energy = sum(s * s for s in chunk)
+        if best_energy is None or energy < best_energy:
+            best_frame, best_energy = frame + window // 2, energy
+    return best_frame
+
+
+def split_audio(audio_path: str) -> list:
+    """
+    Split a WAV recording into overlapping chunk files cut at quiet points
+    
+    Non-WAV input and recordings shorter than CHUNK_SECONDS are returned
+    as the original path. Frames are read in blocks, so the whole
+    recording is never held in memory.
+    """
+    with open(audio_path, "rb") as f:
+        header = f.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return [audio_path]
+    
+    try:
+        wav = wave.open(audio_path, "rb")
+    except (wave.Error, EOFError):
+        return [audio_path]
+    
+    with wav:
+        rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+        total_frames = wav.getnframes()
+        chunk_frames = int(CHUNK_SECONDS * rate)
+        if total_frames <= chunk_frames:
+            return [audio_path]
+        
+        overlap_frames = int(CHUNK_OVERLAP_SECONDS * rate)
+        search_frames = int(SILENCE_SEARCH_SECONDS * rate)
+        block_frames = rate * 30
+        
+        chunks = []
+        start = 0
+        while start < total_frames:
+            end = start + chunk_frames
+            if end >= total_frames:
+                end = total_frames
+            elif width == 2:
+                # Prefer cutting at a pause rather than mid-word
+                search_start = max(start + overlap_frames + 1, end - search_frames)
+                wav.setpos(search_start)
+                samples = array("h")
+                samples.frombytes(wav.readframes(end - search_start))
+                end = search_start + find_quietest_frame(samples, channels, rate)
+            
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+                with wave.open(tmp, "wb") as out:
+                    out.setnchannels(channels)
+                    out.setsampwidth(width)
+                    out.setframerate(rate)
+                    wav.setpos(start)
+                    for block_start in range(start, end, block_frames):
+                        out.writeframes(wav.readframes(min(block_frames, end - block_start)))
+                chunks.append(tmp.name)
+            
+            if end >= total_frames:
+                break
+            start = end - overlap_frames
+    
+    logger.info(f"Split {total_frames / rate:.0f}s of audio into {len(chunks)} chunks")
+    return chunks
+
+
+def merge_transcripts(parts: list, max_overlap_words: int = 30) -> str:
+    """
+    Join chunk transcripts in order, dropping text repeated across overlaps
+    """
+    def normalize(word):
+        return re.sub(r"[^\w']", "", word.lower())
+    
+    merged = []
+    for part in parts:
+        words = part.split()
+        if merged and words:
+            tail = [normalize(w) for w in merged[-max_overlap_words:]]
+            head = [normalize(w) for w in words[:max_overlap_words]]
+            # Longest suffix of the previous text that reappears as our prefix
+            for size in range(min(len(tail), len(head)), 0, -1):
+                if tail[-size:] == head[:size]:
+                    words = words[size:]
+                    break
+        merged.extend(words)
+    return " ".join(merged)
+
+
+async def transcribe_audio(upload: AudioUpload) -> str:
+    """
+    Transcribe audio, reusing the cached transcript for identical uploads
+    
+    Long WAV recordings are split into chunks that are transcribed
+    concurrently and stitched back together in order.
+    """
+    # Transcripts differ between backends, so each has its own cache entries
+    backend = transcription_backend.get()
+    cache_key = upload.sha256 if backend == "groq" else f"{upload.sha256}:{backend}"
+    transcript = await asyncio.to_thread(transcript_cache.get, cache_key)
+    if transcript is not None:
+        logger.info(f"Transcript cache hit ({cache_key[:12]})")
+        return transcript
+    
+    with timed_stage("preprocess"):
+        prepared = await asyncio.to_thread(preprocess_audio, upload.path)
+    with timed_stage("vad"):
+        speech, vad_report = await asyncio.to_thread(apply_vad, prepared)
+    with timed_stage("chunking"):
+        chunks = await asyncio.to_thread(split_audio, speech)
+    try:
+        started = time.perf_counter()
+        with timed_stage("transcription"):
+            results = await asyncio.gather(*[
+                transcribe_file(chunk)
+                for chunk in chunks
+            ])
+        elapsed = time.perf_counter() - started
+    finally:
+        for path in {prepared, speech, *chunks}:
+            if path != upload.path:
+                os.remove(path)
+    parts = [text for text, _ in results]
+    transcript = merge_transcripts(parts) if len(parts) > 1 else parts[0]
+    
+    if vad_report["seconds_in"]:
+        # Dropped audio would have cost the same transcription time per second as the rest
+        dropped = vad_report["seconds_in"] - vad_report["seconds_kept"]
+        latency_saved = dropped * elapsed / max(vad_report["seconds_kept"], 1.0)
+        vad_stats["lectures"] += 1
+        vad_stats["seconds_in"] += vad_report["seconds_in"]
+        vad_stats["seconds_kept"] += vad_report["seconds_kept"]
+        vad_stats["latency_saved_seconds"] += latency_saved
+        logger.info(
+            f"VAD dropped {vad_report['fraction_dropped']:.0%} of audio, "
+            f"saving ~{latency_saved:.1f}s of transcription"
+        )
+    
+    if any(used != backend for _, used in results):
+        # Fallback output isn't what later requests for this backend should get
+        logger.info(f"Not caching transcript {cache_key[:12]}: chunks fell back to local whisper")
+    else:
+        await asyncio.to_thread(transcript_cache.set, cache_key, transcript)
+    return transcript
+
+
+# ==========================================
+# PROMPT SIZE REDUCTION
+# ==========================================
+# Spoken disfluencies carry no lecture content but cost input tokens on every call
+# Case-sensitive so acronyms ("UM", "HM") survive; only a sentence-initial filler
+# may be capitalised. A filler that opens a sentence takes its own punctuation
+# with it, anywhere else the sentence's closing punctuation is kept
+FILLER = r"(?:[Uu]u*[hm]+|[Ee]e*rm+|[Hh]h*m+)\b"
+FILLER_PATTERN = re.compile(
+    r"(?:^|(?<=[.!?]))\s*{filler}[,.!?]?|,?\s*\b{filler},?".format(filler=FILLER)
+)
+DISCOURSE_FILLER_PATTERN = re.compile(
+    r"(,|^|[.!?])\s*(?:you know|i mean|like|sort of|kind of|basically|actually),(?=\s)", re.IGNORECASE
+)
+# "the the", "we can we can" -> one copy (up to six-word phrases). Only words of
+# two or more letters: repeated numbers and letters ("1, 1, 0", "A A T T") are
+# content. "had had" and "that that" are usually grammatical, so they are left alone
+REPEATED_PHRASE_PATTERN = re.compile(
+    r"\b(?!(?:had|that)\b)((?:(?:{word})\s+){{0,5}}(?:{word}))(?:[\s,]+\1\b)+".format(
+        word=r"[^\W\d_]+'[^\W\d_]+|[^\W\d_]{2,}"
+    ),
+    re.IGNORECASE
+)
+
+# Models that accept response_format={"type": "json_schema"}; the rest get a compact
+# schema outline in the prompt and use json_object mode
+JSON_SCHEMA_MODELS = set(filter(None, os.environ.get(
+    "JSON_SCHEMA_MODELS",
+    "openai/gpt-oss-20b,openai/gpt-oss-120b,moonshotai/kimi-k2-instruct,"
+    "meta-llama/llama-4-maverick-17b-128e-instruct,meta-llama/llama-4-scout-17b-16e-instruct"
+).split(",")))
+
+PROMPT_TOKENS_SAVED = Counter(
+    "classecho_prompt_tokens_saved_total", "Estimated input tokens removed by transcript normalization"
+)
+
+
+def normalize_transcript(text: str) -> str:
+    """
+    Drop filler words, collapse stutters and repeated phrases or sentences,
+    and squeeze whitespace
+    """
+    text = FILLER_PATTERN.sub("", text)
+    text = DISCOURSE_FILLER_PATTERN.sub(lambda m: "" if m.group(1) == "," else m.group(1), text)
+    text = REPEATED_PHRASE_PATTERN.sub(r"\1", text)
+    
+    sentences = []
+    for sentence in re.split(r"(?<=[.!?])\s+", text.strip()):
+        if sentences and sentence.lower() == sentences[-1].lower():
+            continue
+        sentences.append(sentence)
+    text = " ".join(sentences)
+    
+    text = re.sub(r"\s+([,.!?])", r"\1", text)
+    text = re.sub(r",\s*([.!?])", r"\1", text)
+    text = re.sub(r"(^|[.!?]\s+)([a-z])", lambda m: m.group(1) + m.group(2).upper(), text.strip())
+    return " ".join(text.split())
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English)"""
+    return len(text) // 4 + 1
+
+
+def prepare_transcript(text: str, task: str) -> str:
+    """Normalize a transcript before prompting and record the tokens saved"""
+    normalized = normalize_transcript(text)
+    saved = estimate_tokens(text) - estimate_tokens(normalized)
+    if saved > 0:
+        PROMPT_TOKENS_SAVED.inc(saved)
+        logger.info(f"Normalized transcript for {task}: ~{saved} tokens removed")
+    return normalized
+
+
+def schema_object(**properties) -> dict:
+    """JSON schema for an object whose listed properties are all required"""
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False
+    }
+
+
+def schema_array(items: dict) -> dict:
+    return {"type": "array", "items": items}
+
+
+STRING = {"type": "string"}
+INTEGER = {"type": "integer"}
+STRINGS = schema_array(STRING)
+
+
+def schema_outline(schema: dict) -> str:
+    """Render a schema as a terse JSON-like skeleton for models without schema mode"""
+    if "enum" in schema:
+        return '"' + "|".join(schema["enum"]) + '"'
+    if schema["type"] == "object":
+        fields = ",".join(f'"{name}":{schema_outline(value)}' for name, value in schema["properties"].items())
+        return "{" + fields + "}"
+    if schema["type"] == "array":
+        return "[" + schema_outline(schema["items"]) + "]"
+    return {"string": "str", "integer": "int"}[schema["type"]]
+
+
+def response_format_for(model: str, name: str, schema: dict) -> dict:
+    """Structured-output settings for a model"""
+    if model in JSON_SCHEMA_MODELS:
+        return {"type": "json_schema", "json_schema": {"name": name, "schema": schema}}
+    return {"type": "json_object"}
+
+
+def format_instructions(model: str, schema: dict) -> str:
+    """Output-format line of a prompt; schema-mode models get the schema out of band"""
+    if model in JSON_SCHEMA_MODELS:
+        return "Reply with JSON matching the provided schema."
+    return f"Reply with JSON only, shaped exactly as:\n{schema_outline(schema)}"
+
+
+# ==========================================
+# STRUCTURED OUTPUT PARSING AND REPAIR
+# ==========================================
+STRUCTURED_OUTPUTS = Counter(
+    "classecho_structured_outputs_total",
+    "LLM JSON responses by how they were recovered (clean, repaired, reasked, incomplete)",
+    ["task", "outcome"]
+)
+JSON_ESCAPES = set('"\\/bfnrtu')
+
+# Models often write null for a string they have nothing for; keep the item
+LenientStr = Annotated[str, BeforeValidator(lambda value: "" if value is None else value)]
+
+
+def repair_json(raw_output: str) -> tuple:
+    """
+    Rewrite model output as parseable JSON: drop text around the object, escape
+    stray backslashes and control characters in strings, remove trailing commas,
+    and close a truncated document after its last complete value.
+    Returns (json text, whether the output was truncated)
+    """
+    start = raw_output.find("{")
+    if start == -1:
+        raise ValueError("No JSON object in model output")
+    
+    out, stack = [], []
+    safe_len, safe_stack = 0, ()   # Last point where every value so far was complete
+    in_string = False
+    i = start
+    while i < len(raw_output):
+        char = raw_output[i]
+        if in_string:
+            if char == "\\":
+                following = raw_output[i + 1:i + 2]
+                if following and following in JSON_ESCAPES:
+                    out.append(char + following)
+                    i += 2
+                    continue
+                out.append("\\\\")
+            elif char == '"':
+                in_string = False
+                out.append(char)
+            elif char == "\n":
+                out.append("\\n")
+            elif char == "\t":
+                out.append("\\t")
+            elif ord(char) >= 0x20:
+                out.append(char)
+        elif char == '"':
+            in_string = True
+            out.append(char)
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            out.append(char)
+            safe_len, safe_stack = len(out), tuple(stack)
+        elif char in "}]":
+            while out and out[-1] in (",", " ", "\n", "\r", "\t"):
+                out.pop()
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+            safe_len, safe_stack = len(out), tuple(stack)
+        elif char == ",":
+            safe_len, safe_stack = len(out), tuple(stack)
+            out.append(char)
+        else:
+            out.append(char)
+        i += 1
+    
+    truncated = bool(stack)
+    if truncated:
+        # Cut back to the last complete value and close what is open
+        out, stack = out[:safe_len], list(safe_stack)
+        while out and out[-1] in (",", " ", "\n", "\r", "\t"):
+            out.pop()
+        out.extend(reversed(stack))
+    return "".join(out), truncated
+
+
+def valid_items(adapter: TypeAdapter):
+    """Before-validator keeping only the list items the adapter accepts"""
+    def keep(value):
+        if not isinstance(value, list):
+            return value
+        items = []
+        for item in value:
+            try:
+                items.append(adapter.validate_python(item))
+            except ValidationError:
+                pass
+        return items
+    return keep
+
+
+def model_from_schema(name: str, schema: dict, key_fields: dict = None, owner: str = None):
+    """
+    Build a Pydantic model from one of the JSON schemas used for prompting
+    
+    Top-level fields (the sections) are required. Inside a section only the
+    fields key_fields lists for the property holding the object are (e.g.
+    {"topics": ["heading"]}); the rest default to empty, so an item that
+    leaves out a minor field is kept rather than dropped. Nested items that
+    lack a key field are dropped without invalidating their parent.
+    """
+    key_fields = key_fields or {}
+    
+    def annotation(field_schema, model_name, field):
+        if field_schema["type"] == "object":
+            return model_from_schema(model_name, field_schema, key_fields, field)
+        if field_schema["type"] == "array":
+            item_type = annotation(field_schema["items"], model_name + "Item", field)
+            if owner is None or field_schema["items"]["type"] != "object":
+                return List[item_type]
+            return Annotated[List[item_type], BeforeValidator(valid_items(TypeAdapter(item_type)))]
+        return LenientStr if field_schema["type"] == "string" else int
+    
+    fields = {}
+    for field, value in schema["properties"].items():
+        field_type = annotation(value, name + field.title().replace("_", ""), field)
+        if owner is None or field in key_fields.get(owner, ()):
+            fields[field] = (field_type, ...)
+        elif value["type"] == "object":
+            fields[field] = (field_type, Field(default_factory=field_type))
+        else:
+            fields[field] = (field_type, Field(default_factory=lambda value=value: StructuredOutput.empty(value)))
+    return create_model(name, __config__=ConfigDict(extra="ignore", coerce_numbers_to_str=True), **fields)
+
+
+class StructuredOutput:
+    """
+    Parses and validates one response schema section by section, so a bad
+    section can be re-asked on its own instead of regenerating everything
+    """
+    def __init__(self, task: str, name: str, schema: dict, guidelines: str, key_fields: dict = None):
+        self.task = task
+        self.name = name
+        self.schema = schema
+        self.guidelines = guidelines
+        self.model = model_from_schema(name.title().replace("_", ""), schema, key_fields)
+        self.sections = {}
+        for field, info in self.model.model_fields.items():
+            item_type = getattr(info.annotation, "__args__", (None,))[0]
+            self.sections[field] = (
+                TypeAdapter(info.annotation),
+                TypeAdapter(item_type) if schema["properties"][field]["type"] == "array" else None
+            )
+    
+    def validate(self, data: dict) -> tuple:
+        """Return (valid sections, names of missing or invalid sections)"""
+        valid, missing = {}, []
+        for field, (adapter, item_adapter) in self.sections.items():
+            value = data.get(field) if isinstance(data, dict) else None
+            if value is None:
+                missing.append(field)
+                continue
+            if item_adapter and isinstance(value, list):
+                # Keep the items that validate (a truncated last item is dropped)
+                items = []
+                for item in value:
+                    try:
+                        items.append(item_adapter.validate_python(item))
+                    except ValidationError:
+                        pass
+                if value and not items:
+                    missing.append(field)
+                    continue
+                valid[field] = adapter.dump_python(items, mode="json")
+                continue
+            try:
+                valid[field] = adapter.dump_python(adapter.validate_python(value), mode="json")
+            except ValidationError:
+                missing.append(field)
+        return valid, missing
+    
+    def parse(self, raw_output: str) -> tuple:
+        """Return (valid sections, missing sections, whether the JSON needed repair)"""
+        try:
+            data = json.loads(raw_output)
+            repaired = False
+        except json.JSONDecodeError:
+            repaired = True
+            try:
+                text, truncated = repair_json(raw_output)
+                data = json.loads(text)
+            except ValueError:
+                data, truncated = {}, False
+            if truncated and data:
+                # The section being written when output stopped is re-asked if nothing survived
+                last = list(data)[-1]
+                if data[last] in ([], {}):
+                    del data[last]
+        valid, missing = self.validate(data)
+        return valid, missing, repaired
+    
+    def reask_prompt(self, text: str, sections: list, model: str) -> str:
+        """Prompt for only the listed sections"""
+        subschema = schema_object(**{field: self.schema["properties"][field] for field in sections})
+        return f"""{self.guidelines}
+Return ONLY these keys: {", ".join(sections)}.
+{format_instructions(model, subschema)}
+
+Transcript:
+{text}"""
+    
+    async def reask(self, client: AsyncGroq, model: str, temperature: float, text: str, sections: list) -> dict:
+        """Ask the model again for the given sections; returns the ones that validate"""
+        subschema = schema_object(**{field: self.schema["properties"][field] for field in sections})
+        with timed_stage(f"llm_{self.task}_reask"):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": self.reask_prompt(text, sections, model)}],
+                temperature=temperature,
+                response_format=response_format_for(model, f"{self.name}_sections", subschema)
+            )
+        record_token_usage(client, model, response.usage)
+        valid, _, _ = self.parse(response.choices[0].message.content.strip())
+        return {field: valid[field] for field in sections if field in valid}
+    
+    async def complete(self, client: AsyncGroq, model: str, temperature: float,
+                       raw_output: str, text: str) -> dict:
+        """Parse model output, repairing it and re-asking only for sections that are still missing"""
+        with timed_stage("json_parse"):
+            result, missing, repaired = self.parse(raw_output)
+        if not missing:
+            STRUCTURED_OUTPUTS.labels(self.task, "repaired" if repaired else "clean").inc()
+            return result
+        
+        logger.warning(f"{self.task} output missing or invalid sections {missing}; re-asking for them")
+        result.update(await self.reask(client, model, temperature, normalize_transcript(text), missing))
+        still_missing = [field for field in missing if field not in result]
+        if still_missing:
+            # Return what we have rather than failing the whole lecture
+            logger.warning(f"{self.task} output still missing {still_missing} after re-ask")
+            STRUCTURED_OUTPUTS.labels(self.task, "incomplete").inc()
+            for field in still_missing:
+                result[field] = self.empty(self.schema["properties"][field])
+        else:
+            STRUCTURED_OUTPUTS.labels(self.task, "reasked").inc()
+        return {field: result[field] for field in self.schema["properties"]}
+    
+    @staticmethod
+    def empty(field_schema: dict):
+        if field_schema["type"] == "object":
+            return {name: StructuredOutput.empty(value) for name, value in field_schema["properties"].items()}
+        return {"array": [], "integer": 0}.get(field_schema["type"], "")
+
+
+# ==========================================
+# MODEL ROUTING
+# ==========================================
+FAST_MODEL = os.environ.get("FAST_MODEL", "llama-3.1-8b-instant")
+LARGE_MODEL = os.environ.get("LARGE_MODEL", "llama-3.3-70b-versatile")
+# Tried in turn when the routed model is rate limited, other families first
+FALLBACK_MODELS = list(filter(None, os.environ.get(
+    "FALLBACK_MODELS", "meta-llama/llama-4-scout-17b-16e-instruct"
+).split(",")))
+ROUTE_FAST_MAX_TOKENS = int(os.environ.get("ROUTE_FAST_MAX_TOKENS", "2000"))
+ROUTE_MIN_HEADROOM = float(os.environ.get("ROUTE_MIN_HEADROOM", "0.2"))
+DETAIL_LEVELS = ("brief", "standard", "detailed")
+
+# USD per million (prompt, completion) tokens, for the cost estimates in /api-status
+MODEL_PRICES = {
+    "llama-3.1-8b-instant": (0.05, 0.08),
+    "llama-3.3-70b-versatile": (0.59, 0.79),
+    "meta-llama/llama-4-scout-17b-16e-instruct": (0.11, 0.34),
+    "meta-llama/llama-4-maverick-17b-128e-instruct": (0.20, 0.60)
+}
+
+MODEL_ROUTES = Counter(
+    "classecho_model_routes_total", "LLM routing decisions", ["task", "model", "reason"]
+)
+MODEL_FALLBACKS = Counter(
+    "classecho_model_fallbacks_total", "LLM calls moved to another model after a rate limit",
+    ["from_model", "to_model"]
+)
+MODEL_LATENCY = Histogram(
+    "classecho_model_latency_seconds", "LLM call latency by model", ["task", "model"]
+)
+
+# Set per request from the X-Detail-Level header
+llm_detail_level = contextvars.ContextVar("llm_detail_level", default="standard")
+
+
+def model_family(model: str) -> str:
+    """'meta-llama/llama-4-scout-17b-16e-instruct' -> 'llama-4'"""
+    match = re.match(r"(?:[\w.-]+/)?([a-z]+(?:-\d+)?)", model)
+    return match.group(1) if match else model
+
+
+class Route:
+    def __init__(self, task, model, reason, candidates):
+        self.task = task
+        self.model = model            # Routed model; part of the LLM cache key
+        self.reason = reason
+        self.candidates = candidates  # Routed model first, then fallbacks
+        self.used = set()             # Models that actually answered
+    
+    @property
+    def fell_back(self):
+        return bool(self.used - {self.model})
+
+
+class ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.rate_limits = 0
+        self.metered_calls = 0       # Calls that reported token usage (streams don't)
+        self.metered_seconds = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = deque(maxlen=500)
+        self.routes = {}
+    
+    def summary(self, prices=None):
+        p50, p95 = np.percentile(self.latencies, [50, 95]) if self.latencies else (0.0, 0.0)
+        summary = {
+            "calls": self.calls,
+            "rate_limits": self.rate_limits,
+            "routes": dict(self.routes),
+            "p50_latency_seconds": round(float(p50), 2),
+            "p95_latency_seconds": round(float(p95), 2),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "mean_prompt_tokens": self.prompt_tokens // self.metered_calls if self.metered_calls else 0,
+            "completion_tokens_per_second": (
+                round(self.completion_tokens / self.metered_seconds, 1) if self.metered_seconds else 0.0
+            )
+        }
+        if prices:
+            summary["estimated_cost_usd"] = round(
+                (self.prompt_tokens * prices[0] + self.completion_tokens * prices[1]) / 1_000_000, 6
+            )
+        return summary
+
+
+class ModelRouter:
+    def __init__(self, fast_model, large_model, fallback_models):
+        """
+        Chooses the model for a notes or Q&A request
+        
+        Brief requests and short transcripts go to the fast model, detailed
+        requests and long transcripts to the large one. When the large
+        model is nearly out of budget across the key pool, standard requests
+        take the fast model too. Groq rate limits are per model, so a model
+        that runs out is skipped on that key until its reset time (budgets
+        are kept per key and model by the key manager) without parking the key.
+        """
+        self.fast_model = fast_model
+        self.large_model = large_model
+        self.models = list(dict.fromkeys([large_model, fast_model, *fallback_models]))
+        self.stats_by_model = {model: ModelStats() for model in self.models}
+    
+    async def park(self, key, model, seconds):
+        """Skip the model on the key for seconds after a 429"""
+        self.stats_by_model.setdefault(model, ModelStats()).rate_limits += 1
+        if key is not None:
+            await key_manager.park_model(key, model, seconds)
+    
+    def available(self, model, key=None):
+        return key_manager.model_available(model, key)
+    
+    def headroom(self, model):
+        return key_manager.model_headroom(model)
+    
+    def candidates(self, model, key=None):
+        """The model, then the other usable models with other families before its own"""
+        others = sorted(
+            (other for other in self.models if other != model),
+            key=lambda other: model_family(other) == model_family(model)
+        )
+        usable = [candidate for candidate in [model, *others] if self.available(candidate, key)]
+        return usable or [model]
+    
+    def route(self, task: str, text: str) -> Route:
+        detail = llm_detail_level.get()
+        if detail == "detailed":
+            model, reason = self.large_model, "detailed"
+        elif detail == "brief":
+            model, reason = self.fast_model, "brief"
+        elif estimate_tokens(text) <= ROUTE_FAST_MAX_TOKENS:
+            model, reason = self.fast_model, "short"
+        elif self.headroom(self.large_model) < ROUTE_MIN_HEADROOM:
+            model, reason = self.fast_model, "low_headroom"
+        else:
+            model, reason = self.large_model, "long"
+        
+        candidates = self.candidates(model)
+        if candidates[0] != model:
+            reason = "rate_limited"
+        route = Route(task, candidates[0], reason, candidates)
+        MODEL_ROUTES.labels(task, route.model, reason).inc()
+        routes = self.stats_by_model[route.model].routes
+        routes[reason] = routes.get(reason, 0) + 1
+        return route
+    
+    async def complete(self, client: AsyncGroq, route: Route, call, record=True):
+        """
+        Run call(client, model) on the route's models in turn, moving to the
+        next one when a model is rate limited on this key; returns
+        (response, model). If every model is limited on this key
+        ModelRateLimited is raised so execute_with_retry tries another key.
+        """
+        key = key_manager.clients.index(client) if client in key_manager.clients else None
+        models = [model for model in route.candidates if key is None or self.available(model, key)]
+        if not models:
+            raise ModelRateLimited()
+        for position, model in enumerate(models):
+            started = time.perf_counter()
+            try:
+                response = await call(client, model)
+            except RateLimitError as e:
+                retry_after = parse_reset_seconds(e.response.headers.get("retry-after")) or 60
+                await self.park(key, model, retry_after)
+                if position + 1 == len(models):
+                    raise ModelRateLimited() from e
+                MODEL_FALLBACKS.labels(model, models[position + 1]).inc()
+                logger.warning(f"{model} rate limited for {route.task}; falling back to {models[position + 1]}")
+                continue
+            
+            route.used.add(model)
+            if record:
+                self.record(route.task, model, time.perf_counter() - started, response.usage)
+                record_token_usage(client, model, response.usage)
+            return response, model
+    
+    def record(self, task: str, model: str, seconds: float, usage=None):
+        """Add one call's latency and token counts to the model's statistics"""
+        stats = self.stats_by_model.setdefault(model, ModelStats())
+        stats.calls += 1
+        stats.latencies.append(seconds)
+        MODEL_LATENCY.labels(task, model).observe(seconds)
+        if usage is not None:
+            stats.metered_calls += 1
+            stats.metered_seconds += seconds
+            stats.prompt_tokens += usage.prompt_tokens or 0
+            stats.completion_tokens += usage.completion_tokens or 0
+    
+    def stats(self):
+        return {
+            "fast_model": self.fast_model,
+            "large_model": self.large_model,
+            "fast_max_tokens": ROUTE_FAST_MAX_TOKENS,
+            "min_headroom": ROUTE_MIN_HEADROOM,
+            "models": {
+                model: {
+                    **stats.summary(MODEL_PRICES.get(model)),
+                    "headroom": round(self.headroom(model), 2),
+                    "limited_keys": sum(not self.available(model, key) for key in range(len(key_manager.api_keys)))
+                }
+                for model, stats in self.stats_by_model.items()
+            }
+        }
+
+
+model_router = ModelRouter(FAST_MODEL, LARGE_MODEL, FALLBACK_MODELS)
+
+
+# ==========================================
+# SUMMARIZE WITH KEY ROTATION
+# ==========================================
+# Bump a *_PROMPT_VERSION whenever its prompt changes so cached results expire
+NOTES_TEMPERATURE = 0.2
+NOTES_PROMPT_VERSION = "notes-v2"
+
+NOTES_SCHEMA = schema_object(
+    title=STRING,
+    overview=STRING,
+    speakers=schema_array(schema_object(name=STRING, role=STRING, key_contributions=STRINGS)),
+    topics=schema_array(schema_object(
+        heading=STRING,
+        summary=STRING,
+        key_points=schema_array(schema_object(
+            point=STRING, explanation=STRING, examples=STRINGS, importance=STRING
+        )),
+        additional_insights=STRINGS,
+        recommended_resources=schema_array(schema_object(
+            type={"type": "string", "enum": ["book", "course", "article", "video", "tool", "documentation"]},
+            title=STRING,
+            description=STRING,
+            url=STRING
+        ))
+    )),
+    key_takeaways=STRINGS,
+    action_items=STRINGS,
+    further_learning=schema_object(beginner=STRINGS, intermediate=STRINGS, advanced=STRINGS)
+)
+
+
+NOTES_GUIDELINES = """You are an expert note-taker and learning guide. Turn this lecture transcript into study notes.
+- Organize content into topics with clear headings and a 2-3 sentence summary each.
+- For each key point give an explanation with context, practical examples, and why it matters.
+- Add insights, common pitfalls, and specific resources (url or "Search online").
+- Attribute speakers when named, otherwise "Speaker 1", "Speaker 2" or "Unknown Speaker".
+- Overview: 2-3 sentences. Include at least 3 key takeaways and concrete action items."""
+
+# Fields without which a speaker, topic, key point or resource is dropped
+NOTES_KEY_FIELDS = {
+    "speakers": ["name"],
+    "topics": ["heading"],
+    "key_points": ["point"],
+    "recommended_resources": ["title"]
+}
+
+notes_output = StructuredOutput("notes", "study_notes", NOTES_SCHEMA, NOTES_GUIDELINES, NOTES_KEY_FIELDS)
+
+
+def build_notes_prompt(text: str, model: str = LARGE_MODEL) -> str:
+    """Prompt asking the model for structured study notes"""
+    return f"""{NOTES_GUIDELINES}
+{format_instructions(model, NOTES_SCHEMA)}
+
+Transcript:
+{text}"""
+
+
+async def summarize_and_structure(client: AsyncGroq, text: str, route: Route = None) -> dict:
+    """
+    Generate structured notes using provided Groq client, on the routed model
+    """
+    route = route or model_router.route("notes", text)
+    transcript = prepare_transcript(text, "notes")
+    
+    async def call(client, model):
+        with timed_stage("llm_notes"):
+            return await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": build_notes_prompt(transcript, model)}],
+                temperature=NOTES_TEMPERATURE,
+                response_format=response_format_for(model, "study_notes", NOTES_SCHEMA)
+            )
+    response, model = await model_router.complete(client, route, call)
+
+    raw_output = response.choices[0].message.content.strip()
+    return await notes_output.complete(client, model, NOTES_TEMPERATURE, raw_output, text)
+
+
+# ==========================================
+# MAP-REDUCE SUMMARIZATION FOR LONG TRANSCRIPTS
+# ==========================================
+SUMMARY_SECTION_TOKENS = int(os.environ.get("SUMMARY_SECTION_TOKENS", "6000"))
+
+
+def split_transcript(text: str, max_tokens: int = SUMMARY_SECTION_TOKENS) -> list:
+    """
+    Split a transcript into sections of at most max_tokens, on sentence boundaries
+    """
+    sentences = re.split(r"(?<=[.!?])\s+", text.strip())
+    sections, current, current_tokens = [], [], 0
+    for sentence in sentences:
+        tokens = estimate_tokens(sentence)
+        if current and current_tokens + tokens > max_tokens:
+            sections.append(" ".join(current))
+            current, current_tokens = [], 0
+        current.append(sentence)
+        current_tokens += tokens
+    if current:
+        sections.append(" ".join(current))
+    return sections
+
+
+def merge_notes(partials: list) -> dict:
+    """
+    Merge per-section notes into a single document with the same schema
+    """
+    def unique(items):
+        seen, result = set(), []
+        for item in items:
+            marker = json.dumps(item, sort_keys=True).lower()
+            if marker not in seen:
+                seen.add(marker)
+                result.append(item)
+        return result
+    
+    speakers = {}
+    for notes in partials:
+        for speaker in notes.get("speakers", []):
+            name = speaker.get("name", "Unknown Speaker")
+            merged = speakers.setdefault(name, {**speaker, "key_contributions": []})
+            merged["key_contributions"] = unique(
+                merged["key_contributions"] + speaker.get("key_contributions", [])
+            )
+    
+    further_learning = {}
+    for notes in partials:
+        for level, resources in notes.get("further_learning", {}).items():
+            further_learning[level] = unique(further_learning.get(level, []) + resources)
+    
+    return {
+        "title": partials[0].get("title", "Lecture Notes"),
+        "overview": " ".join(n.get("overview", "") for n in partials).strip(),
+        "speakers": list(speakers.values()),
+        "topics": [topic for notes in partials for topic in notes.get("topics", [])],
+        "key_takeaways": unique(t for notes in partials for t in notes.get("key_takeaways", [])),
+        "action_items": unique(a for notes in partials for a in notes.get("action_items", [])),
+        "further_learning": further_learning
+    }
+
+
+async def summarize_transcript(transcript: str) -> dict:
+    """
+    Generate notes, summarizing long transcripts section by section in parallel
+    """
+    sections = split_transcript(transcript)
+    if len(sections) == 1:
+        return await execute_cached("notes", transcript)
+    
+    logger.info(f"Summarizing transcript in {len(sections)} sections")
+    partials = await asyncio.gather(*[
+        execute_cached("notes", section)
+        for section in sections
+    ])
+    return merge_notes(partials)
+
+
+# ==========================================
+# Q&A GENERATION FUNCTION
+# ==========================================
+QA_TEMPERATURE = 0.3  # Slightly higher for more diverse questions
+QA_PROMPT_VERSION = "qa-v3"
+
+QA_SCHEMA = schema_object(
+    topic=STRING,
+    total_questions=INTEGER,
+    difficulty_breakdown=schema_object(easy=INTEGER, medium=INTEGER, hard=INTEGER),
+    questions=schema_array(schema_object(
+        id=INTEGER,
+        question=STRING,
+        answer=STRING,
+        difficulty={"type": "string", "enum": ["easy", "medium", "hard"]},
+        category={"type": "string", "enum": ["concept", "application", "critical_thinking", "synthesis"]},
+        key_terms=STRINGS,
+        related_topics=STRINGS
+    )),
+    study_tips=STRINGS,
+    quiz_summary=schema_object(main_themes=STRINGS, prerequisites=STRINGS, next_steps=STRINGS)
+)
+
+
+QA_CATEGORIES = ("concept", "application", "critical_thinking", "synthesis")
+QA_PER_CATEGORY = 5
+QA_CHUNK_TOKENS = int(os.environ.get("QA_CHUNK_TOKENS", "1500"))
+QA_MAX_CHUNKS = int(os.environ.get("QA_MAX_CHUNKS", "8"))
+QA_DUPLICATE_SIMILARITY = 0.75
+QA_TOKENS_PER_QUESTION = 220
+
+# What each chunk call returns; total_questions and the difficulty breakdown
+# are computed once the questions are assembled
+QA_CHUNK_SCHEMA = schema_object(
+    topic=STRING,
+    questions=QA_SCHEMA["properties"]["questions"],
+    study_tips=STRINGS,
+    quiz_summary=QA_SCHEMA["properties"]["quiz_summary"]
+)
+
+QA_GUIDELINES = """You are an expert educator and question generator. Write study questions with answers from this excerpt of a lecture transcript.
+- Questions must be specific, answerable from the excerpt, and test understanding rather than trivia.
+- Mix difficulty: mostly medium, some easy and some hard.
+- Answers: 2-4 sentences explaining the why, with examples where relevant.
+- Also give the excerpt's topic, up to 3 study tips, its main themes, prerequisites and next steps."""
+
+qa_output = StructuredOutput(
+    "qa", "study_questions", QA_CHUNK_SCHEMA, QA_GUIDELINES, {"questions": ["question", "answer"]}
+)
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how in is it of on or the this "
+    "to what when where which who why with would you your".split()
+)
+
+
+def build_qa_prompt(text: str, counts: dict, avoid: list = (), model: str = LARGE_MODEL) -> str:
+    """Prompt asking for a fixed number of questions per category from one excerpt"""
+    wanted = ", ".join(f"{n} {category}" for category, n in counts.items() if n)
+    avoid_lines = "".join(f"\n  - {question}" for question in avoid)
+    return f"""{QA_GUIDELINES}
+- Write exactly {sum(counts.values())} questions: {wanted}.{f"{chr(10)}- Do not repeat or rephrase these existing questions:{avoid_lines}" if avoid else ""}
+{format_instructions(model, QA_CHUNK_SCHEMA)}
+
+Transcript excerpt:
+{text}"""
+
+
+def question_terms(question: str) -> frozenset:
+    return frozenset(re.findall(r"\w+", question.lower())) - STOPWORDS
+
+
+def is_duplicate(terms: frozenset, seen: list) -> bool:
+    """Near-identical questions share most of their content words (Jaccard similarity)"""
+    return any(
+        len(terms & other) / len(terms | other) >= QA_DUPLICATE_SIMILARITY
+        for other in seen if terms or other
+    )
+
+
+def unique_items(items, limit: int) -> list:
+    """First occurrences of case-insensitively distinct strings"""
+    seen, result = set(), []
+    for item in items:
+        if isinstance(item, str) and item.strip() and item.lower() not in seen:
+            seen.add(item.lower())
+            result.append(item)
+    return result[:limit]
+
+
+def plan_question_quotas(chunks: int, slack: int) -> list:
+    """
+    Spread QA_PER_CATEGORY (+ slack) questions per category over the chunks,
+    interleaved so every chunk gets a mix of categories
+    """
+    quotas = [{category: 0 for category in QA_CATEGORIES} for _ in range(chunks)]
+    slots = [category for category in QA_CATEGORIES for _ in range(QA_PER_CATEGORY + slack)]
+    for slot, category in enumerate(slots):
+        quotas[slot % chunks][category] += 1
+    return quotas
+
+
+def plan_qa_chunks(text: str) -> list:
+    """
+    Split a normalized transcript into at most QA_MAX_CHUNKS chunks and pair
+    each with its question quota
+    """
+    chunk_tokens = max(QA_CHUNK_TOKENS, -(-estimate_tokens(text) // QA_MAX_CHUNKS))
+    chunks = split_transcript(text, chunk_tokens)
+    while len(chunks) > QA_MAX_CHUNKS:
+        # Sentence boundaries can push the count over; widen the chunks slightly
+        chunk_tokens = int(chunk_tokens * 1.1) + 1
+        chunks = split_transcript(text, chunk_tokens)
+    # A little over-generation across chunks leaves room for de-duplication
+    quotas = plan_question_quotas(len(chunks), slack=1 if len(chunks) > 1 else 0)
+    return [(chunk, counts) for chunk, counts in zip(chunks, quotas) if any(counts.values())]
+
+
+async def generate_chunk_questions(client: AsyncGroq, chunk: str, counts: dict, avoid: list = (),
+                                   route: Route = None) -> dict:
+    """
+    One small, bounded completion: the requested questions from one excerpt
+    """
+    route = route or model_router.route("qa", chunk)
+    
+    async def call(client, model):
+        with timed_stage("llm_qa"):
+            return await client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": build_qa_prompt(chunk, counts, avoid, model)}],
+                temperature=QA_TEMPERATURE,
+                response_format=response_format_for(model, qa_output.name, QA_CHUNK_SCHEMA),
+                max_tokens=QA_TOKENS_PER_QUESTION * sum(counts.values()) + 400
+            )
+    response, _ = await model_router.complete(client, route, call)
+    
+    # Truncated or invalid questions are dropped here and topped up afterwards
+    with timed_stage("json_parse"):
+        result, missing, _ = qa_output.parse(response.choices[0].message.content.strip())
+    if missing:
+        logger.warning(f"Q&A chunk output missing {missing}")
+    return result
+
+
+def select_questions(pools: list) -> dict:
+    """
+    Drop near-duplicates and keep up to QA_PER_CATEGORY per category, taking
+    questions from the chunks in turn so the whole lecture is covered
+    """
+    selected = {category: [] for category in QA_CATEGORIES}
+    seen = []
+    for round_items in itertools.zip_longest(*pools):
+        for item in round_items:
+            if item is None or item.get("category") not in selected:
+                continue
+            terms = question_terms(item["question"])
+            if len(selected[item["category"]]) >= QA_PER_CATEGORY or is_duplicate(terms, seen):
+                continue
+            seen.append(terms)
+            selected[item["category"]].append(item)
+    return selected
+
+
+async def generate_questions_and_answers(text: str, route: Route = None,
+                                         progress: asyncio.Queue = None) -> dict:
+    """
+    Generate 20 Q&A pairs (5 per category) from transcript chunks in parallel,
+    then top up only the categories that came back short; every chunk uses
+    the model routed for the whole transcript. Each chunk's validated
+    questions are put on `progress` as soon as that chunk finishes
+    """
+    route = route or model_router.route("qa", text)
+    plan = plan_qa_chunks(prepare_transcript(text, "qa"))
+    chunks = [chunk for chunk, _ in plan]
+    
+    async def run_chunk(index, chunk, counts):
+        return index, await key_manager.execute_with_retry(
+            generate_chunk_questions, chunk, counts, route=route, models=route.candidates
+        )
+    tasks = [asyncio.create_task(run_chunk(index, chunk, counts))
+             for index, (chunk, counts) in enumerate(plan)]
+    # Pools stay in transcript order so selection still takes chunks in turn
+    parts = [None] * len(tasks)
+    try:
+        for next_part in asyncio.as_completed(tasks):
+            index, part = await next_part
+            parts[index] = part
+            if progress is not None:
+                await progress.put(part.get("questions", []))
+    finally:
+        for task in tasks:
+            task.cancel()
+    pools = [part.get("questions", []) for part in parts]
+    selected = select_questions(pools)
+    
+    missing = {category: QA_PER_CATEGORY - len(items) for category, items in selected.items()}
+    topped_up = 0
+    if any(missing.values()):
+        # Ground the top-up on the chunk that contributed the fewest questions
+        used = [
+            sum(1 for items in selected.values() for item in items if item in pool)
+            for pool in pools
+        ]
+        chunk = chunks[used.index(min(used))] if used else chunks[0]
+        existing = [item["question"] for items in selected.values() for item in items]
+        logger.info(f"Topping up Q&A categories {({c: n for c, n in missing.items() if n})}")
+        with timed_stage("llm_qa_topup"):
+            extra = await key_manager.execute_with_retry(
+                generate_chunk_questions, chunk, {c: n for c, n in missing.items() if n}, existing,
+                route=route, models=route.candidates
+            )
+        before = sum(len(items) for items in selected.values())
+        selected = select_questions([[item for items in selected.values() for item in items]]
+                                    + [extra.get("questions", [])])
+        topped_up = sum(len(items) for items in selected.values()) - before
+        parts.append(extra)
+        if progress is not None:
+            await progress.put(extra.get("questions", []))
+    
+    questions = []
+    for category in QA_CATEGORIES:
+        questions.extend(selected[category])
+    # Easy to hard within the quiz, keeping the category order for ties
+    difficulty_rank = {"easy": 0, "medium": 1, "hard": 2}
+    questions.sort(key=lambda item: difficulty_rank.get(item.get("difficulty"), 1))
+    for number, item in enumerate(questions, start=1):
+        item["id"] = number
+    
+    summaries = [part.get("quiz_summary", {}) for part in parts]
+    qa_data = {
+        "topic": next((part["topic"] for part in parts if part.get("topic")), "Lecture Q&A"),
+        "total_questions": len(questions),
+        "difficulty_breakdown": {
+            level: sum(1 for item in questions if item.get("difficulty") == level)
+            for level in ("easy", "medium", "hard")
+        },
+        "questions": questions,
+        "study_tips": unique_items((tip for part in parts for tip in part.get("study_tips", [])), 5),
+        "quiz_summary": {
+            field: unique_items((value for summary in summaries for value in summary.get(field, [])), limit)
+            for field, limit in (("main_themes", 8), ("prerequisites", 5), ("next_steps", 5))
+        }
+    }
+    
+    logger.info(
+        f"Generated {len(questions)} questions from {len(chunks)} chunks"
+        + (f" ({topped_up} from top-up)" if topped_up else "")
+    )
+    return qa_data
+
+
+
+# ==========================================
+# LLM RESULT CACHE
+# ==========================================
+llm_cache = ResultCache(
+    "llm_results",
+    max_entries=int(os.environ.get("LLM_CACHE_SIZE", "512")),
+    ttl_seconds=int(os.environ.get("LLM_CACHE_TTL", str(7 * 86400))),
+    db_path=os.environ.get("LLM_CACHE_DB")
+)
+
+# Set per request from the X-Cache-Bypass header
+llm_cache_bypass = contextvars.ContextVar("llm_cache_bypass", default=False)
+
+LLM_TASKS = {
+    "notes": {
+        "prompt_version": NOTES_PROMPT_VERSION,
+        "temperature": NOTES_TEMPERATURE
+    },
+    "qa": {
+        "prompt_version": QA_PROMPT_VERSION,
+        "temperature": QA_TEMPERATURE,
+        "chunk_tokens": QA_CHUNK_TOKENS,
+        "max_chunks": QA_MAX_CHUNKS
+    }
+}
+LLM_TASK_FUNCTIONS = {
+    "notes": summarize_and_structure,
+    "qa": generate_questions_and_answers
+}
+# Tasks that schedule their own Groq calls instead of running on a single key
+LLM_MULTI_CALL_TASKS = {"qa"}
+
+
+def llm_cache_key(task: str, text: str, model: str) -> str:
+    """Hash of the normalized transcript, prompt version, routed model and sampling parameters"""
+    normalized = normalize_transcript(text)
+    payload = json.dumps({
+        "text": normalized, **LLM_TASKS[task], "model": model, "json_schema": model in JSON_SCHEMA_MODELS
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def get_cached_result(task: str, text: str, model: str):
+    """Return a copy of the cached result, or None on a miss or bypass"""
+    if llm_cache_bypass.get():
+        return None
+    result = await asyncio.to_thread(llm_cache.get, llm_cache_key(task, text, model))
+    return copy.deepcopy(result)
+
+
+async def store_cached_result(task: str, text: str, model: str, result: dict):
+    await asyncio.to_thread(llm_cache.set, llm_cache_key(task, text, model), copy.deepcopy(result))
+
+
+async def store_routed_result(route: Route, text: str, result: dict):
+    """Cache a result under its routed model, unless another model had to answer"""
+    if route.fell_back:
+        logger.info(f"Not caching {route.task}: answered by {sorted(route.used)} instead of {route.model}")
+        return
+    await store_cached_result(route.task, text, route.model, result)
+
+
+async def execute_cached(task: str, text: str) -> dict:
+    """
+    Run a notes or Q&A task on the routed model, serving identical requests from the cache
+    """
+    route = model_router.route(task, text)
+    result = await get_cached_result(task, text, route.model)
+    if result is not None:
+        logger.info(f"LLM cache hit for {task} ({route.model})")
+        return result
+    
+    if task in LLM_MULTI_CALL_TASKS:
+        result = await LLM_TASK_FUNCTIONS[task](text, route)
+    else:
+        result = await key_manager.execute_with_retry(
+            LLM_TASK_FUNCTIONS[task], text, route, models=route.candidates
+        )
+    await store_routed_result(route, text, result)
+    return result
+
+
+@app.middleware("http")
+async def read_llm_request_headers(request: Request, call_next):
+    """
+    Honour X-Cache-Bypass: 1 (or Cache-Control: no-cache) for LLM results, and
+    X-Detail-Level: brief | standard | detailed for model routing
+    """
+    bypass = (
+        request.headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes")
+        or "no-cache" in request.headers.get("cache-control", "").lower()
+    )
+    llm_cache_bypass.set(bypass)
+    detail = request.headers.get("x-detail-level", "standard").lower()
+    llm_detail_level.set(detail if detail in DETAIL_LEVELS else "standard")
+    return await call_next(request)
+
+
+# ==========================================
+# STREAMING (SERVER-SENT EVENTS)
+# ==========================================
+class IncrementalArrayParser:
+    """
+    Pulls complete objects out of a JSON array (e.g. "topics") while the
+    surrounding document is still being streamed
+    """
+    def __init__(self, key: str):
+        self.key_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        self.buffer = ""
+        self.pos = None          # Scan position once the array is found
+        self.item_start = None   # Buffer index where the current item began
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+    
+    def feed(self, text: str) -> list:
+        """Add streamed text and return any items completed by it"""
+        self.buffer += text
+        if self.done:
+            return []
+        if self.pos is None:
+            match = self.key_pattern.search(self.buffer)
+            if not match:
+                return []
+            self.pos = match.end()
+        
+        items = []
+        while self.pos < len(self.buffer):
+            char = self.buffer[self.pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                if self.depth == 0:
+                    self.item_start = self.pos
+                self.depth += 1
+            elif char in "}]":
+                if self.depth == 0:
+                    # Closing bracket of the array itself
+                    self.done = True
+                    break
+                self.depth -= 1
+                if self.depth == 0:
+                    try:
+                        items.append(json.loads(self.buffer[self.item_start:self.pos + 1]))
+                    except json.JSONDecodeError:
+                        pass
+            self.pos += 1
+        return items
+
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def open_chat_stream(client: AsyncGroq, prompt: str, model: str, temperature: float,
+                           response_format: dict = None):
+    """
+    Start a streaming chat completion (rate limits surface here, so this
+    runs under execute_with_retry)
+    """
+    return await client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        temperature=temperature,
+        response_format=response_format or {"type": "json_object"},
+        stream=True
+    )
+
+
+async def stream_pipeline(upload: AudioUpload, feature: str):
+    """
+    Yield SSE events for each stage: upload, transcript, items, final result
+    """
+    item_key, item_event = ("topics", "topic") if feature == "notes" else ("questions", "question")
+    try:
+        yield sse_event("upload_received", {"filename": upload.filename, "size": upload.size})
+        
+        try:
+            transcript = await transcribe_audio(upload)
+        finally:
+            upload.cleanup()
+        yield sse_event("transcript", {"text": transcript})
+        
+        if feature == "qa":
+            route = model_router.route(feature, transcript)
+            result = await get_cached_result(feature, transcript, route.model)
+            if result is None:
+                # Questions go out as each chunk lands; `complete` carries the
+                # de-duplicated, balanced selection
+                questions = asyncio.Queue()
+                task = asyncio.create_task(
+                    generate_questions_and_answers(transcript, route, progress=questions)
+                )
+                task.add_done_callback(lambda _: questions.put_nowait(None))
+                try:
+                    seen = []
+                    while (items := await questions.get()) is not None:
+                        for item in items:
+                            terms = question_terms(item["question"])
+                            if is_duplicate(terms, seen):
+                                continue
+                            seen.append(terms)
+                            yield sse_event(item_event, item)
+                    result = await task
+                finally:
+                    task.cancel()
+                await store_routed_result(route, transcript, result)
+            else:
+                for item in result.get(item_key, []):
+                    yield sse_event(item_event, item)
+        elif len(split_transcript(transcript)) > 1:
+            # Long notes go through map-reduce; emit the topics once they are merged
+            result = await summarize_transcript(transcript)
+            for item in result.get(item_key, []):
+                yield sse_event(item_event, item)
+        else:
+            route = model_router.route(feature, transcript)
+            result = await get_cached_result(feature, transcript, route.model)
+            if result is not None:
+                for item in result.get(item_key, []):
+                    yield sse_event(item_event, item)
+            else:
+                prepared = prepare_transcript(transcript, feature)
+                output = notes_output
+                temperature = LLM_TASKS[feature]["temperature"]
+                
+                async def open_stream(client, model):
+                    return await open_chat_stream(
+                        client, build_notes_prompt(prepared, model), model, temperature,
+                        response_format_for(model, output.name, output.schema)
+                    )
+                started = time.perf_counter()
+                stream, model = await key_manager.execute_with_retry(
+                    model_router.complete, route, open_stream, record=False, models=route.candidates
+                )
+                parser = IncrementalArrayParser(item_key)
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    for item in parser.feed(delta):
+                        yield sse_event(item_event, item)
+                model_router.record(feature, model, time.perf_counter() - started)
+                with timed_stage("json_parse"):
+                    result, missing, repaired = output.parse(parser.buffer.strip())
+                if missing:
+                    result = await key_manager.execute_with_retry(
+                        output.complete, model, temperature, parser.buffer.strip(), transcript, models=[model]
+                    )
+                else:
+                    STRUCTURED_OUTPUTS.labels(feature, "repaired" if repaired else "clean").inc()
+                await store_routed_result(route, transcript, result)
+        
+        lecture_store.remember(upload, transcript, **{feature: result})
+        yield sse_event("complete", result)
+    
+    except HTTPException as e:
+        yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+    except Exception as e:
+        logger.error(f"Unexpected error in stream_pipeline: {str(e)}")
+        yield sse_event("error", {"status_code": 500, "detail": str(e)})
+
+
+# ==========================================
+# LECTURE STORE AND SEARCH
+# ==========================================
+LECTURE_CHUNK_TOKENS = int(os.environ.get("LECTURE_CHUNK_TOKENS", "200"))
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+
+
+def text_fields(value) -> list:
+    """All string leaves of a notes or Q&A document, in order"""
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    if isinstance(value, dict):
+        return [text for item in value.values() for text in text_fields(item)]
+    if isinstance(value, list):
+        return [text for item in value for text in text_fields(item)]
+    return []
+
+
+def fts_query(query: str) -> str:
+    """Quote each search term so user input can't break FTS5 query syntax"""
+    return " OR ".join(f'"{term}"' for term in re.findall(r"\w+", query))
+
+
+class LectureStore:
+    def __init__(self, db_path):
+        """
+        Every processed lecture (transcript, notes, Q&A) in SQLite, with an FTS5
+        index over transcript and notes chunks and, when fastembed is installed,
+        a CPU embedding index for semantic search
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS lectures ("
+                "id TEXT PRIMARY KEY, filename TEXT, title TEXT, transcript TEXT NOT NULL, "
+                "notes TEXT, qa TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS lecture_chunks ("
+                "id INTEGER PRIMARY KEY, lecture_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                "position INTEGER NOT NULL, text TEXT NOT NULL, embedding BLOB)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS lecture_chunks_lecture ON lecture_chunks (lecture_id, kind)"
+            )
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS lecture_fts USING fts5("
+                "text, lecture_id UNINDEXED, chunk_id UNINDEXED, tokenize='porter unicode61')"
+            )
+        
+        self.embedder = None
+        self.embedding_ids = np.zeros(0, dtype=np.int64)
+        self.embedding_lectures = []
+        self.embedding_matrix = np.zeros((0, 0), dtype=np.float32)
+        self.embedding_generation = 0   # Bumped whenever the matrix is reset
+        # Guards the embedder and the in-memory matrix. Never held together with
+        # self.lock: embeddings are computed before writing, and chunk rows are
+        # read before the matrix is locked
+        self.embedding_lock = threading.Lock()
+        self.pending = set()
+    
+    def semantic_available(self):
+        return TextEmbedding is not None and bool(EMBEDDING_MODEL)
+    
+    def _embed(self, texts):
+        """Unit-length float32 embeddings (the model is loaded on first use)"""
+        with self.embedding_lock:
+            if self.embedder is None:
+                self.embedder = TextEmbedding(model_name=EMBEDDING_MODEL)
+                logger.info(f"Loaded embedding model {EMBEDDING_MODEL}")
+            vectors = np.array(list(self.embedder.embed(texts)), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    
+    def _chunk(self, text):
+        """Split text into chunks and embed them (None without fastembed)"""
+        chunks = split_transcript(text, LECTURE_CHUNK_TOKENS) if text.strip() else []
+        return chunks, self._embed(chunks) if chunks and self.semantic_available() else None
+    
+    def _index(self, conn, lecture_id, kind, chunks, embeddings):
+        """Replace the chunks of one kind for a lecture"""
+        stale = [row[0] for row in conn.execute(
+            "SELECT id FROM lecture_chunks WHERE lecture_id = ? AND kind = ?", (lecture_id, kind)
+        )]
+        conn.executemany("DELETE FROM lecture_fts WHERE chunk_id = ?", [(i,) for i in stale])
+        conn.execute("DELETE FROM lecture_chunks WHERE lecture_id = ? AND kind = ?", (lecture_id, kind))
+        
+        for position, chunk in enumerate(chunks):
+            chunk_id = conn.execute(
+                "INSERT INTO lecture_chunks (lecture_id, kind, position, text, embedding) VALUES (?, ?, ?, ?, ?)",
+                (lecture_id, kind, position, chunk,
+                 embeddings[position].tobytes() if embeddings is not None else None)
+            ).lastrowid
+            conn.execute(
+                "INSERT INTO lecture_fts (text, lecture_id, chunk_id) VALUES (?, ?, ?)",
+                (chunk, lecture_id, chunk_id)
+            )
+        return bool(stale)
+    
+    def save(self, lecture_id, filename, transcript, notes=None, qa=None):
+        """
+        Store a lecture and index whatever is new; notes and Q&A generated by
+        separate requests for the same audio end up on one record
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT transcript FROM lectures WHERE id = ?", (lecture_id,)
+            ).fetchone()
+        
+        # Embedding is slow and takes embedding_lock, so it happens before self.lock
+        pieces = {}
+        if row is None or row[0] != transcript:
+            pieces["transcript"] = self._chunk(transcript)
+        if notes is not None:
+            pieces["notes"] = self._chunk(". ".join(text_fields(notes)))
+        if qa is not None:
+            pieces["qa"] = self._chunk(". ".join(text_fields(qa)))
+        
+        now = time.time()
+        rebuilt = False
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT transcript FROM lectures WHERE id = ?", (lecture_id,)
+            ).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO lectures (id, filename, transcript, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (lecture_id, filename, transcript, now, now)
+                )
+            if "transcript" in pieces:
+                self.conn.execute(
+                    "UPDATE lectures SET transcript = ?, updated_at = ? WHERE id = ?",
+                    (transcript, now, lecture_id)
+                )
+                rebuilt |= self._index(self.conn, lecture_id, "transcript", *pieces["transcript"])
+            if notes is not None:
+                self.conn.execute(
+                    "UPDATE lectures SET notes = ?, title = ?, updated_at = ? WHERE id = ?",
+                    (json.dumps(notes), notes.get("title"), now, lecture_id)
+                )
+                rebuilt |= self._index(self.conn, lecture_id, "notes", *pieces["notes"])
+            if qa is not None:
+                self.conn.execute(
+                    "UPDATE lectures SET qa = ?, title = COALESCE(title, ?), updated_at = ? WHERE id = ?",
+                    (json.dumps(qa), qa.get("topic"), now, lecture_id)
+                )
+                rebuilt |= self._index(self.conn, lecture_id, "qa", *pieces["qa"])
+        if rebuilt:
+            # Replaced chunks: reload the in-memory embedding matrix from scratch
+            with self.embedding_lock:
+                self.embedding_ids = np.zeros(0, dtype=np.int64)
+                self.embedding_lectures = []
+                self.embedding_matrix = np.zeros((0, 0), dtype=np.float32)
+                self.embedding_generation += 1
+    
+    def remember(self, upload, transcript, notes=None, qa=None):
+        """Save a processed upload in the background so responses aren't delayed"""
+        self.save_in_background(upload.sha256[:16], upload.filename, transcript, notes, qa)
+    
+    def save_in_background(self, lecture_id, filename, transcript, notes=None, qa=None):
+        task = asyncio.create_task(asyncio.to_thread(
+            self.save, lecture_id, filename, transcript, copy.deepcopy(notes), copy.deepcopy(qa)
+        ))
+        self.pending.add(task)
+        task.add_done_callback(self._saved)
+    
+    def _saved(self, task):
+        self.pending.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Failed to store lecture: {task.exception()}")
+    
+    def get(self, lecture_id):
+        with self.lock:
+            self.conn.row_factory = sqlite3.Row
+            row = self.conn.execute("SELECT * FROM lectures WHERE id = ?", (lecture_id,)).fetchone()
+            self.conn.row_factory = None
+        if row is None:
+            return None
+        lecture = dict(row)
+        lecture["notes"] = json.loads(lecture["notes"]) if lecture["notes"] else None
+        lecture["qa"] = json.loads(lecture["qa"]) if lecture["qa"] else None
+        return lecture
+    
+    def list(self, limit=50):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, filename, title, length(transcript), notes IS NOT NULL, qa IS NOT NULL, "
+                "created_at, updated_at FROM lectures ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            {"id": row[0], "filename": row[1], "title": row[2], "transcript_length": row[3],
+             "has_notes": bool(row[4]), "has_qa": bool(row[5]), "created_at": row[6], "updated_at": row[7]}
+            for row in rows
+        ]
+    
+    def keyword_search(self, query, limit):
+        terms = fts_query(query)
+        if not terms:
+            return []
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT chunk_id, lecture_id, snippet(lecture_fts, 0, '[', ']', '...', 16), bm25(lecture_fts) "
+                "FROM lecture_fts WHERE lecture_fts MATCH ? ORDER BY rank LIMIT ?",
+                (terms, limit)
+            ).fetchall()
+        return [
+            {"chunk_id": row[0], "lecture_id": row[1], "snippet": row[2], "score": round(-row[3], 4)}
+            for row in rows
+        ]
+    
+    def _load_embeddings(self):
+        """
+        Append embeddings of chunks indexed since the last search; rows are
+        read under self.lock first, then added under embedding_lock
+        """
+        while True:
+            with self.embedding_lock:
+                generation = self.embedding_generation
+                last_id = int(self.embedding_ids[-1]) if len(self.embedding_ids) else 0
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, lecture_id, embedding FROM lecture_chunks "
+                    "WHERE id > ? AND embedding IS NOT NULL ORDER BY id", (last_id,)
+                ).fetchall()
+            with self.embedding_lock:
+                if generation != self.embedding_generation:
+                    continue   # Reset while we were reading; the matrix needs every row again
+                # Another search may have appended some of these meanwhile
+                last_id = int(self.embedding_ids[-1]) if len(self.embedding_ids) else 0
+                rows = [row for row in rows if row[0] > last_id]
+                if rows:
+                    vectors = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+                    self.embedding_ids = np.concatenate([self.embedding_ids, [row[0] for row in rows]])
+                    self.embedding_lectures += [row[1] for row in rows]
+                    self.embedding_matrix = (
+                        np.vstack([self.embedding_matrix, vectors]) if self.embedding_matrix.size else vectors
+                    )
+                return
+    
+    def semantic_search(self, query, limit):
+        query_vector = self._embed([query])[0]
+        self._load_embeddings()
+        with self.embedding_lock:
+            if not len(self.embedding_ids):
+                return []
+            scores = self.embedding_matrix @ query_vector
+            top = np.argsort(-scores)[:limit]
+            hits = [(int(self.embedding_ids[i]), self.embedding_lectures[i], float(scores[i])) for i in top]
+        with self.lock:
+            texts = dict(self.conn.execute(
+                f"SELECT id, text FROM lecture_chunks WHERE id IN ({','.join('?' * len(hits))})",
+                [hit[0] for hit in hits]
+            ).fetchall())
+        return [
+            {"chunk_id": chunk_id, "lecture_id": lecture_id, "snippet": texts.get(chunk_id, ""),
+             "score": round(score, 4)}
+            for chunk_id, lecture_id, score in hits
+        ]
+    
+    def search(self, query, limit=10, mode="hybrid"):
+        """
+        Keyword (BM25), semantic (cosine) or hybrid search over lecture chunks;
+        hybrid merges the two rankings with reciprocal rank fusion
+        """
+        if mode == "keyword" or not self.semantic_available():
+            results = self.keyword_search(query, limit)
+        elif mode == "semantic":
+            results = self.semantic_search(query, limit)
+        else:
+            fused = {}
+            for ranking in (self.keyword_search(query, 2 * limit), self.semantic_search(query, 2 * limit)):
+                for rank, hit in enumerate(ranking):
+                    entry = fused.setdefault(hit["chunk_id"], {**hit, "score": 0.0})
+                    entry["score"] += 1 / (60 + rank)
+            results = sorted(fused.values(), key=lambda hit: -hit["score"])[:limit]
+            for hit in results:
+                hit["score"] = round(hit["score"], 4)
+        
+        if results:
+            with self.lock:
+                chunks = {row[0]: row[1:] for row in self.conn.execute(
+                    "SELECT c.id, c.kind, c.position, l.filename, l.title FROM lecture_chunks c "
+                    f"JOIN lectures l ON l.id = c.lecture_id WHERE c.id IN ({','.join('?' * len(results))})",
+                    [hit["chunk_id"] for hit in results]
+                )}
+            for hit in results:
+                kind, position, filename, title = chunks.get(hit["chunk_id"], (None, None, None, None))
+                hit.update(kind=kind, position=position, filename=filename, title=title)
+        return results
+    
+    def stats(self):
+        with self.lock:
+            lectures = self.conn.execute("SELECT COUNT(*) FROM lectures").fetchone()[0]
+            chunks = self.conn.execute("SELECT COUNT(*) FROM lecture_chunks").fetchone()[0]
+        return {
+            "lectures": lectures,
+            "chunks": chunks,
+            "semantic_search": self.semantic_available(),
+            "embedding_model": EMBEDDING_MODEL if self.semantic_available() else None,
+            "pending_writes": len(self.pending)
+        }
+
+
+lecture_store = LectureStore(os.environ.get("LECTURES_DB", "lectures.db"))
+
+
+@app.get("/search")
+def search_lectures(q: str, limit: int = 10, mode: str = "hybrid"):
+    """
+    Search every stored lecture (transcripts, notes and Q&A) for a topic
+    """
+    if mode not in ("keyword", "semantic", "hybrid"):
+        raise HTTPException(status_code=400, detail="mode must be keyword, semantic or hybrid")
+    if mode == "semantic" and not lecture_store.semantic_available():
+        raise HTTPException(
+            status_code=400,
+            detail="Semantic search needs fastembed (pip install -r requirements-local.txt)"
+        )
+    started = time.perf_counter()
+    results = lecture_store.search(q, max(1, min(limit, 50)), mode)
+    return {
+        "query": q,
+        "mode": mode if lecture_store.semantic_available() else "keyword",
+        "results": results,
+        "took_ms": round((time.perf_counter() - started) * 1000, 2)
+    }
+
+
+@app.get("/lectures")
+def list_lectures(limit: int = 50):
+    """Most recently processed lectures"""
+    return {"lectures": lecture_store.list(max(1, min(limit, 500)))}
+
+
+@app.get("/lectures/{lecture_id}")
+def get_lecture(lecture_id: str):
+    """Stored transcript, notes and Q&A for one lecture"""
+    lecture = lecture_store.get(lecture_id)
+    if lecture is None:
+        raise HTTPException(status_code=404, detail="Lecture not found")
+    return lecture
+
+
+# ==========================================
+# MAIN ENDPOINT WITH AUTOMATIC KEY ROTATION
+# ==========================================
+
+@app.post("/generate_qa")
+async def generate_qa_endpoint(audio: UploadFile = File(...)):
+    """
+    Generate Q&A only from audio
+    """
+    try:
+        upload = await spool_upload(audio)
+        
+        # Transcribe (cached by audio hash)
+        try:
+            transcript = await transcribe_audio(upload)
+        finally:
+            upload.cleanup()
+        
+        # Generate Q&A
+        qa_data = await execute_cached("qa", transcript)
+        lecture_store.remember(upload, transcript, qa=qa_data)
+        
+        return JSONResponse(content=qa_data)
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+
+@app.post("/generate_notes")
+async def generate_notes(audio: UploadFile = File(...)):
+    """
+    Process audio file with automatic API key rotation on rate limits
+    """
+    try:
+        upload = await spool_upload(audio)
+        logger.info(f"Processing audio file: {audio.filename} ({upload.size} bytes)")
+
+        # Step 1: Audio → Transcript (cached, with automatic key rotation)
+        try:
+            transcript = await transcribe_audio(upload)
+        finally:
+            upload.cleanup()
+        
+        logger.info(f"Transcription successful. Length: {len(transcript)} characters")
+
+        
+        # Step 2: Transcript → Structured Notes (with automatic key rotation)
+        structured_notes = await summarize_transcript(transcript)
+        lecture_store.remember(upload, transcript, notes=structured_notes)
+        
+        logger.info("Note generation successful")
+
+        # Add metadata about which key was used
+        structured_notes["_metadata"] = {
+            "processed_with_key": key_manager.current_key_index + 1,
+            "total_keys_available": len(key_manager.api_keys),
+            "trace_id": trace_id.get()
+        }
+
+        return JSONResponse(content=structured_notes)
+    
     except HTTPException:
         raise
     except Exception as e:
@@ -652,6 +3966,748 @@ async def generate_notes(audio: UploadFile = File(...)):
 
 
 
+@app.post("/process-lecture")
+async def process_lecture(audio: UploadFile = File(...)):
+    """
+    Transcribe audio once, then generate notes and Q&A concurrently
+    """
+    try:
+        upload = await spool_upload(audio)
+        logger.info(f"Processing lecture: {audio.filename} ({upload.size} bytes)")
+
+        # Step 1: Audio → Transcript (single pass shared by both outputs)
+        try:
+            transcript = await transcribe_audio(upload)
+        finally:
+            upload.cleanup()
+        
+        logger.info(f"Transcription successful. Length: {len(transcript)} characters")
+
+        # Step 2: Notes and Q&A in parallel, so wall-clock is the slower of the two
+        structured_notes, qa_data = await asyncio.gather(
+            summarize_transcript(transcript),
+            execute_cached("qa", transcript)
+        )
+        lecture_store.remember(upload, transcript, notes=structured_notes, qa=qa_data)
+        
+        logger.info("Lecture processing successful")
+
+        return JSONResponse(content={
+            "notes": structured_notes,
+            "qa": qa_data,
+            "_metadata": {
+                "processed_with_key": key_manager.current_key_index + 1,
+                "total_keys_available": len(key_manager.api_keys),
+                "transcript_length": len(transcript),
+                "trace_id": trace_id.get()
+            }
+        })
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in process_lecture: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+
+
+@app.post("/generate_notes/stream")
+async def generate_notes_stream(audio: UploadFile = File(...)):
+    """
+    Stream note generation progress as Server-Sent Events
+    """
+    upload = await spool_upload(audio)
+    return StreamingResponse(
+        stream_pipeline(upload, "notes"),
+        media_type="text/event-stream",
+        background=BackgroundTask(upload.cleanup)
+    )
+
+
+@app.post("/generate_qa/stream")
+async def generate_qa_stream(audio: UploadFile = File(...)):
+    """
+    Stream Q&A generation progress as Server-Sent Events
+    """
+    upload = await spool_upload(audio)
+    return StreamingResponse(
+        stream_pipeline(upload, "qa"),
+        media_type="text/event-stream",
+        background=BackgroundTask(upload.cleanup)
+    )
+
+
+
+
+# ==========================================
+# BACKGROUND JOB QUEUE
+# ==========================================
+JOB_FEATURES = ("notes", "qa", "lecture")
+
+
+class JobStore:
+    def __init__(self, db_path):
+        """
+        SQLite-backed job records (status, stage, timings, result), safe to
+        share between worker processes
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, audio_hash TEXT NOT NULL, feature TEXT NOT NULL, "
+                "filename TEXT, status TEXT NOT NULL, stage TEXT NOT NULL, "
+                "timings TEXT NOT NULL, result TEXT, error TEXT, "
+                "created_at REAL NOT NULL, updated_at REAL NOT NULL, worker INTEGER)"
+            )
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+            if "worker" not in columns:
+                self.conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_audio ON jobs (audio_hash, feature)"
+            )
+            # Queued audio lives in temp files owned by the process that accepted
+            # the job, so unfinished jobs of exited workers can't resume
+            workers = self.conn.execute(
+                "SELECT DISTINCT worker FROM jobs WHERE status IN ('queued', 'running')"
+            ).fetchall()
+            for (worker,) in workers:
+                if worker is None or worker == os.getpid() or not pid_alive(worker):
+                    self.conn.execute(
+                        "UPDATE jobs SET status = 'failed', error = 'Interrupted by server restart' "
+                        "WHERE status IN ('queued', 'running') AND worker IS ?", (worker,)
+                    )
+    
+    def find_or_create(self, audio_hash, feature, filename):
+        """
+        Return (job_id, created): the queued, running or completed job for this
+        audio, or a new queued one. The check and insert share one write
+        transaction so concurrent submissions, from any worker, collapse
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id FROM jobs WHERE audio_hash = ? AND feature = ? AND status != 'failed' "
+                    "ORDER BY created_at DESC LIMIT 1",
+                    (audio_hash, feature)
+                ).fetchone()
+                if row:
+                    self.conn.rollback()
+                    return row[0], False
+                job_id = uuid.uuid4().hex
+                now = time.time()
+                self.conn.execute(
+                    "INSERT INTO jobs (id, audio_hash, feature, filename, status, stage, timings, "
+                    "created_at, updated_at, worker) VALUES (?, ?, ?, ?, 'queued', 'queued', '{}', ?, ?, ?)",
+                    (job_id, audio_hash, feature, filename, now, now, os.getpid())
+                )
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+        return job_id, True
+    
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        for name in ("timings", "result"):
+            if name in fields:
+                fields[name] = json.dumps(fields[name])
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.lock, self.conn:
+            self.conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id)
+            )
+    
+    def get(self, job_id):
+        with self.lock:
+            self.conn.row_factory = sqlite3.Row
+            row = self.conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            self.conn.row_factory = None
+        if row is None:
+            return None
+        job = dict(row)
+        job["timings"] = json.loads(job["timings"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+class JobQueue:
+    def __init__(self, store, workers=2):
+        """
+        Bounded worker pool draining an in-memory queue of audio jobs
+        """
+        self.store = store
+        self.num_workers = workers
+        self.queue = asyncio.Queue()
+        self.workers = []
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.stage_seconds = {}
+        self.stage_counts = {}
+    
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+            logger.info(f"Started {self.num_workers} job workers")
+    
+    async def submit(self, upload, feature):
+        """Queue a job, or return the existing job for identical audio"""
+        job_id, created = await asyncio.to_thread(
+            self.store.find_or_create, upload.sha256, feature, upload.filename
+        )
+        if not created:
+            logger.info(f"Duplicate submission collapsed into job {job_id}")
+            upload.cleanup()
+            return job_id, False
+        
+        await self.queue.put((job_id, feature, upload))
+        return job_id, True
+    
+    async def _worker(self):
+        # Jobs are batch work however they were submitted
+        groq_priority.set("batch")
+        while True:
+            job_id, feature, upload = await self.queue.get()
+            self.busy += 1
+            try:
+                await self._run(job_id, feature, upload)
+            finally:
+                upload.cleanup()
+                self.busy -= 1
+                self.queue.task_done()
+    
+    async def _run(self, job_id, feature, upload):
+        timings = {}
+        
+        async def stage(name, coro):
+            await asyncio.to_thread(
+                self.store.update, job_id, status="running", stage=name, timings=timings
+            )
+            started = time.perf_counter()
+            result = await coro
+            timings[name] = round(time.perf_counter() - started, 3)
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + timings[name]
+            self.stage_counts[name] = self.stage_counts.get(name, 0) + 1
+            return result
+        
+        try:
+            transcript = await stage("transcribing", transcribe_audio(upload))
+            if feature == "notes":
+                result = await stage("generating_notes", summarize_transcript(transcript))
+            elif feature == "qa":
+                result = await stage("generating_qa", execute_cached("qa", transcript))
+            else:
+                notes, qa_data = await stage("generating", asyncio.gather(
+                    summarize_transcript(transcript),
+                    execute_cached("qa", transcript)
+                ))
+                result = {"notes": notes, "qa": qa_data}
+            lecture_store.remember(upload, transcript, **(result if feature == "lecture" else {feature: result}))
+            
+            await asyncio.to_thread(
+                self.store.update, job_id,
+                status="completed", stage="completed", timings=timings, result=result
+            )
+            self.completed += 1
+        except Exception as e:
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            logger.error(f"Job {job_id} failed: {detail}")
+            await asyncio.to_thread(
+                self.store.update, job_id,
+                status="failed", stage="failed", timings=timings, error=str(detail)
+            )
+            self.failed += 1
+    
+    def stats(self):
+        """Queue depth and mean per-stage timings for capacity planning"""
+        return {
+            "workers": self.num_workers,
+            "busy_workers": self.busy,
+            "queue_depth": self.queue.qsize(),
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_stage_seconds": {
+                name: round(total / self.stage_counts[name], 3)
+                for name, total in self.stage_seconds.items()
+            }
+        }
+
+
+job_queue = JobQueue(
+    JobStore(os.environ.get("JOBS_DB", "jobs.db")),
+    workers=int(os.environ.get("JOB_WORKERS", "2"))
+)
+
+
+@app.on_event("startup")
+async def start_job_workers():
+    job_queue.start()
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(feature: str = "notes", audio: UploadFile = File(...)):
+    """
+    Queue audio for processing and return a job ID immediately
+    """
+    if feature not in JOB_FEATURES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown feature '{feature}'. Use one of: {', '.join(JOB_FEATURES)}"
+        )
+    
+    upload = await spool_upload(audio)
+    job_id, created = await job_queue.submit(upload, feature)
+    return {
+        "job_id": job_id,
+        "created": created,
+        "status_url": f"/jobs/{job_id}"
+    }
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll a job's status, stage, timings and result"""
+    job = await asyncio.to_thread(job_queue.store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job.pop("audio_hash", None)
+    return job
+
+
+@app.get("/jobs")
+def job_stats():
+    """Queue depth and per-stage timings"""
+    return job_queue.stats()
+
+
+
+
+# ==========================================
+# BATCH COURSE INGESTION
+# ==========================================
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".flac", ".ogg", ".webm", ".mp4", ".mpeg", ".mpga")
+BATCH_FEATURES = ("notes", "qa")
+MAX_BATCH_FILES = int(os.environ.get("MAX_BATCH_FILES", "200"))
+# Cap on what an archive may expand to, whatever its compressed size
+MAX_BATCH_EXTRACTED_BYTES = int(float(os.environ.get("MAX_BATCH_EXTRACTED_MB", "4096")) * 1024 * 1024)
+
+# Shared by every batch so concurrent course uploads queue behind one pipeline
+batch_stage_limits = {
+    "transcribe": asyncio.Semaphore(int(os.environ.get(
+        "BATCH_TRANSCRIBE_CONCURRENCY", str(max(2 * len(key_manager.api_keys), os.cpu_count() or 2))
+    ))),
+    "notes": asyncio.Semaphore(int(os.environ.get(
+        "BATCH_NOTES_CONCURRENCY", str(2 * len(key_manager.api_keys))
+    ))),
+    "qa": asyncio.Semaphore(int(os.environ.get(
+        "BATCH_QA_CONCURRENCY", str(2 * len(key_manager.api_keys))
+    ))),
+}
+
+
+def extract_archive(archive: AudioUpload, max_files: int = MAX_BATCH_FILES) -> list:
+    """
+    Copy each audio file in a zip archive to its own spooled upload
+    
+    The member count, each member's size and the total uncompressed size
+    are checked before anything is extracted (zipfile never reads past a
+    member's declared size), and each file's length afterwards.
+    """
+    uploads = []
+    with zipfile.ZipFile(archive.path) as zf:
+        members = [
+            member for member in zf.infolist()
+            if not member.is_dir()
+            and not os.path.basename(member.filename).startswith(".")
+            and member.filename.lower().endswith(AUDIO_EXTENSIONS)
+        ]
+        if len(members) > max_files:
+            raise HTTPException(
+                status_code=413, detail=f"A batch may contain at most {MAX_BATCH_FILES} audio files"
+            )
+        oversized = [member.filename for member in members if member.file_size > MAX_UPLOAD_BYTES]
+        if oversized:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Archive files exceed {MAX_UPLOAD_BYTES // (1024 * 1024)} MB: {', '.join(oversized)}"
+            )
+        if sum(member.file_size for member in members) > MAX_BATCH_EXTRACTED_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Archive expands to more than {MAX_BATCH_EXTRACTED_BYTES // (1024 * 1024)} MB"
+            )
+        try:
+            for member in members:
+                name = os.path.basename(member.filename)
+                digest = hashlib.sha256()
+                with zf.open(member) as src, tempfile.NamedTemporaryFile(
+                    delete=False, suffix=os.path.splitext(name)[1].lower()
+                ) as dst:
+                    upload = AudioUpload(dst.name, None, member.file_size, member.filename)
+                    uploads.append(upload)
+                    while block := src.read(UPLOAD_READ_SIZE):
+                        digest.update(block)
+                        dst.write(block)
+                upload.sha256 = digest.hexdigest()
+                check_duration(upload)
+        except BaseException:
+            # A bad CRC, a full disk or an over-long file: don't leave the rest behind
+            for upload in uploads:
+                upload.cleanup()
+            raise
+    return uploads
+
+
+async def process_batch_item(index: int, upload: AudioUpload, features: list) -> dict:
+    """Run one file through the transcribe, notes and Q&A stages"""
+    started = time.perf_counter()
+    item = {"index": index, "filename": upload.filename}
+    try:
+        async with batch_stage_limits["transcribe"]:
+            try:
+                transcript = await transcribe_audio(upload)
+            finally:
+                upload.cleanup()
+        
+        async def run_stage(feature):
+            async with batch_stage_limits[feature]:
+                if feature == "notes":
+                    return await summarize_transcript(transcript)
+                return await execute_cached("qa", transcript)
+        
+        results = await asyncio.gather(*[run_stage(feature) for feature in features])
+        item.update(dict(zip(features, results)))
+        lecture_store.remember(upload, transcript, **dict(zip(features, results)))
+        item["status"] = "completed"
+    except Exception as e:
+        item["status"] = "failed"
+        item["error"] = e.detail if isinstance(e, HTTPException) else str(e)
+        logger.error(f"Batch item {upload.filename} failed: {item['error']}")
+    item["seconds"] = round(time.perf_counter() - started, 3)
+    return item
+
+
+async def stream_batch(uploads: list, features: list):
+    """Yield one NDJSON line per file as soon as it finishes"""
+    started = time.perf_counter()
+    succeeded = failed = 0
+    yield json.dumps({"event": "batch_started", "files": len(uploads), "features": features}) + "\n"
+    
+    tasks = [
+        asyncio.create_task(process_batch_item(i, upload, features))
+        for i, upload in enumerate(uploads)
+    ]
+    try:
+        for task in asyncio.as_completed(tasks):
+            item = await task
+            if item["status"] == "completed":
+                succeeded += 1
+            else:
+                failed += 1
+            yield json.dumps({"event": "file_completed", **item}) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        for upload in uploads:
+            upload.cleanup()
+    
+    yield json.dumps({
+        "event": "batch_completed",
+        "succeeded": succeeded,
+        "failed": failed,
+        "seconds": round(time.perf_counter() - started, 3)
+    }) + "\n"
+
+
+@app.post("/batch")
+async def batch_ingest(
+    files: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    features: str = "notes,qa"
+):
+    """
+    Process a whole course folder (multiple files and/or a zip archive),
+    streaming per-file results as NDJSON
+    """
+    selected = [feature.strip() for feature in features.split(",") if feature.strip()]
+    if not selected or any(feature not in BATCH_FEATURES for feature in selected):
+        raise HTTPException(
+            status_code=400,
+            detail=f"features must be a comma-separated subset of: {', '.join(BATCH_FEATURES)}"
+        )
+    
+    if len(files or []) > MAX_BATCH_FILES:
+        raise HTTPException(status_code=413, detail=f"A batch may contain at most {MAX_BATCH_FILES} audio files")
+    
+    uploads = []
+    try:
+        for audio in files or []:
+            uploads.append(await spool_upload(audio))
+        if archive is not None:
+            spooled = await spool_upload(archive)
+            try:
+                uploads.extend(await asyncio.to_thread(extract_archive, spooled, MAX_BATCH_FILES - len(uploads)))
+            except zipfile.BadZipFile:
+                raise HTTPException(status_code=400, detail="archive is not a valid zip file")
+            finally:
+                spooled.cleanup()
+    except BaseException:
+        for upload in uploads:
+            upload.cleanup()
+        raise
+    
+    if not uploads:
+        raise HTTPException(status_code=400, detail="No audio files found in the upload")
+    
+    logger.info(f"Batch of {len(uploads)} files queued ({', '.join(selected)})")
+    return StreamingResponse(
+        stream_batch(uploads, selected),
+        media_type="application/x-ndjson",
+        background=BackgroundTask(lambda: [upload.cleanup() for upload in uploads])
+    )
+
+
+
+
+# ==========================================
+# LIVE LECTURE SESSIONS
+# ==========================================
+# Transcript tokens collected before the running summary is extended
+LIVE_SECTION_TOKENS = int(os.environ.get("LIVE_SECTION_TOKENS", "1200"))
+LIVE_SESSION_TTL = int(os.environ.get("LIVE_SESSION_TTL", str(4 * 3600)))
+
+
+class LiveSession:
+    def __init__(self, filename):
+        """
+        A lecture being recorded: segment transcripts in sequence order and a
+        running summary built from per-section notes, so closing the session
+        only has to summarize the last few minutes
+        """
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = "recording"
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.received = 0
+        self.segments = {}           # sequence -> transcript text
+        self.in_flight = set()       # Sequence numbers reserved by uploads being transcribed
+        self.drained = asyncio.Event()   # Set while no upload is being transcribed
+        self.drained.set()
+        self.closing = False         # Close requested; no new uploads, in-flight ones still land
+        self.next_sequence = 0       # First segment not yet added to the transcript
+        self.next_unnumbered = 0     # Handed to uploads without a sequence; only ever increases
+        self.transcript = []
+        self.pending = ""            # Committed text not yet summarized
+        self.partials = []
+        self.summary = None
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+        self.result = None
+    
+    def full_transcript(self):
+        return " ".join(self.transcript)
+    
+    def reserve(self, sequence):
+        self.in_flight.add(sequence)
+        self.drained.clear()
+    
+    def release(self, sequence):
+        self.in_flight.discard(sequence)
+        if not self.in_flight:
+            self.drained.set()
+    
+    async def advance(self, final=False):
+        """
+        Append segments that are now in order and extend the running summary once
+        enough new text has accumulated (or, when final, whatever is left)
+        """
+        async with self.lock:
+            while self.next_sequence in self.segments:
+                text = self.segments.pop(self.next_sequence).strip()
+                if text:
+                    self.transcript.append(text)
+                    self.pending = f"{self.pending} {text}".strip()
+                self.next_sequence += 1
+            
+            if not self.pending or (not final and estimate_tokens(self.pending) < LIVE_SECTION_TOKENS):
+                return
+            # Segments arriving meanwhile wait in self.segments for the next pass
+            with timed_stage("live_summary_update"):
+                partial = await execute_cached("notes", self.pending)
+            self.partials.append(partial)
+            self.summary = merge_notes(self.partials)
+            self.pending = ""
+            logger.info(f"Live session {self.id}: summary now covers {len(self.partials)} sections")
+    
+    def schedule_advance(self):
+        task = asyncio.create_task(self.advance())
+        self.tasks.add(task)
+        task.add_done_callback(self._advanced)
+    
+    def _advanced(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            # The text stays pending and is retried with the next segment or on close
+            logger.error(f"Live session {self.id} summary update failed: {task.exception()}")
+    
+    def status_view(self):
+        return {
+            "session_id": self.id,
+            "status": self.status,
+            "segments_received": self.received,
+            "segments_transcribed": self.next_sequence,
+            "transcript": self.full_transcript(),
+            "pending_tokens": estimate_tokens(self.pending) if self.pending else 0,
+            "summary_sections": len(self.partials),
+            "summary": self.summary,
+            "updated_at": self.updated_at
+        }
+
+
+live_sessions = {}
+
+
+def get_live_session(session_id: str) -> LiveSession:
+    session = live_sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Live session not found")
+    return session
+
+
+@app.post("/live/sessions")
+def start_live_session(filename: str = "live-lecture"):
+    """
+    Start a live lecture; upload audio segments while recording, then close
+    the session to get the final notes and Q&A
+    """
+    now = time.time()
+    for session_id, session in list(live_sessions.items()):
+        if now - session.updated_at > LIVE_SESSION_TTL:
+            del live_sessions[session_id]
+    
+    session = LiveSession(filename)
+    live_sessions[session.id] = session
+    logger.info(f"Live session {session.id} started")
+    return {"session_id": session.id, "section_tokens": LIVE_SECTION_TOKENS}
+
+
+@app.post("/live/sessions/{session_id}/segments")
+async def add_live_segment(session_id: str, audio: UploadFile = File(...), sequence: Optional[int] = None):
+    """
+    Transcribe one recorded segment; segments may arrive out of order if
+    they carry a sequence number (0, 1, 2, ...)
+    """
+    session = get_live_session(session_id)
+    if session.status != "recording" or session.closing:
+        raise HTTPException(status_code=409, detail="Live session is already closed")
+    numbered = sequence is not None
+    if not numbered:
+        sequence = session.next_unnumbered
+    if sequence < session.next_sequence or sequence in session.segments or sequence in session.in_flight:
+        raise HTTPException(status_code=409, detail=f"Segment {sequence} was already received")
+    # Reserve the number before awaiting so a concurrent upload can't take it
+    session.reserve(sequence)
+    session.next_unnumbered = max(session.next_unnumbered, sequence + 1)
+    
+    try:
+        upload = await spool_upload(audio)
+        try:
+            text = await transcribe_audio(upload)
+        finally:
+            upload.cleanup()
+    except BaseException:
+        session.release(sequence)
+        if not numbered:
+            # The client can't retry this number, so skip it rather than stall the summary
+            session.segments[sequence] = ""
+            session.schedule_advance()
+        raise
+    
+    session.release(sequence)
+    if session.status != "recording":
+        # Close waits for uploads in flight, so this only happens if it gave up on them
+        raise HTTPException(status_code=409, detail="Live session was closed while the segment was transcribed")
+    session.received += 1
+    session.segments[sequence] = text
+    session.updated_at = time.time()
+    session.schedule_advance()
+    return {"session_id": session.id, "sequence": sequence, "text": text}
+
+
+@app.get("/live/sessions/{session_id}")
+def live_session_status(session_id: str):
+    """Transcript so far and the running summary"""
+    return get_live_session(session_id).status_view()
+
+
+@app.post("/live/sessions/{session_id}/close")
+async def close_live_session(session_id: str):
+    """
+    Finish the lecture: summarize the remaining text, merge it into the
+    running summary and generate Q&A over the full transcript
+    """
+    session = get_live_session(session_id)
+    if session.result is not None:
+        return session.result
+    if session.status == "finalizing" or session.closing:
+        raise HTTPException(status_code=409, detail="Live session is already closing")
+    session.closing = True
+    started = time.perf_counter()
+    
+    try:
+        # Let segments still being transcribed land before the transcript is final
+        await session.drained.wait()
+        session.status = "finalizing"
+        await asyncio.gather(*session.tasks, return_exceptions=True)
+        if session.segments:
+            missing = sorted(set(range(session.next_sequence, max(session.segments))) - set(session.segments))
+            logger.warning(f"Live session {session.id} closing without segments {missing}")
+            # Skip gaps so everything received still reaches the transcript
+            for sequence in sorted(session.segments):
+                session.segments[session.next_sequence] = session.segments.pop(sequence)
+                await session.advance()
+        
+        transcript = session.full_transcript()
+        if not transcript:
+            raise HTTPException(status_code=400, detail="No speech was transcribed in this session")
+        _, qa_data = await asyncio.gather(
+            session.advance(final=True),
+            execute_cached("qa", transcript)
+        )
+    except BaseException:
+        session.status = "recording"
+        session.closing = False
+        raise
+    
+    session.status = "closed"
+    lecture_id = hashlib.sha256(session.id.encode("utf-8")).hexdigest()[:16]
+    lecture_store.save_in_background(lecture_id, session.filename, transcript, session.summary, qa_data)
+    session.result = {
+        "session_id": session.id,
+        "lecture_id": lecture_id,
+        "notes": session.summary,
+        "qa": qa_data,
+        "_metadata": {
+            "segments": session.next_sequence,
+            "summary_sections": len(session.partials),
+            "transcript_length": len(transcript),
+            "finalize_seconds": round(time.perf_counter() - started, 3),
+            "trace_id": trace_id.get()
+        }
+    }
+    logger.info(f"Live session {session.id} closed in {session.result['_metadata']['finalize_seconds']}s")
+    return session.result
+
+
+
+
 # ==========================================
 # ALTERNATIVE: Manual key rotation endpoint
 # ==========================================
@@ -663,7 +4719,20 @@ def manual_rotate_key():
         return {
             "message": "Key rotated successfully",
             "current_key": key_manager.current_key_index + 1,
-            "total_keys": len(key_manager.api_keys)
+            "total_keys": len(key_manager.api_keys),
+            "shared_across_workers": bool(key_manager.shared)
         }
     except HTTPException as e:
-        raise e
\ No newline at end of file
+        raise e
+
+
+# CORS middleware, added last so it wraps every other middleware and their
+# early error responses carry CORS headers too
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["Retry-After"],
+)
\ No newline at end of file
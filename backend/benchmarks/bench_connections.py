@@ -0,0 +1,64 @@
+"""
+Per-request connection overhead: a fresh Groq client per call vs the
+pooled keep-alive client used by GroqKeyManager.
+
+Runs against the local mock Groq server, so no API key or network is needed.
+
+    python benchmarks/bench_connections.py --requests 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+from app import http_pool_settings
+from mock_groq import MockSettings, create_mock_app, start_server
+
+
+async def call(client):
+    await client.chat.completions.create(
+        model="llama-3.3-70b-versatile",
+        messages=[{"role": "user", "content": "ping"}]
+    )
+
+
+async def fresh_client_per_request(base_url, requests):
+    for _ in range(requests):
+        client = AsyncGroq(api_key="benchmark", base_url=base_url, max_retries=0)
+        await call(client)
+        await client.close()
+
+
+async def pooled_client(base_url, requests):
+    http_client = DefaultAsyncHttpxClient(**http_pool_settings())
+    client = AsyncGroq(api_key="benchmark", base_url=base_url, http_client=http_client, max_retries=0)
+    for _ in range(requests):
+        await call(client)
+    await http_client.aclose()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    # Zero mock latency so only client and connection overhead is measured
+    settings = MockSettings(chat_base=0, chat_tokens_per_second=10 ** 9)
+    base_url = start_server(create_mock_app(settings))
+    for name, scenario in [("fresh client per request", fresh_client_per_request),
+                           ("pooled keep-alive client", pooled_client)]:
+        started = time.perf_counter()
+        await scenario(base_url, args.requests)
+        elapsed = time.perf_counter() - started
+        print(f"{name:<26} {elapsed * 1000 / args.requests:7.2f} ms/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
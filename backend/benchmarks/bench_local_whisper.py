@@ -0,0 +1,62 @@
+"""
+Real-time factor of the local faster-whisper backend per CPU core.
+
+RTF = processing seconds / audio seconds (lower is faster). The same
+recording is transcribed once per worker concurrently, so the aggregate
+RTF shows how throughput scales with the process pool.
+
+    pip install -r requirements-local.txt
+    python benchmarks/bench_local_whisper.py lecture.wav --workers 1 2 4
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app import LocalWhisperBackend, WhisperModel
+
+
+def audio_seconds(path):
+    with wave.open(path, "rb") as wav:
+        return wav.getnframes() / wav.getframerate()
+
+
+async def run(path, model, workers, threads, compute_type):
+    backend = LocalWhisperBackend(model, workers, threads, compute_type)
+    await backend.warm_up()
+    started = time.perf_counter()
+    await asyncio.gather(*[backend.transcribe(path) for _ in range(workers)])
+    elapsed = time.perf_counter() - started
+    backend.shutdown()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("audio", help="WAV recording to transcribe")
+    parser.add_argument("--model", default="base.en")
+    parser.add_argument("--compute-type", default="int8")
+    parser.add_argument("--threads", type=int, default=2, help="CPU threads per worker")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    args = parser.parse_args()
+
+    if WhisperModel is None:
+        sys.exit("faster-whisper is not installed (pip install -r requirements-local.txt)")
+
+    duration = audio_seconds(args.audio)
+    print(f"{args.audio}: {duration:.1f}s audio, model={args.model}, {args.compute_type}")
+    for workers in args.workers:
+        elapsed = await run(args.audio, args.model, workers, args.threads, args.compute_type)
+        rtf = elapsed / (duration * workers)
+        cores = workers * args.threads
+        print(f"workers={workers:<3} cores={cores:<3} wall={elapsed:7.2f}s "
+              f"aggregate RTF={rtf:.3f}  RTF per core={rtf * cores:.3f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
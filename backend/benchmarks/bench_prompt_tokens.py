@@ -0,0 +1,255 @@
+"""
+Input-token report for the notes and Q&A prompts: the previous verbose
+prompts with the raw transcript vs the compact prompts with a normalized
+transcript. Also checks that normalization only removes disfluencies, by
+comparing the words left against the lecture as written, counting repeats,
+so a dropped "1, 1, 0" or "A A T T" shows up as lost content.
+
+    python benchmarks/bench_prompt_tokens.py --minutes 10 30 60 --filler-rate 0.08
+
+Token counts use tiktoken's cl100k_base encoding when it is installed and
+the app's ~4 characters/token estimate otherwise.
+"""
+import argparse
+import os
+import random
+import re
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app import build_notes_prompt, build_qa_prompt, estimate_tokens, normalize_transcript, plan_qa_chunks
+
+try:
+    import tiktoken
+    ENCODING = tiktoken.get_encoding("cl100k_base")
+    count_tokens = lambda text: len(ENCODING.encode(text))
+except ImportError:
+    count_tokens = estimate_tokens
+
+WORDS_PER_MINUTE = 140
+FILLERS = ["um,", "uh,", "you know,", "I mean,", "like,", "erm,"]
+FILLER_WORDS = {"um", "uh", "erm", "you", "know", "i", "mean", "like"}
+SENTENCES = [
+    "Gradient descent updates each weight in the direction that lowers the loss.",
+    "The learning rate controls how large each of those steps is.",
+    "If the rate is too high the loss oscillates instead of converging.",
+    "Momentum keeps a running average of past gradients to smooth the updates.",
+    "We evaluate on a held out validation set to detect overfitting early.",
+    "Regularization adds a penalty on large weights to the objective.",
+    "Batch normalization rescales activations so deeper networks train faster.",
+    "The chain rule lets backpropagation compute every gradient in one pass.",
+    # Repeated numbers, letters and units that normalization must keep
+    "The eigenvector of this matrix is 1, 1, 0.",
+    "The identity matrix has 1 1 on the diagonal.",
+    "This strand of DNA reads A A T T before the marker.",
+    "The wire in the sensor is 2 mm thick.",
+]
+
+# Prompts before the compact templates (notes-v1 / qa-v1)
+LEGACY_NOTES_PROMPT = """
+You are an expert note-taking assistant and learning guide. Your task is to transform the following transcript into comprehensive, actionable study notes.
+
+**Instructions:**
+1. Identify and extract all speakers (if mentioned) and attribute their contributions
+2. Organize content into clear topics with descriptive headings
+3. For each topic, provide:
+   - Key points with detailed explanations
+   - Context and additional insights to deepen understanding
+   - Practical examples or applications
+   - Recommended learning resources (books, courses, articles, or tools)
+   - Summary that connects ideas together
+4. Act as a learning guide by highlighting important concepts and suggesting next steps
+
+Return the result in strict JSON with this exact format:
+{{
+  "title": "Descriptive Title of the Lecture/Discussion",
+  "overview": "Brief 2-3 sentence overview of the entire content",
+  "speakers": [
+    {{
+      "name": "Speaker Name or 'Unknown' if not mentioned",
+      "role": "Their role or context if mentioned",
+      "key_contributions": ["Main points they discussed"]
+    }}
+  ],
+  "topics": [
+    {{
+      "heading": "Clear Topic Heading",
+      "summary": "2-3 sentence summary of this topic",
+      "key_points": [
+        {{
+          "point": "Main point statement",
+          "explanation": "Detailed explanation with context",
+          "examples": ["Practical example 1", "Practical example 2"],
+          "importance": "Why this matters or how to apply it"
+        }}
+      ],
+      "additional_insights": [
+        "Extra context or connection to other concepts",
+        "Common misconceptions or pitfalls to avoid"
+      ],
+      "recommended_resources": [
+        {{
+          "type": "book|course|article|video|tool|documentation",
+          "title": "Resource name",
+          "description": "Why this resource is helpful",
+          "url": "URL if applicable or 'Search online'"
+        }}
+      ]
+    }}
+  ],
+  "key_takeaways": [
+    "Most important insight 1",
+    "Most important insight 2",
+    "Most important insight 3"
+  ],
+  "action_items": [
+    "Specific next step or practice exercise 1",
+    "Specific next step or practice exercise 2"
+  ],
+  "further_learning": {{
+    "beginner": ["Resource for those new to the topic"],
+    "intermediate": ["Resource for those with some knowledge"],
+    "advanced": ["Resource for deep diving"]
+  }}
+}}
+
+**Transcript:**
+{text}
+
+**Important:** 
+- If speakers are not identified in the transcript, use "Speaker 1", "Speaker 2" or "Unknown Speaker"
+- Ensure all JSON is properly formatted with correct escaping
+- Provide specific, actionable resource recommendations
+- Keep summaries concise but informative
+- Focus on creating value beyond just transcribing - add insights that help learning
+"""
+
+LEGACY_QA_PROMPT = """
+You are an expert educator and question generator. Your task is to create comprehensive, thoughtful questions and answers based on the following transcript to help students test their understanding and reinforce learning.
+
+**Instructions:**
+1. Analyze the transcript thoroughly
+2. Generate exactly 20 questions that cover:
+   - Key concepts and definitions (5 questions)
+   - Application and practical scenarios (5 questions)
+   - Critical thinking and analysis (5 questions)
+   - Synthesis and connections (5 questions)
+3. Each question should:
+   - Be clear and specific
+   - Test real understanding, not just memorization
+   - Be answerable from the content provided
+   - Progress from basic to advanced difficulty
+4. Each answer should:
+   - Be comprehensive yet concise
+   - Include examples where relevant
+   - Explain the "why" not just the "what"
+   - Connect to broader concepts when applicable
+
+Return the result in strict JSON with this exact format:
+{{
+  "topic": "Main topic of the transcript",
+  "total_questions": 20,
+  "difficulty_breakdown": {{
+    "easy": 5,
+    "medium": 10,
+    "hard": 5
+  }},
+  "questions": [
+    {{
+      "id": 1,
+      "question": "Clear, specific question text",
+      "answer": "Comprehensive answer with explanation",
+      "difficulty": "easy|medium|hard",
+      "category": "concept|application|critical_thinking|synthesis",
+      "key_terms": ["term1", "term2"],
+      "related_topics": ["topic1", "topic2"]
+    }}
+  ],
+  "study_tips": [
+    "Tip 1 for effective studying",
+    "Tip 2 for retention",
+    "Tip 3 for application"
+  ],
+  "quiz_summary": {{
+    "main_themes": ["theme1", "theme2", "theme3"],
+    "prerequisites": ["What students should know before"],
+    "next_steps": ["What to study next"]
+  }}
+}}
+
+**Transcript:**
+{text}
+
+**Important:** 
+- Generate EXACTLY 20 questions
+- Ensure questions are diverse in type and difficulty
+- Answers should be 2-4 sentences each
+- Focus on understanding, not trivia
+- Make questions practical and relevant
+"""
+
+
+def spoken_transcript(minutes, filler_rate, repeat_rate, seed=0):
+    """
+    A lecture transcript with fillers, stutters and repeated sentences,
+    and the same lecture without them
+    """
+    rng = random.Random(seed)
+    words, sentences, written = 0, [], []
+    while words < minutes * WORDS_PER_MINUTE:
+        # Never the same sentence twice in a row, so every repeat is a disfluency
+        written.append(rng.choice([s for s in SENTENCES if not written or s != written[-1]]))
+        tokens = written[-1].split()
+        spoken = []
+        for token in tokens:
+            if rng.random() < filler_rate:
+                spoken.append(rng.choice(FILLERS))
+            spoken.append(token)
+            if rng.random() < repeat_rate / 2:
+                spoken.append(token)
+        sentence = " ".join(spoken)
+        sentences.append(sentence)
+        if rng.random() < repeat_rate:
+            sentences.append(sentence)
+        words += len(spoken)
+    return " ".join(sentences), " ".join(written)
+
+
+def content_words(text):
+    """Word counts, ignoring case, punctuation and filler words"""
+    return Counter(word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in FILLER_WORDS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=int, nargs="+", default=[10, 30, 60])
+    parser.add_argument("--filler-rate", type=float, default=0.08, help="Fillers per spoken word")
+    parser.add_argument("--repeat-rate", type=float, default=0.05, help="Repeated words/sentences rate")
+    args = parser.parse_args()
+
+    print(f"{'minutes':>7} {'task':>5} {'before':>8} {'after':>8} {'saved':>7} "
+          f"{'content kept':>13} {'repeats left':>13}")
+    for minutes in args.minutes:
+        raw, written = spoken_transcript(minutes, args.filler_rate, args.repeat_rate)
+        normalized = normalize_transcript(raw)
+        expected, after_words = content_words(written), content_words(normalized)
+        kept = sum((expected & after_words).values()) / sum(expected.values())
+        left = sum((after_words - expected).values()) / sum(expected.values())
+        for task, legacy, compact in (
+            ("notes", LEGACY_NOTES_PROMPT, build_notes_prompt),
+            # Q&A is generated per chunk; count every chunk prompt
+            ("qa", LEGACY_QA_PROMPT, lambda text: "".join(
+                build_qa_prompt(chunk, counts) for chunk, counts in plan_qa_chunks(text)
+            )),
+        ):
+            before = count_tokens(legacy.format(text=raw))
+            after = count_tokens(compact(normalized))
+            print(f"{minutes:>7} {task:>5} {before:>8} {after:>8} "
+                  f"{1 - after / before:>7.1%} {kept:>13.1%} {left:>13.1%}")
+
+
+if __name__ == "__main__":
+    main()
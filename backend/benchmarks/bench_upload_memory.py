@@ -0,0 +1,71 @@
+"""
+Peak Python memory while ingesting concurrent uploads: reading each upload
+fully into memory and copying it to a temp file (the old path) vs
+spool_upload(), which copies to disk in fixed-size blocks.
+
+    python benchmarks/bench_upload_memory.py --uploads 24 --size-mb 25
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from starlette.datastructures import UploadFile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+
+from app import spool_upload
+
+BLOCK = os.urandom(1024 * 1024)
+
+
+def make_upload(size_mb):
+    """An UploadFile backed by a disk-spooled temp file, like Starlette builds"""
+    spooled = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+    for _ in range(size_mb):
+        spooled.write(BLOCK)
+    spooled.seek(0)
+    return UploadFile(file=spooled, filename="lecture.wav")
+
+
+async def buffered_ingest(audio):
+    contents = await audio.read()
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
+        tmp.write(contents)
+    os.remove(tmp.name)
+
+
+async def spooled_ingest(audio):
+    upload = await spool_upload(audio)
+    upload.cleanup()
+
+
+async def measure(ingest, uploads, size_mb):
+    files = [make_upload(size_mb) for _ in range(uploads)]
+    tracemalloc.start()
+    await asyncio.gather(*[ingest(audio) for audio in files])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    for audio in files:
+        audio.file.close()
+    return peak / (1024 * 1024)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--uploads", type=int, default=24)
+    parser.add_argument("--size-mb", type=int, default=25)
+    args = parser.parse_args()
+
+    print(f"{args.uploads} concurrent uploads of {args.size_mb} MB")
+    for name, ingest in [("read() + temp copy", buffered_ingest),
+                         ("spool_upload()", spooled_ingest)]:
+        peak = await measure(ingest, args.uploads, args.size_mb)
+        print(f"{name:<20} peak {peak:8.1f} MB total, {peak / args.uploads:6.1f} MB/request")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+"""
+Synthetic lecture recordings for benchmarks: 16 kHz mono WAV with
+speech-like harmonic bursts separated by pauses of varying length.
+"""
+import os
+import tempfile
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+def lecture_samples(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    total = int(seconds * SAMPLE_RATE)
+    samples = np.zeros(total, dtype=np.float32)
+    position = 0
+    while position < total:
+        burst = int(rng.uniform(2, 8) * SAMPLE_RATE)
+        t = np.arange(min(burst, total - position)) / SAMPLE_RATE
+        pitch = rng.uniform(100, 220)
+        voice = sum(np.sin(2 * np.pi * pitch * h * t) / h for h in range(1, 5))
+        envelope = 0.5 + 0.5 * np.sin(2 * np.pi * 4 * t)  # ~4 syllables per second
+        samples[position:position + len(t)] = 0.2 * voice * envelope
+        position += len(t) + int(rng.uniform(0.3, 3.0) * SAMPLE_RATE)
+    samples += 0.003 * rng.standard_normal(total).astype(np.float32)
+    return samples
+
+
+def write_lecture_wav(path, seconds, seed=0):
+    samples = lecture_samples(seconds, seed)
+    with wave.open(path, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(SAMPLE_RATE)
+        out.writeframes((np.clip(samples, -1, 1) * 32767).astype("<i2").tobytes())
+    return path
+
+
+def make_fixtures(lengths, copies=1, directory=None, seed_offset=0):
+    """
+    Write `copies` distinct recordings of each length (in seconds); returns
+    {length: [paths]}. Calls with different seed offsets write different audio.
+    """
+    directory = directory or tempfile.mkdtemp(prefix="classecho-fixtures-")
+    fixtures = {}
+    for length in lengths:
+        fixtures[length] = [
+            write_lecture_wav(os.path.join(directory, f"lecture_{length}s_{i}.wav"), length, seed=seed_offset + length * 1000 + i)
+            for i in range(copies)
+        ]
+    return fixtures
@@ -0,0 +1,299 @@
+"""
+Load test for the audio endpoints against the mock Groq server.
+
+Runs the real app in-process on a local port with GROQ_BASE_URL pointed at
+benchmarks/mock_groq.py, replays synthetic lectures through each scenario,
+and writes p50/p95/p99 latency, throughput and peak memory to a JSON
+baseline that later runs can be compared against.
+
+    python benchmarks/load_test.py --output baseline.json
+    python benchmarks/load_test.py --compare baseline.json --output after.json
+    python benchmarks/load_test.py --scenarios --check-concurrency 8
+    python benchmarks/load_test.py --scenarios --key-scaling 1 2 4
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from fixtures import make_fixtures
+from mock_groq import MockSettings, create_mock_app, start_server
+
+SCENARIOS = {
+    "notes": ["/generate_notes"],
+    "qa": ["/generate_qa"],
+    "lecture": ["/process-lecture"],
+    # Roughly how the Flutter client is used: notes and Q&A for the same upload
+    "mixed": ["/generate_notes", "/generate_qa", "/generate_notes", "/generate_qa", "/process-lecture"],
+}
+
+
+class MemorySampler:
+    """Tracks peak resident memory of this process while a scenario runs"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    @staticmethod
+    def rss_bytes():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            # ru_maxrss is KB on Linux, bytes on macOS; only a lifetime peak
+            scale = 1 if platform.system() == "Darwin" else 1024
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    def _run(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss_bytes())
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.peak = self.rss_bytes()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+
+
+async def run_scenario(base_url, endpoints, recordings, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, statuses = [], {}
+    routes = itertools.cycle(endpoints)
+
+    async def send(client, endpoint, path, user):
+        async with semaphore:
+            started = time.perf_counter()
+            with open(path, "rb") as f:
+                # Each request is a different student as far as admission control is concerned:
+                # the load test poses as a trusted proxy forwarding for distinct addresses
+                response = await client.post(endpoint, files={"audio": (os.path.basename(path), f, "audio/wav")},
+                                             headers={"X-Forwarded-For": f"10.0.{user // 256}.{user % 256}"})
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        with MemorySampler() as memory:
+            started = time.perf_counter()
+            await asyncio.gather(*[
+                send(client, next(routes), path, user) for user, path in enumerate(recordings)
+            ])
+            elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        "requests": len(latencies),
+        "concurrency": concurrency,
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "p50_seconds": round(float(p50), 3),
+        "p95_seconds": round(float(p95), 3),
+        "p99_seconds": round(float(p99), 3),
+        "requests_per_second": round(len(latencies) / elapsed, 3),
+        "wall_seconds": round(elapsed, 3),
+        "peak_rss_mb": round(memory.peak / (1024 * 1024), 1)
+    }
+
+
+async def check_concurrency(base_url, recordings, max_slowdown):
+    """
+    Time one /generate_notes upload on its own, then the rest all at once;
+    concurrent uploads should finish in about the time of a single one
+    """
+    single = await run_scenario(base_url, ["/generate_notes"], recordings[:1], 1)
+    concurrent = await run_scenario(base_url, ["/generate_notes"], recordings[1:], len(recordings) - 1)
+    slowdown = concurrent["wall_seconds"] / single["wall_seconds"]
+    return {
+        "single_wall_seconds": single["wall_seconds"],
+        "concurrent_requests": concurrent["requests"],
+        "concurrent_wall_seconds": concurrent["wall_seconds"],
+        "statuses": concurrent["statuses"],
+        "slowdown": round(slowdown, 2),
+        "max_slowdown": max_slowdown,
+        "passed": slowdown <= max_slowdown and set(concurrent["statuses"]) == {"200"}
+    }
+
+
+def use_keys(classecho, count):
+    """Swap the app's key manager for one with `count` mock keys"""
+    for name in [name for name in os.environ if name.startswith("GROQ_API_KEY")]:
+        del os.environ[name]
+    os.environ["GROQ_API_KEY"] = "mock-key-0"
+    for i in range(1, count):
+        os.environ[f"GROQ_API_KEY{i}"] = f"mock-key-{i}"
+    classecho.key_manager = classecho.GroqKeyManager()
+
+
+async def check_key_scaling(classecho, base_url, settings, key_counts, audio_seconds, chunk_seconds):
+    """
+    Upload one multi-chunk WAV per key count while the mock serves one call
+    per key at a time; wall time should fall as keys are added
+    """
+    original = (classecho.key_manager, classecho.CHUNK_SECONDS, settings.key_concurrency)
+    classecho.CHUNK_SECONDS, settings.key_concurrency = chunk_seconds, 1
+    runs = []
+    try:
+        # Fresh audio, so nothing comes from the transcript cache the scenarios filled
+        fixtures = make_fixtures([audio_seconds], copies=len(key_counts), seed_offset=1_000_000)
+        for count, path in zip(key_counts, fixtures[audio_seconds]):
+            use_keys(classecho, count)
+            result = await run_scenario(base_url, ["/generate_notes"], [path], 1)
+            runs.append({"keys": count, "wall_seconds": result["wall_seconds"], "statuses": result["statuses"]})
+    finally:
+        classecho.key_manager, classecho.CHUNK_SECONDS, settings.key_concurrency = original
+    return {
+        "audio_seconds": audio_seconds,
+        "chunk_seconds": chunk_seconds,
+        "runs": runs,
+        "passed": all(run["statuses"] == {"200": 1} for run in runs) and all(
+            later["wall_seconds"] < earlier["wall_seconds"] * 0.9 for earlier, later in zip(runs, runs[1:])
+        )
+    }
+
+
+def compare(baseline, current):
+    """Print the change in each metric relative to a previous run"""
+    lower_is_better = ("p50_seconds", "p95_seconds", "p99_seconds", "peak_rss_mb")
+    print(f"\n{'scenario':<10} {'metric':<20} {'baseline':>10} {'current':>10} {'change':>9}")
+    for name, result in current["scenarios"].items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before:
+            continue
+        for metric in lower_is_better + ("requests_per_second",):
+            old, new = before[metric], result[metric]
+            change = (new - old) / old * 100 if old else 0.0
+            better = change < 0 if metric in lower_is_better else change > 0
+            flag = "" if abs(change) < 5 else (" better" if better else " worse")
+            print(f"{name:<10} {metric:<20} {old:>10} {new:>10} {change:>+8.1f}%{flag}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, cwd=BENCH_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", nargs="*", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=24, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--audio-seconds", type=int, nargs="+", default=[30, 120],
+                        help="Fixture lengths; requests cycle through them")
+    parser.add_argument("--keys", type=int, default=3, help="Number of mock API keys")
+    parser.add_argument("--rpm", type=int, default=0, help="Mock per-key RPM limit (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Mock random 429 probability")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Multiply mock latencies")
+    parser.add_argument("--check-concurrency", type=int, default=0, metavar="N",
+                        help="Also check that N concurrent /generate_notes uploads take about as long as one")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="Allowed concurrent/single wall-time ratio for --check-concurrency")
+    parser.add_argument("--key-scaling", type=int, nargs="+", metavar="KEYS",
+                        help="Also check that a multi-chunk upload gets faster with each of these key counts")
+    parser.add_argument("--chunk-seconds", type=float, default=20,
+                        help="Transcription chunk length for --key-scaling")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    settings = MockSettings(error_rate=args.error_rate, rpm_limit=args.rpm)
+    for name in ("transcribe_base", "transcribe_per_audio_second", "chat_base"):
+        setattr(settings, name, getattr(settings, name) * args.latency_scale)
+    mock_url = start_server(create_mock_app(settings))
+
+    # The app reads its configuration at import time
+    os.environ["GROQ_BASE_URL"] = mock_url
+    os.environ["GROQ_API_KEY"] = "mock-key-0"
+    for i in range(1, args.keys):
+        os.environ[f"GROQ_API_KEY{i}"] = f"mock-key-{i}"
+    os.environ.setdefault("GROQ_RPM_LIMIT", str(args.rpm or 1000))
+    os.environ.setdefault("JOBS_DB", ":memory:")
+    os.environ.setdefault("LECTURES_DB", ":memory:")
+    os.environ.setdefault("LOCAL_WHISPER_FALLBACK", "0")
+    os.environ.setdefault("TRUSTED_PROXIES", "127.0.0.1")
+    # Let every simulated upload in flight at once through admission control
+    os.environ.setdefault("ADMISSION_MAX_ACTIVE", str(max(args.concurrency, args.check_concurrency, 4)))
+    import app as classecho
+
+    app_url = start_server(classecho.app)
+
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "settings": vars(args)
+        },
+        "scenarios": {}
+    }
+
+    for index, name in enumerate(args.scenarios):
+        # Fresh recordings per scenario so caches don't carry over between them
+        copies = -(-args.requests // len(args.audio_seconds))
+        fixtures = make_fixtures([s + index for s in args.audio_seconds], copies=copies)
+        recordings = list(itertools.chain(*zip(*fixtures.values())))[:args.requests]
+        result = await run_scenario(app_url, SCENARIOS[name], recordings, args.concurrency)
+        results["scenarios"][name] = result
+        print(f"{name:<8} {result['requests']:>4} req  p50 {result['p50_seconds']:6.2f}s  "
+              f"p95 {result['p95_seconds']:6.2f}s  p99 {result['p99_seconds']:6.2f}s  "
+              f"{result['requests_per_second']:6.2f} req/s  peak {result['peak_rss_mb']:.0f} MB  "
+              f"{result['statuses']}")
+
+    failed = False
+    if args.check_concurrency:
+        fixtures = make_fixtures([args.audio_seconds[0] + len(args.scenarios)], copies=args.check_concurrency + 1)
+        check = await check_concurrency(app_url, next(iter(fixtures.values())), args.max_slowdown)
+        results["concurrency_check"] = check
+        failed = not check["passed"]
+        print(f"concurrency: 1 upload {check['single_wall_seconds']:.2f}s, {check['concurrent_requests']} at once "
+              f"{check['concurrent_wall_seconds']:.2f}s ({check['slowdown']:.2f}x, max {args.max_slowdown}x)  "
+              f"{check['statuses']}  {'ok' if check['passed'] else 'FAILED'}")
+
+    if args.key_scaling:
+        scaling = await check_key_scaling(
+            classecho, app_url, settings, args.key_scaling, max(args.audio_seconds), args.chunk_seconds
+        )
+        results["key_scaling"] = scaling
+        failed = failed or not scaling["passed"]
+        print(f"key scaling ({scaling['audio_seconds']}s audio, {scaling['chunk_seconds']:.0f}s chunks): "
+              + ", ".join(f"{run['keys']} keys {run['wall_seconds']:.2f}s" for run in scaling["runs"])
+              + f"  {'ok' if scaling['passed'] else 'FAILED'}")
+
+    async with httpx.AsyncClient(base_url=mock_url) as client:
+        results["mock_usage"] = (await client.get("/mock/stats")).json()
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
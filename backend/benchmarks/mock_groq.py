@@ -0,0 +1,228 @@
+"""
+Local stand-in for the Groq transcription and chat completion endpoints.
+
+Latency scales with audio length and completion size, 429s can be injected
+at random or by a per-key requests-per-minute limit, each key can be limited
+to a number of calls in progress at once, and token usage is tallied per key. Point the app at it with GROQ_BASE_URL.
+
+    python benchmarks/mock_groq.py --port 9000 --rpm 30 --error-rate 0.05
+"""
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+
+import uvicorn
+from fastapi import FastAPI, Request, UploadFile, File, Form
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+# 16 kHz mono 16-bit PCM
+BYTES_PER_AUDIO_SECOND = 32000
+
+
+class MockSettings:
+    def __init__(self, transcribe_base=0.3, transcribe_per_audio_second=0.01,
+                 chat_base=0.5, chat_tokens_per_second=800, error_rate=0.0,
+                 rpm_limit=0, questions=20, key_concurrency=0):
+        self.transcribe_base = transcribe_base
+        self.transcribe_per_audio_second = transcribe_per_audio_second
+        self.chat_base = chat_base
+        self.chat_tokens_per_second = chat_tokens_per_second
+        self.error_rate = error_rate
+        self.rpm_limit = rpm_limit
+        self.questions = questions
+        self.key_concurrency = key_concurrency
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def notes_document(seed):
+    return {
+        "title": f"Mock Lecture {seed}",
+        "overview": "A synthetic lecture used for benchmarking.",
+        "speakers": [{"name": "Speaker 1", "role": "Lecturer", "key_contributions": ["Mock content"]}],
+        "topics": [{
+            "heading": f"Topic {i + 1}",
+            "summary": "Synthetic topic summary.",
+            "key_points": [{
+                "point": "A key point",
+                "explanation": "An explanation of the key point.",
+                "examples": ["Example"],
+                "importance": "Why it matters"
+            }],
+            "additional_insights": ["An insight"],
+            "recommended_resources": [{
+                "type": "book", "title": "Resource", "description": "Helpful", "url": "Search online"
+            }]
+        } for i in range(4)],
+        "key_takeaways": ["Takeaway 1", "Takeaway 2", "Takeaway 3"],
+        "action_items": ["Practice exercise"],
+        "further_learning": {"beginner": ["Intro"], "intermediate": ["Next"], "advanced": ["Deep dive"]}
+    }
+
+
+def qa_document(seed, questions):
+    categories = ["concept", "application", "critical_thinking", "synthesis"]
+    return {
+        "topic": f"Mock Lecture {seed}",
+        "total_questions": questions,
+        "difficulty_breakdown": {"easy": 5, "medium": 10, "hard": 5},
+        "questions": [{
+            "id": i + 1,
+            "question": f"Synthetic question {i + 1} about lecture {seed}?",
+            "answer": "A synthetic answer that explains the reasoning in two sentences. It is mock data.",
+            "difficulty": ["easy", "medium", "medium", "hard"][i % 4],
+            "category": categories[i * len(categories) // questions],
+            "key_terms": ["term"],
+            "related_topics": ["topic"]
+        } for i in range(questions)],
+        "study_tips": ["Tip 1", "Tip 2", "Tip 3"],
+        "quiz_summary": {"main_themes": ["theme"], "prerequisites": ["basics"], "next_steps": ["more"]}
+    }
+
+
+def create_mock_app(settings=None):
+    """Build the mock API; stats are served on GET /mock/stats"""
+    settings = settings or MockSettings()
+    app = FastAPI(title="Mock Groq")
+    windows = defaultdict(deque)
+    key_slots = {}
+    stats = defaultdict(lambda: {
+        "requests": 0, "rate_limited": 0, "audio_seconds": 0.0,
+        "prompt_tokens": 0, "completion_tokens": 0
+    })
+
+    def admit(request: Request):
+        """Return a 429 response if this key is over budget, else None"""
+        key = request.headers.get("authorization", "anonymous").removeprefix("Bearer ")
+        now = time.monotonic()
+        window = windows[key]
+        while window and now - window[0] > 60:
+            window.popleft()
+        stats[key]["requests"] += 1
+        limited = settings.rpm_limit and len(window) >= settings.rpm_limit
+        if limited or random.random() < settings.error_rate:
+            stats[key]["rate_limited"] += 1
+            reset = 60 - (now - window[0]) if limited else 1.0
+            return key, JSONResponse(
+                status_code=429,
+                headers={"retry-after": f"{reset:.0f}", "x-ratelimit-remaining-requests": "0",
+                         "x-ratelimit-reset-requests": f"{reset:.2f}s"},
+                content={"error": {"message": "Rate limit reached (mock)", "type": "requests"}}
+            )
+        window.append(now)
+        return key, None
+
+    def key_slot(key):
+        """Calls beyond key_concurrency on one key wait their turn (0 = no limit)"""
+        if not settings.key_concurrency:
+            return contextlib.nullcontext()
+        if key not in key_slots:
+            key_slots[key] = asyncio.Semaphore(settings.key_concurrency)
+        return key_slots[key]
+
+    def rate_limit_headers(key):
+        remaining = max(settings.rpm_limit - len(windows[key]), 0) if settings.rpm_limit else 1000
+        return {"x-ratelimit-remaining-requests": str(remaining),
+                "x-ratelimit-limit-tokens": "6000", "x-ratelimit-remaining-tokens": "6000"}
+
+    @app.post("/openai/v1/audio/transcriptions")
+    async def transcriptions(request: Request, file: UploadFile = File(...), model: str = Form(...)):
+        key, limited = admit(request)
+        if limited:
+            return limited
+        audio = await file.read()
+        audio_seconds = len(audio) / BYTES_PER_AUDIO_SECOND
+        stats[key]["audio_seconds"] += audio_seconds
+        async with key_slot(key):
+            await asyncio.sleep(settings.transcribe_base + audio_seconds * settings.transcribe_per_audio_second)
+        # Unique text per recording so downstream caches behave as they would in production
+        digest = hashlib.sha256(audio).hexdigest()[:12]
+        words = " ".join(f"word{i % 97}" for i in range(int(audio_seconds * 2.5)))
+        text = f"Lecture {digest}. {words}."
+        return PlainTextResponse(text, headers=rate_limit_headers(key))
+
+    @app.post("/openai/v1/chat/completions")
+    async def chat_completions(request: Request):
+        key, limited = admit(request)
+        if limited:
+            return limited
+        body = await request.json()
+        prompt = " ".join(m.get("content", "") for m in body.get("messages", []))
+        seed = hashlib.sha256(prompt.encode()).hexdigest()[:8]
+        if "question generator" in prompt:
+            document = qa_document(seed, settings.questions)
+        else:
+            document = notes_document(seed)
+        content = json.dumps(document)
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        stats[key]["prompt_tokens"] += prompt_tokens
+        stats[key]["completion_tokens"] += completion_tokens
+        generation_seconds = completion_tokens / settings.chat_tokens_per_second
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        base = {"id": f"mock-{seed}", "created": int(time.time()), "model": body.get("model")}
+
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(settings.chat_base)
+                pieces = [content[i:i + 64] for i in range(0, len(content), 64)]
+                for piece in pieces:
+                    await asyncio.sleep(generation_seconds / len(pieces))
+                    chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                        {"index": 0, "delta": {"content": piece}, "finish_reason": None}
+                    ]}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream",
+                                     headers=rate_limit_headers(key))
+
+        async with key_slot(key):
+            await asyncio.sleep(settings.chat_base + generation_seconds)
+        return JSONResponse(headers=rate_limit_headers(key), content={
+            **base, "object": "chat.completion", "usage": usage,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}]
+        })
+
+    @app.get("/mock/stats")
+    def mock_stats():
+        return stats
+
+    return app
+
+
+def start_server(app):
+    """Serve an ASGI app on a free local port in a daemon thread; returns its URL"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, port=port, log_level="error"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--rpm", type=int, default=0, help="Per-key requests per minute (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probability of a random 429")
+    parser.add_argument("--latency-scale", type=float, default=1.0)
+    parser.add_argument("--key-concurrency", type=int, default=0,
+                        help="Calls in progress at once per key (0 = unlimited)")
+    args = parser.parse_args()
+
+    settings = MockSettings(error_rate=args.error_rate, rpm_limit=args.rpm, key_concurrency=args.key_concurrency)
+    for name in ("transcribe_base", "transcribe_per_audio_second", "chat_base"):
+        setattr(settings, name, getattr(settings, name) * args.latency_scale)
+    uvicorn.run(create_mock_app(settings), port=args.port)